@@ -2,47 +2,107 @@
 """The run script."""
 import logging
 import os
+from typing import TYPE_CHECKING
 
-# import flywheel functions
-from flywheel_gear_toolkit import GearToolkitContext
 from utils.parser import parse_config
-from utils.command_line import exec_command
+from utils import profiler
+from utils.cache import TransformCache
+from utils.publish import Publisher
+from utils.storage import intermediate_ext, nifti, release_work_dir, resolve_work_dir
 
-from utils.join_data import housekeeping
-
-from utils.Inspect_segmentations import SegQC
+if TYPE_CHECKING:
+    # import flywheel functions
+    from flywheel_gear_toolkit import GearToolkitContext
 
 # from utils.parseOutput import parseOutput
 
 # The gear is split up into 2 main components. The run.py file which is executed
 # when the container runs. The run.py file then imports the rest of the gear as a
-# module.
+# module. The stage modules, and the numpy, nibabel, pandas, PIL and matplotlib
+# they use, are imported when their stage starts so that the gear starts quickly
+# (see utils/benchmarks/startup.py).
 
 log = logging.getLogger(__name__)
 
-def main(context: GearToolkitContext) -> None:
+def main(context: "GearToolkitContext") -> None:
     """Parses config and runs."""
-    input_path, age, demographics = parse_config(context)
-    
-    print("running main.sh...")
-    # Set the command to be executed
-    command = "/flywheel/v0/app/main.sh"
-    # Add the input path and age to the command
-    command = f"{command} {input_path} {age}"
-    # Execute the command
-    exec_command(command, shell=True, cont_output=True)
-
-    # Run housekeeping
-    print("running housekeeping...")
-    housekeeping(demographics)
-
-    # Run Segmentation QC
-    print("running segmentation QC...")
-    subject_label = demographics['subject'].values[0]
-    SegQC(input_path, subject_label)
+    output_dir = str(context.output_dir)
+    # Record the resources used by every step when profiling is enabled
+    if context.config.get("profile"):
+        profiler.enable(os.path.join(output_dir, profiler.TRACE_NAME))
+
+    publisher = None
+    try:
+        with profiler.span("parse_config"):
+            input_path, age, demographics, gear_options = parse_config(context)
+        
+        # Keep the intermediates as the storage policy asks
+        threads = gear_options["threads"]
+        work_dir = resolve_work_dir(gear_options["storage"], str(context.work_dir),
+                                    input_path)
+        ext = intermediate_ext(gear_options["storage"])
+        cache = None
+        if gear_options["transform_cache"]:
+            cache = TransformCache(gear_options["transform_cache"],
+                                   gear_options["transform_cache_size_gb"] * 1024 ** 3)
+
+        print("running pipeline...")
+        from utils.join_data import housekeeping, segmentation_output
+        from utils.pipeline import qc_step, run_pipeline, run_step
+        from utils.refine import FINAL_ATLAS_CALLOSUM
+
+        # Publish the segmentation as soon as it is written, named once the
+        # demographics are in
+        demographics_future = demographics
+        publisher = Publisher(threads)
+        publisher.expect(
+            os.path.join(work_dir, nifti(FINAL_ATLAS_CALLOSUM, ext)),
+            lambda: segmentation_output(
+                output_dir, demographics_future.result()['acquisition'].values[0]),
+        )
+
+        # Run the segmentation steps, skipping those with an up to date checkpoint
+        run_pipeline(input_path, age, work_dir=work_dir, threads=threads, ext=ext,
+                     crop=gear_options["crop"],
+                     preset=gear_options["registration_preset"], cache=cache,
+                     on_complete=publisher.step_complete,
+                     atropos_iterations=gear_options["atropos_iterations"],
+                     atropos_convergence=gear_options["atropos_convergence"],
+                     preprocessing=gear_options["preprocessing"],
+                     template_store=gear_options["template_store"])
+
+        # The demographics were pulled while the pipeline ran
+        demographics = demographics.result()
+
+        # Run housekeeping
+        print("running housekeeping...")
+        with profiler.span("housekeeping"):
+            housekeeping(demographics, work_dir, output_dir, ext, threads, publisher)
+
+        # Run Segmentation QC
+        print("running segmentation QC...")
+        subject_label = demographics['subject'].values[0]
+        acquisition_label = demographics['acquisition'].values[0]
+        run_step(qc_step(input_path, subject_label, work_dir, output_dir,
+                         slices=gear_options["qc_slices"], threads=threads,
+                         acquisition=acquisition_label, ext=ext),
+                 work_dir, threads)
+
+        # Free the work files kept on the tmpfs once the outputs are published,
+        # failing the run if any of them could not be
+        publisher.wait()
+        publisher.close()
+        release_work_dir(work_dir)
+    finally:
+        # Let the outputs being published complete, even if a step failed
+        if publisher is not None:
+            publisher.close()
+        profiler.write()
 
 # Only execute if file is run as main, not when imported by another module
 if __name__ == "__main__":  # pragma: no cover
+    from flywheel_gear_toolkit import GearToolkitContext
+
     # Get access to gear config, inputs, and sdk client if enabled.
     with GearToolkitContext() as gear_context:
 
@@ -2,157 +2,328 @@ import os
 import numpy as np
 import nibabel as nib
 from PIL import Image, ImageDraw, ImageFont
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
 import sys
-import glob
+import io
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
-def SegQC(input_image_path, subj):
+from utils.publish import atomic_write
 
-    # Setup the output directory
-    overlay_dir = '/flywheel/v0/output'  # Directory to save overlay images
-    # Create overlay directory if it doesn't exist
-    os.makedirs(overlay_dir, exist_ok=True)
-
-    # Dictionary to store paths of generated GIF images
-    gif_images = {}  # Key: subject, Value: dict of plane: gif path
-
-    print(f'Processing {subj}...')
-    # # Path to output image
-    # atlas_image_path = os.path.join('/flywheel/v0/output/Segmentation_atlas_all_classes.nii.gz')  # T1
-
-
-    # Find all files that end with '_segmentation.nii.gz'
-    atlas_image_path = glob.glob(os.path.join(overlay_dir, '*_segmentation.nii.gz'))
-    # Take the first file
-    atlas_image_path = atlas_image_path[0]
-
-
-    # Load images
-    if not os.path.exists(input_image_path) or not os.path.exists(atlas_image_path):
-        print(f"Images not found for {subj}. Skipping.")
-        sys.exit(0)  # Exit the entire script with status code 0 (successful exit)
-
-    registered_img = nib.load(input_image_path)
-    reference_img = nib.load(atlas_image_path)
-
-    # Get data arrays
-    registered_data = registered_img.get_fdata()
-    reference_data = reference_img.get_fdata()
+# Number of discrete colours for the atlas labels (0 to 30)
+ATLAS_COLOURS = 31
 
-    # Define the planes and corresponding slice indices
-    planes = ['axial', 'coronal', 'sagittal']
-    slices_indices = {
-        'axial': registered_data.shape[2] // 2,
-        'coronal': registered_data.shape[1] // 2,
-        'sagittal': registered_data.shape[0] // 2
-    }
+PLANES = ['axial', 'coronal', 'sagittal']
+# Axis of the image each plane slices
+PLANE_AXES = {'axial': 2, 'coronal': 1, 'sagittal': 0}
 
-    # Dictionary to store GIF paths for this subject
-    subject_gif_paths = {}
 
-    for plane in planes:
-        slice_index = slices_indices[plane]
+@lru_cache(maxsize=None)
+def jet_lut():
+    """Get the jet colormap with one 8-bit RGB colour per atlas label, built once."""
+    import matplotlib
 
-        # Extract slices based on the plane
-        if plane == 'axial':
-            registered_slice = registered_data[:, :, slice_index]
-            reference_slice = reference_data[:, :, slice_index]
-        elif plane == 'coronal':
-            registered_slice = registered_data[:, slice_index, :]
-            reference_slice = reference_data[:, slice_index, :]
-            # Rotate for correct orientation
-            registered_slice = np.rot90(registered_slice)
-            reference_slice = np.rot90(reference_slice)
-        elif plane == 'sagittal':
-            registered_slice = registered_data[slice_index, :, :]
-            reference_slice = reference_data[slice_index, :, :]
-            # Rotate for correct orientation
-            registered_slice = np.rot90(registered_slice)
-            reference_slice = np.rot90(reference_slice)
+    try:
+        colormap = matplotlib.colormaps['jet'].resampled(ATLAS_COLOURS)
+    except AttributeError:  # matplotlib < 3.5
+        import matplotlib.cm as cm
+        colormap = cm.get_cmap('jet', ATLAS_COLOURS)
+    return (colormap(np.arange(ATLAS_COLOURS))[:, :3] * 255).astype(np.uint8)
 
-        # Normalize the registered image for display (grayscale)
-        registered_slice_norm = (registered_slice - np.min(registered_slice)) / (np.max(registered_slice) - np.min(registered_slice) + 1e-8)
-        registered_image_uint8 = (registered_slice_norm * 255).astype(np.uint8)
-        registered_image = Image.fromarray(registered_image_uint8).convert('L')
 
-        # Apply a colormap to the atlas labels (0 to 30)
-        colormap = cm.get_cmap('jet', 31)  # Use a colormap with 31 discrete colors (0-30)
-        reference_slice_colormap = colormap(reference_slice / 30.0)  # Normalize between 0 and 1
+def colour_labels(labels):
+    """Colour an atlas slice with the jet lookup table.
 
-        # Convert the colormapped atlas slice to an 8-bit image (RGB)
-        reference_image_colored = (reference_slice_colormap[:, :, :3] * 255).astype(np.uint8)
-        reference_image = Image.fromarray(reference_image_colored)
+    Labels are binned as matplotlib bins ``colormap(labels / 30)``, so the colours
+    are those of applying the colormap directly.
+    """
+    index = np.nan_to_num(np.asarray(labels, dtype=np.float64) / 30.0) * ATLAS_COLOURS
+    index = np.clip(index, 0, ATLAS_COLOURS - 1).astype(np.intp)
+    return jet_lut()[index]
 
-        # Resize images to a standard size
-        registered_image = registered_image.resize((256, 256))
-        reference_image = reference_image.resize((256, 256))
 
-        # Function to add text below image
-        def add_text(image, subj_name, plane_name):
-            # Increase image height to add space for the text
-            new_height = image.height + 30  # Add 30 pixels at the bottom
-            new_image = Image.new('RGB', (image.width, new_height), color=(0, 0, 0))  # 'RGB' mode for color
+def slice_positions(size, slices):
+    """Evenly strided slice indices along an axis; a single slice is the middle one."""
+    return [(k + 1) * size // (slices + 1) for k in range(slices)]
 
-            # Paste the image onto the new image
-            new_image.paste(image, (0, 0))
 
-            # Draw the text
-            draw = ImageDraw.Draw(new_image)
-            text = f'{plane_name.capitalize()}'
-            font = ImageFont.load_default()  # Use default font
+def gif_name(subj, plane, k=0, slices=1):
+    """Name of the QC GIF of the k-th slice of a plane."""
+    if slices == 1:
+        return f'sub-{subj}_{plane}.gif'
+    return f'sub-{subj}_{plane}_{k + 1:02d}.gif'
+
 
-            # Calculate text width and position using textbbox
-            text_bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = text_bbox[2] - text_bbox[0]  # Width of the text
-            text_height = text_bbox[3] - text_bbox[1]  # Height of the text
+def add_text(image, text):
+    """Add a caption below an image."""
+    # Increase image height to add space for the text
+    new_height = image.height + 30  # Add 30 pixels at the bottom
+    new_image = Image.new('RGB', (image.width, new_height), color=(0, 0, 0))  # 'RGB' mode for color
 
-            text_x = (new_image.width - text_width) // 2
-            text_y = image.height + (30 - text_height) // 2  # Center the text vertically
+    # Paste the image onto the new image
+    new_image.paste(image, (0, 0))
 
-            # Add text
-            draw.text((text_x, text_y), text, font=font, fill=(255, 255, 255))  # White text
+    # Draw the text
+    draw = ImageDraw.Draw(new_image)
+    font = ImageFont.load_default()  # Use default font
+
+    # Calculate text width and position using textbbox
+    text_bbox = draw.textbbox((0, 0), text, font=font)
+    text_width = text_bbox[2] - text_bbox[0]  # Width of the text
+    text_height = text_bbox[3] - text_bbox[1]  # Height of the text
+
+    text_x = (new_image.width - text_width) // 2
+    text_y = image.height + (30 - text_height) // 2  # Center the text vertically
+
+    # Add text
+    draw.text((text_x, text_y), text, font=font, fill=(255, 255, 255))  # White text
+
+    return new_image
+
+
+def load_slice(img, plane, slice_index):
+    """Read one slice of an image through its array proxy.
+
+    Only the slice is read (memory-mapped for uncompressed images), instead of
+    loading the whole volume as float64 with ``get_fdata``. Arrays that are
+    already loaded are sliced directly.
+    """
+    data = getattr(img, 'dataobj', img)
+    if plane == 'axial':
+        data = data[:, :, slice_index]
+    elif plane == 'coronal':
+        data = data[:, slice_index, :]
+    else:
+        data = data[slice_index, :, :]
+    return np.asarray(data)
+
+
+def qc_source(path, slices=1):
+    """Open an image for the QC slice reads.
+
+    The image is kept as a proxy, its slices read with ``load_slice``. Only a
+    gzipped image read at several slices per plane is loaded whole, in its native
+    dtype, as each proxy slice read decompresses the file again.
+
+    Returns:
+        The image, or its loaded array.
+    """
+    img = nib.load(path)
+    if slices > 1 and path.endswith('.gz'):
+        return np.asanyarray(img.dataobj)
+    return img
+
+
+def edges(labels):
+    """Mark the voxels of a slice where the label changes from the previous voxel."""
+    edge = np.zeros(labels.shape, dtype=bool)
+    edge[1:, :] |= labels[1:, :] != labels[:-1, :]
+    edge[:, 1:] |= labels[:, 1:] != labels[:, :-1]
+    return edge
+
+
+def montage_row(img, labels=False):
+    """Render the mid sagittal, coronal and axial slices side by side, as ``slicer -a``.
+
+    The slices are shown in grayscale over the image range with their edges in red:
+    the outline of the non-zero voxels of an image, or the label boundaries of an
+    atlas.
+
+    Args:
+        img: Image (read through its array proxy) or loaded 3D array.
+        labels (bool, optional): Outline the labels of an atlas. Defaults to False.
+
+    Returns:
+        numpy.ndarray: 8-bit RGB row of the three panels.
+    """
+    panels = []
+    for plane in ['sagittal', 'coronal', 'axial']:
+        data = np.rot90(load_slice(img, plane, img.shape[PLANE_AXES[plane]] // 2))
+        panels.append(np.nan_to_num(data.astype(np.float64)))
+    low = min(p.min() for p in panels)
+    high = max(p.max() for p in panels)
+
+    height = max(p.shape[0] for p in panels)
+    row = []
+    for data in panels:
+        grey = ((data - low) / (high - low + 1e-8) * 255).astype(np.uint8)
+        panel = np.repeat(grey[:, :, np.newaxis], 3, axis=2)
+        panel[edges(np.rint(data) if labels else data > 0)] = (255, 0, 0)
+        # Pad to a common height, centred, as slicer does
+        top = (height - panel.shape[0]) // 2
+        row.append(np.pad(panel, ((top, height - panel.shape[0] - top), (0, 0), (0, 0))))
+    return np.concatenate(row, axis=1)
+
+
+def QCMontage(bet_image, atlas_image, montage_path):
+    """Write the QC montage: the brain extracted image above the segmentation atlas.
+
+    Replaces ``slicer -a`` on each image and ``pngappend`` of the two, reading only
+    the mid slices of each volume.
+
+    Args:
+        bet_image: Brain extracted native image, as a path, image or loaded array.
+        atlas_image: Segmentation atlas, as a path, image or loaded array.
+        montage_path (str): Where to write the PNG montage.
+    """
+    if isinstance(bet_image, str):
+        bet_image = nib.load(bet_image)
+    if isinstance(atlas_image, str):
+        atlas_image = nib.load(atlas_image)
+
+    rows = [montage_row(bet_image), montage_row(atlas_image, labels=True)]
+    width = max(r.shape[1] for r in rows)
+    montage = np.concatenate(
+        [np.pad(r, ((0, 0), (0, width - r.shape[1]), (0, 0))) for r in rows], axis=0)
+    with atomic_write(montage_path) as f:
+        Image.fromarray(montage).save(f, format='PNG')
+
+
+def render_slice(registered_slice, reference_slice, plane, caption):
+    """Render the atlas/input animated GIF of one slice.
+
+    Args:
+        registered_slice (numpy.ndarray): 2D slice of the input image.
+        reference_slice (numpy.ndarray): Matching 2D slice of the atlas.
+        plane (str): Plane of the slices, one of ``PLANES``.
+        caption (str): Caption shown below the slice.
+
+    Returns:
+        bytes: The encoded GIF.
+    """
+    registered_slice = np.asarray(registered_slice, dtype=np.float64)
+    reference_slice = np.asarray(reference_slice)
+    if plane != 'axial':
+        # Rotate for correct orientation
+        registered_slice = np.rot90(registered_slice)
+        reference_slice = np.rot90(reference_slice)
+
+    # Normalize the registered image for display (grayscale)
+    registered_slice_norm = (registered_slice - np.min(registered_slice)) / (np.max(registered_slice) - np.min(registered_slice) + 1e-8)
+    registered_image_uint8 = (registered_slice_norm * 255).astype(np.uint8)
+    registered_image = Image.fromarray(registered_image_uint8).convert('L')
+
+    # Apply the jet colormap to the atlas labels (0 to 30) as an 8-bit RGB image
+    reference_image = Image.fromarray(colour_labels(reference_slice))
+
+    # Resize images to a standard size
+    registered_image = registered_image.resize((256, 256))
+    reference_image = reference_image.resize((256, 256))
+
+    # Add the caption to images
+    registered_image = add_text(registered_image, caption)
+    reference_image = add_text(reference_image, caption)
+
+    # Create an animated GIF of the slice, in memory
+    frames = [reference_image.convert('RGB'), registered_image.convert('RGB')]
+    gif = io.BytesIO()
+    frames[0].save(gif, format='GIF', append_images=frames[1:], save_all=True, duration=500, loop=0)
+    return gif.getvalue()
+
+
+def SegQC(input_image_path, atlas_image_path, subj, overlay_dir='/flywheel/v0/output', slices=1, threads=1,
+          bet_image_path=None, montage_path=None):
+    """Render the segmentation QC GIFs and the HTML page showing them.
+
+    Each plane is shown at ``slices`` evenly strided positions (the middle slice by
+    default). The slices are read up front through the array proxies (see
+    ``qc_source``); GIF encoding holds the GIL, so they are rendered in a process
+    pool and the GIFs written once all are rendered.
+
+    Args:
+        input_image_path (str): Native space input image.
+        atlas_image_path (str): Segmentation atlas of the input image.
+        subj (str): Subject label used to name the QC files.
+        overlay_dir (str, optional): Directory for the QC files.
+        slices (int, optional): Number of slices per plane. Defaults to 1.
+        threads (int, optional): Number of processes rendering slices. Defaults to 1.
+        bet_image_path (str, optional): Brain extracted native image for the QC
+            montage.
+        montage_path (str, optional): Where to write the QC montage of the brain
+            extracted image and the segmentation, if given.
+    """
 
-            return new_image
+    # Setup the output directory
+    # Create overlay directory if it doesn't exist
+    os.makedirs(overlay_dir, exist_ok=True)
 
-        # Add plane name to images
-        registered_image = add_text(registered_image, subj, plane)
-        reference_image = add_text(reference_image, subj, plane)
+    print(f'Processing {subj}...')
 
-        # Create an animated GIF for this plane
-        frames = [reference_image.convert('RGB'), registered_image.convert('RGB')]
+    # Load images
+    if not os.path.exists(input_image_path) or not os.path.exists(atlas_image_path):
+        print(f"Images not found for {subj}. Skipping.")
+        sys.exit(0)  # Exit the entire script with status code 0 (successful exit)
 
-        gif_image_path = os.path.join(overlay_dir, f'sub-{subj}_{plane}.gif')
+    # Keep the images as proxies and read only the slices needed, memory-mapped for
+    # uncompressed images. A gzipped image is decompressed again for every slice
+    # read, so with several slices per plane it is decompressed once up front
+    slices = max(1, int(slices))
+    registered = qc_source(input_image_path, slices)
+    reference = qc_source(atlas_image_path, slices)
+
+    # Slice positions of each plane, one grid row per position
+    positions = {
+        plane: slice_positions(registered.shape[PLANE_AXES[plane]], slices)
+        for plane in PLANES
+    }
 
-        # Save frames as an animated GIF
-        frames[0].save(gif_image_path, format='GIF', append_images=frames[1:], save_all=True, duration=500, loop=0)
+    tasks = {
+        (plane, k): (load_slice(registered, plane, slice_index),
+                     load_slice(reference, plane, slice_index), plane,
+                     plane.capitalize() if slices == 1 else f'{plane.capitalize()} {slice_index}')
+        for plane in PLANES
+        for k, slice_index in enumerate(positions[plane])
+    }
+    del registered
 
-        subject_gif_paths[plane] = gif_image_path
+    # Render all slices, in a pool when there is more than one worker, then write
+    # the GIFs in bulk
+    workers = min(max(1, int(threads or 1)), len(tasks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            gifs = dict(zip(tasks, pool.map(render_slice, *zip(*tasks.values()))))
+    else:
+        gifs = {key: render_slice(*task) for key, task in tasks.items()}
 
-    # Store the GIF paths for this subject
-    gif_images[subj] = subject_gif_paths
+    for (plane, k), gif in gifs.items():
+        with atomic_write(os.path.join(overlay_dir, gif_name(subj, plane, k, slices))) as f:
+            f.write(gif)
 
     print('All animated GIFs have been created.')
 
-    # Optionally, create an HTML file to view all GIFs together in rows
-    html_output_path = os.path.join('/flywheel/v0/output/registration_check.html')
-    with open(html_output_path, 'w') as f:
+    if montage_path is not None:
+        QCMontage(bet_image_path, reference, montage_path)
+        print('QC montage has been created.')
+
+    # Create an HTML file to view all GIFs together: a column per plane, a row per
+    # slice position
+    html_output_path = os.path.join(overlay_dir, 'registration_check.html')
+    with atomic_write(html_output_path, 'w') as f:
         f.write('<html><body>\n')
         f.write('<style>table {border-collapse: collapse;} td {padding: 5px;}</style>\n')
         f.write('<table>\n')
-        # for subj, planes_dict in gif_images.items():
         f.write('<tr>\n')
         f.write(f'<td colspan="3" style="text-align:center;"><h2>{subj}</h2></td>\n')
         f.write('</tr>\n')
-        f.write('<tr>\n')
-        for plane in ['axial', 'coronal', 'sagittal']:
+        for k in range(slices):
+            f.write('<tr>\n')
+            for plane in PLANES:
                 f.write(f'<td style="text-align:center;">\n')
-                f.write(f'<img src="./{subj}_{plane}.gif" alt="{subj} {plane}"><br>\n')
+                f.write(f'<img src="./{gif_name(subj, plane, k, slices)}" alt="{subj} {plane}"><br>\n')
                 f.write(f'<b>{plane.capitalize()}</b>\n')
                 f.write('</td>\n')
-        f.write('</tr>\n')
+            f.write('</tr>\n')
         f.write('<tr><td colspan="3"><hr></td></tr>\n')
         f.write('</table>\n')
         f.write('</body></html>')
 
     print('HTML file has been created to view all GIFs together.')
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Write the QC montage of a segmentation.")
+    parser.add_argument("bet_image", help="brain extracted native image")
+    parser.add_argument("atlas_image", help="segmentation atlas")
+    parser.add_argument("montage_path", help="output PNG")
+    args = parser.parse_args()
+    QCMontage(args.bet_image, args.atlas_image, args.montage_path)
@@ -0,0 +1,309 @@
+"""Batch mode: run the pipeline for many subjects in one container.
+
+Each subject gets its own work and output directories under the batch output root,
+and subjects run in a bounded process pool that shares the node's thread budget.
+The derived files of each template age (uncompressed template, prior stack and mask
+boxes) are written once to a template store, ``<output_root>/templates`` by default,
+and read by all subjects from there (see ``utils.templates.shared_store``). Once
+every subject has finished, the volume tables are aggregated into
+``batch_volumes.csv`` and the outcome of each subject into ``batch_status.csv``.
+
+The inputs are either a csv file with an ``input`` column (the NIfTI path), an
+``age`` column (months, or a template age such as "12M") and optional ``subject``,
+``session`` and ``acquisition`` columns, or a directory of NIfTI images that all use
+the ``--age`` template. A subject's directories are named after its subject,
+session and acquisition labels, which must be unique within the batch.
+
+Example:
+    python3 -m utils.batch cohort.csv /data/minimorph-batch --jobs 4 --threads 16
+"""
+
+import argparse
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from utils import profiler
+from utils.cache import DEFAULT_MAX_BYTES, TransformCache
+from utils.join_data import housekeeping, segmentation_output
+from utils.parser import age_to_template
+from utils.pipeline import TEMPLATES_DIR, qc_step, run_pipeline, run_step
+from utils.publish import Publisher
+from utils.refine import FINAL_ATLAS_CALLOSUM
+from utils.preprocess import DEFAULT_MODE, PREPROCESSING_MODES
+from utils.registration import DEFAULT_PRESET, REGISTRATION_PRESETS
+from utils.segmentation import DEFAULT_CONVERGENCE, DEFAULT_ITERATIONS
+from utils.storage import STORAGE_POLICIES, intermediate_ext, nifti, release_work_dir
+from utils.storage import resolve_work_dir
+from utils.templates import load_bundle
+from utils.threads import thread_budget
+
+log = logging.getLogger(__name__)
+
+NIFTI_PATTERNS = ("*.nii", "*.nii.gz")
+
+
+def subject_name(path):
+    """Name a subject after its input file, without the NIfTI extension."""
+    name = os.path.basename(path)
+    for ext in (".nii.gz", ".nii"):
+        if name.endswith(ext):
+            return name[: -len(ext)]
+    return name
+
+
+def job_id(subject, session, acquisition):
+    """Name the directory of a subject after its labels."""
+    labels = (subject, session, acquisition)
+    return "_".join(f"{key}-{label.replace(os.sep, '-')}"
+                    for key, label in zip(("sub", "ses", "acq"), labels))
+
+
+def read_jobs(inputs, age=None):
+    """Read the subjects of a batch.
+
+    Args:
+        inputs (str): A csv file listing the inputs, or a directory of NIfTI images.
+        age (str, optional): Age for inputs without one, required for a directory.
+
+    Returns:
+        list: One dict per subject with ``job`` (see ``job_id``), ``input``,
+            ``age``, ``subject``, ``session`` and ``acquisition`` keys.
+
+    Raises:
+        ValueError: If an input has no age, or two inputs have the same labels.
+    """
+    if os.path.isdir(inputs):
+        paths = sorted(p for pattern in NIFTI_PATTERNS
+                       for p in glob.glob(os.path.join(inputs, pattern)))
+        rows = [{"input": p} for p in paths]
+    else:
+        rows = pd.read_csv(inputs, dtype=str).to_dict("records")
+
+    jobs = []
+    inputs_of = {}
+    for row in rows:
+        row = {k: v for k, v in row.items() if isinstance(v, str) and v}
+        row_age = row.get("age", age)
+        if row_age is None:
+            raise ValueError(f"No age given for {row['input']}")
+        name = subject_name(row["input"])
+        labels = [row.get(key, name) for key in ("subject", "session", "acquisition")]
+        job = job_id(*labels)
+        if job in inputs_of:
+            raise ValueError(f"{row['input']} and {inputs_of[job]} are both {job}, "
+                             "give them distinct subject, session or acquisition labels")
+        inputs_of[job] = row["input"]
+        jobs.append({
+            "job": job,
+            "input": os.path.abspath(row["input"]),
+            "age": age_to_template(row_age),
+            "subject": labels[0],
+            "session": labels[1],
+            "acquisition": labels[2],
+        })
+    return jobs
+
+
+def run_subject(job, output_root, threads, stack_dirs, profile=False, qc_slices=1,
+                storage="compressed", crop=False, preset=DEFAULT_PRESET, cache_dir=None,
+                template_store=None, cache_bytes=DEFAULT_MAX_BYTES,
+                atropos_iterations=DEFAULT_ITERATIONS,
+                atropos_convergence=DEFAULT_CONVERGENCE, preprocessing=DEFAULT_MODE):
+    """Run the pipeline, housekeeping and QC for one subject of a batch.
+
+    Args:
+        job (dict): Subject description from ``read_jobs``.
+        output_root (str): Batch output root, the subject uses
+            ``<output_root>/<job>/{work,output}``.
+        threads (int): Thread budget of the subject.
+        stack_dirs (dict): Shared template stack directory of each template age.
+        profile (bool, optional): Write a resource trace to the subject's output
+            directory. Defaults to False.
+        qc_slices (int, optional): Number of QC slices per plane. Defaults to 1.
+        storage (str, optional): Storage policy of the intermediates, see
+            ``utils.storage``. Defaults to "compressed".
+        crop (bool, optional): Run the heavy steps on the brain bounding box.
+            Defaults to False.
+        preset (str, optional): Registration preset. Defaults to "standard".
+        cache_dir (str, optional): Transform cache directory shared by the
+            subjects, see ``utils.cache``.
+        template_store (str, optional): Template store shared by the subjects.
+        cache_bytes (int, optional): Size limit of the transform cache. Defaults
+            to 20 GiB.
+        atropos_iterations (int, optional): Maximum number of Atropos rounds.
+        atropos_convergence (float, optional): Posterior change the Atropos
+            rounds stop at.
+        preprocessing (str, optional): Preprocessing mode, see
+            ``utils.preprocess``. Defaults to "full".
+
+    Returns:
+        str: Path to the subject's volumes csv.
+    """
+    subject_root = os.path.join(output_root, job["job"])
+    output_dir = os.path.join(subject_root, "output")
+    os.makedirs(output_dir, exist_ok=True)
+    work_dir = resolve_work_dir(storage, os.path.join(subject_root, "work"), job["input"])
+    ext = intermediate_ext(storage)
+    if profile:
+        profiler.enable(os.path.join(output_dir, profiler.TRACE_NAME))
+
+    # Publish the segmentation as soon as it is written
+    publisher = Publisher(threads)
+    publisher.expect(os.path.join(work_dir, nifti(FINAL_ATLAS_CALLOSUM, ext)),
+                     segmentation_output(output_dir, job["acquisition"]))
+    cache = TransformCache(cache_dir, cache_bytes) if cache_dir else None
+    try:
+        run_pipeline(job["input"], job["age"], work_dir=work_dir, threads=threads,
+                     stack_dir=stack_dirs.get(job["age"]), ext=ext, crop=crop,
+                     preset=preset, cache=cache,
+                     on_complete=publisher.step_complete,
+                     atropos_iterations=atropos_iterations,
+                     atropos_convergence=atropos_convergence,
+                     preprocessing=preprocessing, template_store=template_store,
+                     verify_template=False)
+
+        demographics = pd.DataFrame([{
+            "subject": job["subject"],
+            "session": job["session"],
+            "acquisition": job["acquisition"],
+        }])
+        with profiler.span("housekeeping"):
+            volumes_csv = housekeeping(demographics, work_dir, output_dir, ext, threads,
+                                       publisher)
+        run_step(qc_step(job["input"], job["subject"], work_dir, output_dir, qc_slices,
+                         threads, job["acquisition"], ext), work_dir, threads)
+
+        # Free the work files kept on the tmpfs once the outputs are published
+        publisher.close()
+        release_work_dir(work_dir)
+    finally:
+        publisher.close()
+        profiler.write()
+        profiler.disable()
+    return volumes_csv
+
+
+def run_batch(jobs, output_root, processes=None, threads=None, profile=False,
+              qc_slices=1, storage="compressed", crop=False, preset=DEFAULT_PRESET,
+              cache_dir=None, template_store=None, cache_bytes=DEFAULT_MAX_BYTES,
+              atropos_iterations=DEFAULT_ITERATIONS,
+              atropos_convergence=DEFAULT_CONVERGENCE, preprocessing=DEFAULT_MODE):
+    """Run a batch of subjects in a process pool and aggregate the results.
+
+    Args:
+        jobs (list): Subject descriptions from ``read_jobs``.
+        output_root (str): Directory for the subjects and the aggregated results.
+        processes (int, optional): Number of subjects run at once. Defaults to one
+            subject per 4 threads of the budget.
+        threads (int, optional): Thread budget of the node, shared equally by the
+            subjects running at once. Defaults to the CPUs available.
+        profile (bool, optional): Write a resource trace for each subject. Defaults
+            to False.
+        qc_slices (int, optional): Number of QC slices per plane. Defaults to 1.
+        storage (str, optional): Storage policy of the intermediates. Defaults to
+            "compressed".
+        crop (bool, optional): Run the heavy steps on the brain bounding box.
+            Defaults to False.
+        preset (str, optional): Registration preset. Defaults to "standard".
+        cache_dir (str, optional): Transform cache directory.
+        template_store (str, optional): Template store, e.g. one shared by the
+            batches of a node. Defaults to ``<output_root>/templates``.
+        cache_bytes (int, optional): Size limit of the transform cache. Defaults
+            to 20 GiB.
+        atropos_iterations (int, optional): Maximum number of Atropos rounds.
+        atropos_convergence (float, optional): Posterior change the Atropos
+            rounds stop at.
+        preprocessing (str, optional): Preprocessing mode, see
+            ``utils.preprocess``. Defaults to "full".
+
+    Returns:
+        pandas.DataFrame: Status of each subject.
+    """
+    os.makedirs(output_root, exist_ok=True)
+    budget = thread_budget(threads)
+    processes = processes or max(1, budget // 4)
+    processes = max(1, min(processes, len(jobs)))
+    subject_threads = max(1, budget // processes)
+    log.info("Running %d subjects, %d at a time with %d thread(s) each",
+             len(jobs), processes, subject_threads)
+
+    # Validate the templates and write them to the store once, before the workers
+    # start, unless the template registry already holds their derived files. The
+    # subjects then only check that the files exist
+    template_store = template_store or os.path.join(output_root, "templates")
+    stack_dirs = {}
+    for age in sorted({job["age"] for job in jobs}):
+        bundle = load_bundle(os.path.join(TEMPLATES_DIR, age), age, store=template_store)
+        stack_dirs[age] = bundle.derived_dir
+
+    status = []
+    volumes = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {
+            pool.submit(run_subject, job, output_root, subject_threads, stack_dirs,
+                        profile, qc_slices, storage, crop, preset, cache_dir,
+                        template_store, cache_bytes, atropos_iterations,
+                        atropos_convergence, preprocessing): job
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                volumes_csv = future.result()
+            except Exception as exc:  # pylint: disable=broad-except
+                log.error("Subject %s failed: %s", job["job"], exc)
+                status.append({**job, "status": "failed", "error": str(exc)})
+            else:
+                log.info("Subject %s complete", job["job"])
+                status.append({**job, "status": "complete", "error": ""})
+                volumes.append(pd.read_csv(volumes_csv))
+
+    if volumes:
+        pd.concat(volumes, ignore_index=True).to_csv(
+            os.path.join(output_root, "batch_volumes.csv"), index=False)
+    status = pd.DataFrame(status)
+    status.to_csv(os.path.join(output_root, "batch_status.csv"), index=False)
+    return status
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", help="csv listing the inputs, or a directory of NIfTIs")
+    parser.add_argument("output_root", help="directory for the batch results")
+    parser.add_argument("--age", help="template age for inputs without one")
+    parser.add_argument("--jobs", type=int, help="subjects to run at once")
+    parser.add_argument("--threads", type=int, help="thread budget of the node")
+    parser.add_argument("--profile", action="store_true",
+                        help="write a resource trace for each subject")
+    parser.add_argument("--qc-slices", type=int, default=1,
+                        help="number of QC slices per plane")
+    parser.add_argument("--storage", choices=STORAGE_POLICIES, default="compressed",
+                        help="storage policy of the intermediates")
+    parser.add_argument("--crop", action="store_true",
+                        help="run the heavy steps on the brain box instead of the full grid")
+    parser.add_argument("--registration-preset", choices=REGISTRATION_PRESETS,
+                        default=DEFAULT_PRESET, help="registration speed preset")
+    parser.add_argument("--transform-cache", help="transform cache directory")
+    parser.add_argument("--transform-cache-size-gb", type=float,
+                        default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="size limit of the transform cache")
+    parser.add_argument("--template-store",
+                        help="template store (default: <output_root>/templates)")
+    parser.add_argument("--atropos-iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="maximum number of Atropos rounds")
+    parser.add_argument("--atropos-convergence", type=float, default=DEFAULT_CONVERGENCE,
+                        help="mean posterior change the Atropos rounds stop at")
+    parser.add_argument("--preprocessing", choices=PREPROCESSING_MODES, default=DEFAULT_MODE,
+                        help="preprocessing mode")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(processName)s %(name)s %(message)s")
+    run_batch(read_jobs(args.inputs, args.age), args.output_root, args.jobs, args.threads,
+              args.profile, args.qc_slices, args.storage, args.crop,
+              args.registration_preset, args.transform_cache, args.template_store,
+              args.transform_cache_size_gb * 1024 ** 3, max(1, args.atropos_iterations),
+              args.atropos_convergence, args.preprocessing)
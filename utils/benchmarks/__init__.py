@@ -0,0 +1 @@
+# Benchmarks of the pipeline stages, run as python3 -m utils.benchmarks.<name>
@@ -0,0 +1,155 @@
+"""Synthetic labelled head phantoms and templates for the offline benchmarks.
+
+A phantom is a padded ellipsoidal infant head on a grid of a given size: a skull
+shell around supratentorial csf, tissue and two ventricles, with T2w-like
+intensities (csf bright, skull dark) and noise. The matching template directory
+has the files ``utils.pipeline.build_steps`` expects: the template image and brain
+mask, the three tissue priors and the five region masks with the label values
+``utils.refine`` inserts.
+
+Example:
+    >>> make_phantom("bench/phantom_128.nii.gz", (128, 128, 96))
+    >>> make_template("bench/templates/12M", "12M", (128, 128, 96))
+"""
+
+import argparse
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils.refine import CALLOSUM_MASK, INSERTIONS, VENTRICLES_MASK
+from utils.transforms import PRIORS
+
+log = logging.getLogger(__name__)
+
+# Labels of the phantom, those of the first refinement atlas
+TISSUE, CSF, VENTRICLES, SKULL = 1, 2, 3, 4
+# T2w intensity of each label, background is 0
+INTENSITIES = {TISSUE: 400.0, CSF: 900.0, VENTRICLES: 1000.0, SKULL: 150.0}
+VOXEL_MM = 0.55
+
+
+def _ellipsoid(shape, centre, radii):
+    """Boolean ellipsoid on a grid, centre and radii as fractions of the grid."""
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    distance = sum(((g - c * n) / (r * n)) ** 2
+                   for g, n, c, r in zip(grid, shape, centre, radii))
+    return distance <= 1
+
+
+def phantom_labels(shape):
+    """Label a phantom head on a grid.
+
+    Args:
+        shape (tuple): Grid size.
+
+    Returns:
+        numpy.ndarray: uint8 labels, see ``TISSUE``, ``CSF``, ``VENTRICLES`` and
+            ``SKULL``.
+    """
+    centre = (0.5, 0.5, 0.5)
+    labels = np.zeros(shape, dtype=np.uint8)
+    labels[_ellipsoid(shape, centre, (0.40, 0.42, 0.38))] = SKULL
+    labels[_ellipsoid(shape, centre, (0.36, 0.38, 0.34))] = CSF
+    labels[_ellipsoid(shape, centre, (0.33, 0.35, 0.31))] = TISSUE
+    for side in (0.42, 0.58):
+        labels[_ellipsoid(shape, (side, 0.5, 0.55), (0.05, 0.15, 0.06))] = VENTRICLES
+    return labels
+
+
+def _affine(shape, voxel_mm):
+    """RAS affine of a grid centred on the origin."""
+    affine = np.diag([voxel_mm] * 3 + [1.0])
+    affine[:3, 3] = -voxel_mm * (np.asarray(shape) - 1) / 2
+    return affine
+
+
+def make_phantom(path, shape, voxel_mm=VOXEL_MM, noise=0.05, seed=0):
+    """Write a T2w-like phantom image.
+
+    Args:
+        path (str): Output NIfTI path.
+        shape (tuple): Grid size.
+        voxel_mm (float, optional): Isotropic voxel size. Defaults to 0.55 mm, that
+            of the templates.
+        noise (float, optional): Gaussian noise, relative to the csf intensity.
+        seed (int, optional): Seed of the noise.
+
+    Returns:
+        str: The ``path``.
+    """
+    labels = phantom_labels(shape)
+    image = np.zeros(shape, dtype=np.float32)
+    for label, intensity in INTENSITIES.items():
+        image[labels == label] = intensity
+    rng = np.random.default_rng(seed)
+    image += rng.normal(0, noise * INTENSITIES[CSF], shape).astype(np.float32)
+    np.clip(image, 0, None, out=image)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    nib.save(nib.Nifti1Image(image, _affine(shape, voxel_mm)), path)
+    return path
+
+
+def make_template(template_dir, age, shape, voxel_mm=VOXEL_MM):
+    """Write a template directory matching the phantoms.
+
+    Args:
+        template_dir (str): Output directory.
+        age (str): Template age, used in the template image name.
+        shape (tuple): Grid size of the template.
+        voxel_mm (float, optional): Isotropic voxel size.
+
+    Returns:
+        str: The ``template_dir``.
+    """
+    os.makedirs(template_dir, exist_ok=True)
+    affine = _affine(shape, voxel_mm)
+
+    def save(name, data):
+        nib.save(nib.Nifti1Image(data, affine), os.path.join(template_dir, name + ".nii.gz"))
+
+    labels = phantom_labels(shape)
+    image = np.zeros(shape, dtype=np.float32)
+    for label, intensity in INTENSITIES.items():
+        image[labels == label] = intensity
+    save(f"template_{age}_degibbs_padded", image)
+    save("brainMask", ((labels > 0) & (labels != SKULL)).astype(np.uint8))
+
+    # Tissue, csf (with the ventricles) and skull priors
+    for name, members in zip(PRIORS, ((TISSUE,), (CSF, VENTRICLES), (SKULL,))):
+        save(name, np.isin(labels, members).astype(np.float32))
+
+    # Region masks, valued so that the refinement inserts its labels
+    centre = (0.5, 0.5, 0.5)
+    ventricles = (labels == VENTRICLES).astype(np.float32)
+    grey = np.zeros(shape, dtype=np.float32)
+    for value, side in zip((16, 17, 18, 19), (0.38, 0.46, 0.54, 0.62)):
+        grey[_ellipsoid(shape, (side, 0.5, 0.45), (0.03, 0.04, 0.04))] = value
+    cerebellum = 30 * _ellipsoid(shape, (0.5, 0.3, 0.3), (0.15, 0.08, 0.08)).astype(np.float32)
+    brainstem = 40 * _ellipsoid(shape, (0.5, 0.4, 0.25), (0.04, 0.05, 0.1)).astype(np.float32)
+    callosum = np.zeros(shape, dtype=np.float32)
+    for value, front in zip(range(7, 12), np.linspace(0.35, 0.65, 5)):
+        callosum[_ellipsoid(shape, (0.5, front, 0.65), (0.02, 0.03, 0.02))] = value
+    callosum *= _ellipsoid(shape, centre, (0.33, 0.35, 0.31))
+
+    regions = dict(zip((name for name, _, _ in INSERTIONS), (grey, cerebellum, brainstem)))
+    regions.update({VENTRICLES_MASK: ventricles, CALLOSUM_MASK: callosum})
+    for name, data in regions.items():
+        save(name, data)
+    return template_dir
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="phantom image to write")
+    parser.add_argument("shape", type=int, nargs=3, help="grid size")
+    parser.add_argument("--template-dir", help="also write a template directory")
+    parser.add_argument("--age", default="12M", help="template age")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    make_phantom(args.output, tuple(args.shape))
+    if args.template_dir:
+        make_template(args.template_dir, args.age, tuple(args.shape))
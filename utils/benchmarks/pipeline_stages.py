@@ -0,0 +1,233 @@
+"""Offline benchmark of the pipeline stages on synthetic phantoms.
+
+Runs the whole gear flow (the pipeline, housekeeping and the segmentation QC) on
+phantom heads of several grid sizes (see ``utils.benchmarks.phantoms``), with the
+ANTs, FSL and SynthStrip executables replaced by the stubs of
+``utils.benchmarks.stub_tools``. No Flywheel, network or licensed tool is needed,
+so it runs on any Linux box with the Python dependencies of the gear.
+
+The resources of every stage are taken from the profiler (see ``utils.profiler``):
+wall time, CPU time, peak RSS and block I/O, the median over the repeats. They are
+written with the commit and platform to ``pipeline_stages.json``, and compared to a
+previous results file with ``--baseline``; ``--tolerance`` makes the run fail when a
+stage got slower by more than that factor.
+
+Example:
+    python3 -m utils.benchmarks.pipeline_stages /tmp/bench --sizes 96x96x80 160x160x128
+    python3 -m utils.benchmarks.pipeline_stages /tmp/bench-new \\
+        --baseline /tmp/bench/pipeline_stages.json --tolerance 1.25
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess as sp
+import time
+
+import pandas as pd
+
+from utils import profiler
+from utils.benchmarks.phantoms import make_phantom, make_template
+from utils.benchmarks.stub_tools import install_stub_tools
+from utils.join_data import housekeeping
+from utils.pipeline import qc_step, run_pipeline, run_step
+from utils.storage import STORAGE_POLICIES, intermediate_ext
+
+log = logging.getLogger(__name__)
+
+RESULTS_NAME = "pipeline_stages.json"
+DEFAULT_SIZES = ("96x96x80", "160x160x128")
+AGE = "12M"
+SUBJECT = "phantom"
+MEASURES = ("wall_s", "cpu_s", "max_rss_mb", "read_mb", "write_mb", "processes")
+
+
+def parse_size(size):
+    """Parse a grid size such as ``"96x96x80"``."""
+    shape = tuple(int(n) for n in size.lower().split("x"))
+    if len(shape) != 3:
+        raise ValueError(f"Expected a grid size such as 96x96x80, got {size!r}")
+    return shape
+
+
+def summarise_trace(events):
+    """Aggregate the events of a profiler trace by stage.
+
+    Args:
+        events (list): Chrome trace events from ``utils.profiler``.
+
+    Returns:
+        list: A dict of ``MEASURES`` per stage, in the order the stages started.
+    """
+    stages = {}
+    for event in sorted(events, key=lambda e: e["ts"]):
+        stages.setdefault(event["cat"], []).append(event)
+
+    rows = []
+    for stage, stage_events in stages.items():
+        start = min(e["ts"] for e in stage_events)
+        end = max(e["ts"] + e["dur"] for e in stage_events)
+        args = [e["args"] for e in stage_events]
+        rows.append({
+            "stage": stage,
+            "wall_s": round((end - start) / 1e6, 3),
+            "cpu_s": round(sum(a["user_cpu_s"] + a["sys_cpu_s"] for a in args), 3),
+            "max_rss_mb": max(a["max_rss_mb"] for a in args),
+            "read_mb": round(sum(a["read_bytes"] for a in args) / 1e6, 1),
+            "write_mb": round(sum(a["write_bytes"] for a in args) / 1e6, 1),
+            "processes": sum("command" in a for a in args),
+        })
+    return rows
+
+
+def run_phantom(input_path, template_dir, run_dir, threads=1, storage="compressed"):
+    """Run the gear flow on a phantom, profiled.
+
+    Args:
+        input_path (str): Phantom image.
+        template_dir (str): Phantom template directory.
+        run_dir (str): Directory for the work and output directories, emptied first.
+        threads (int, optional): Thread budget.
+        storage (str, optional): Storage policy of the intermediates.
+
+    Returns:
+        list: The stage summaries from ``summarise_trace``.
+    """
+    shutil.rmtree(run_dir, ignore_errors=True)
+    work_dir = os.path.join(run_dir, "work")
+    output_dir = os.path.join(run_dir, "output")
+    os.makedirs(output_dir)
+    ext = intermediate_ext(storage)
+    demographics = pd.DataFrame([{"subject": SUBJECT, "session": SUBJECT,
+                                  "acquisition": SUBJECT}])
+
+    tracer = profiler.enable(os.path.join(output_dir, profiler.TRACE_NAME))
+    try:
+        with profiler.span("total"):
+            run_pipeline(input_path, AGE, work_dir=work_dir, template_dir=template_dir,
+                         threads=threads, ext=ext)
+            with profiler.span("housekeeping"):
+                housekeeping(demographics, work_dir, output_dir, ext, threads)
+            run_step(qc_step(input_path, SUBJECT, work_dir, output_dir, threads=threads,
+                             acquisition=SUBJECT, ext=ext), work_dir, threads)
+        profiler.write()
+    finally:
+        profiler.disable()
+    return summarise_trace(tracer.events)
+
+
+def git_commit():
+    """Get the commit of the working tree, or None outside of a git checkout."""
+    try:
+        result = sp.run(["git", "rev-parse", "--short", "HEAD"], stdout=sp.PIPE,
+                        stderr=sp.DEVNULL, universal_newlines=True,
+                        cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run_suite(output_root, sizes=DEFAULT_SIZES, threads=1, storage="compressed",
+              repeats=1):
+    """Benchmark the gear flow on phantoms of several sizes.
+
+    Args:
+        output_root (str): Directory for the phantoms, stub tools and runs.
+        sizes (sequence, optional): Grid sizes such as ``"96x96x80"``.
+        threads (int, optional): Thread budget of each run.
+        storage (str, optional): Storage policy of the intermediates.
+        repeats (int, optional): Runs per size, the median is reported.
+
+    Returns:
+        dict: The results, as written to ``pipeline_stages.json``.
+    """
+    bin_dir = install_stub_tools(os.path.join(output_root, "bin"))
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+    rows = []
+    for size in sizes:
+        shape = parse_size(size)
+        grid = "x".join(map(str, shape))
+        input_path = make_phantom(os.path.join(output_root, "phantoms", f"{grid}.nii.gz"),
+                                  shape)
+        template_dir = make_template(os.path.join(output_root, "templates", grid, AGE),
+                                     AGE, shape)
+        runs = []
+        for repeat in range(repeats):
+            log.info("Running the %s phantom, repeat %d of %d", grid, repeat + 1, repeats)
+            runs.extend(run_phantom(input_path, template_dir,
+                                    os.path.join(output_root, "runs", grid),
+                                    threads, storage))
+        medians = pd.DataFrame(runs).groupby("stage", sort=False).median().round(3)
+        medians = medians.astype({"processes": int}).reset_index()
+        rows.extend({"grid": grid, **row} for row in medians.to_dict("records"))
+
+    results = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "threads": threads,
+        "storage": storage,
+        "repeats": repeats,
+        "results": rows,
+    }
+    with open(os.path.join(output_root, RESULTS_NAME), "w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+def compare(results, baseline):
+    """Compare benchmark results to a baseline.
+
+    Args:
+        results (dict): Results from ``run_suite``.
+        baseline (dict): Earlier results.
+
+    Returns:
+        pandas.DataFrame: Wall time, CPU time and peak RSS of both, with the
+            ratio of each, per grid and stage run in both.
+    """
+    columns = ["grid", "stage", "wall_s", "cpu_s", "max_rss_mb"]
+    new = pd.DataFrame(results["results"])[columns]
+    old = pd.DataFrame(baseline["results"])[columns]
+    merged = old.merge(new, on=["grid", "stage"], suffixes=("_base", ""))
+    for measure in columns[2:]:
+        merged[measure + "_ratio"] = (merged[measure] / merged[measure + "_base"]).round(2)
+    return merged
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output_root", help="directory for the benchmark files")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES,
+                        help="phantom grid sizes, e.g. 96x96x80")
+    parser.add_argument("--threads", type=int, default=1, help="thread budget")
+    parser.add_argument("--storage", choices=STORAGE_POLICIES, default="compressed",
+                        help="storage policy of the intermediates")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per size")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--tolerance", type=float,
+                        help="fail when a stage is slower than the baseline by this factor")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    results = run_suite(args.output_root, args.sizes, args.threads, args.storage,
+                        args.repeats)
+    report = pd.DataFrame(results["results"]).set_index(["grid", "stage"])
+    print(report.to_string())
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare(results, json.load(f))
+        print(comparison.to_string(index=False))
+        if args.tolerance:
+            # Ignore stages too short to time reliably
+            slower = comparison[(comparison["wall_s_ratio"] > args.tolerance)
+                                & (comparison["wall_s_base"] >= 0.5)]
+            if not slower.empty:
+                raise SystemExit("Slower than the baseline: "
+                                 + ", ".join(slower["grid"] + "/" + slower["stage"]))
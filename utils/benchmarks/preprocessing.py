@@ -0,0 +1,133 @@
+"""Benchmark the preprocessing modes: time saved against mask and segmentation overlap.
+
+Every mode is run on each subject of a reference set, from a fresh work directory
+and profiled (see ``utils.profiler``). The wall time of the preprocessing steps
+and of the whole pipeline are reported with the Dice overlap of the mode's brain
+mask and ``Final_segmentation_atlas`` with those of the ``full`` mode, per subject
+in ``preprocessing_modes.csv`` and averaged per mode on stdout, with the time
+saved relative to ``full``.
+
+The reference set is given as for batch mode (see ``utils.batch``): a csv listing
+the inputs, or a directory of NIfTI images with ``--age``. The settings of the
+``reduced`` mode can be tuned from the command line.
+
+Example:
+    python3 -m utils.benchmarks.preprocessing reference.csv /data/bench --threads 8
+    python3 -m utils.benchmarks.preprocessing reference.csv /data/bench \\
+        --n4-shrink-factor 2 --strip-factor 2
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import time
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from utils import profiler
+from utils.batch import read_jobs
+from utils.benchmarks.pipeline_stages import summarise_trace
+from utils.benchmarks.registration_presets import dice
+from utils.pipeline import run_pipeline
+from utils.preprocess import DEFAULT_MODE, PREPROCESSING_MODES
+from utils.refine import FINAL_ATLAS
+
+log = logging.getLogger(__name__)
+
+REPORT_NAME = "preprocessing_modes.csv"
+PREPROCESSING_STEPS = ("head_mask", "denoise", "n4", "synthstrip")
+BRAIN_MASK = "native_brain_mask.nii.gz"
+
+
+def run_benchmark(jobs, output_root, modes=None, threads=None):
+    """Run each mode on each subject and score it against the full mode.
+
+    Args:
+        jobs (list): Subject descriptions from ``utils.batch.read_jobs``.
+        output_root (str): Directory for the work directories and the report.
+        modes (dict, optional): Settings of each mode to run, by name. Defaults to
+            ``PREPROCESSING_MODES``; the full mode is always run as the reference.
+        threads (int, optional): Thread budget of each run.
+
+    Returns:
+        pandas.DataFrame: Run times and Dice overlaps of each subject and mode.
+    """
+    modes = dict(modes or PREPROCESSING_MODES)
+    modes = {DEFAULT_MODE: modes.pop(DEFAULT_MODE, PREPROCESSING_MODES[DEFAULT_MODE]),
+             **modes}
+
+    rows = []
+    for job in jobs:
+        reference = {}
+        for mode, settings in modes.items():
+            work_dir = os.path.join(output_root, mode, job["job"])
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.makedirs(work_dir)
+            log.info("Running %s with the %s preprocessing", job["job"], mode)
+            tracer = profiler.enable(os.path.join(work_dir, profiler.TRACE_NAME))
+            try:
+                start = time.time()
+                run_pipeline(job["input"], job["age"], work_dir=work_dir, threads=threads,
+                             preprocessing=settings)
+                wall = time.time() - start
+            finally:
+                profiler.disable()
+            stages = {s["stage"]: s["wall_s"] for s in summarise_trace(tracer.events)}
+
+            images = {}
+            for name in (BRAIN_MASK, FINAL_ATLAS):
+                data = np.asanyarray(nib.load(os.path.join(work_dir, name)).dataobj)
+                images[name] = (data > 0).astype(np.uint8) if name == BRAIN_MASK else data
+            if mode == DEFAULT_MODE:
+                reference = images
+            preprocessing_s = sum(stages.get(s, 0) for s in PREPROCESSING_STEPS)
+            rows.append({
+                "subject": job["job"],
+                "mode": mode,
+                "preprocessing_s": round(preprocessing_s, 1),
+                "wall_s": round(wall, 1),
+                "brain_mask_dice": round(dice(images[BRAIN_MASK], reference[BRAIN_MASK]), 4),
+                "segmentation_dice": round(dice(images[FINAL_ATLAS], reference[FINAL_ATLAS]),
+                                           4),
+            })
+
+    report = pd.DataFrame(rows)
+    report.to_csv(os.path.join(output_root, REPORT_NAME), index=False)
+    return report
+
+
+def summarise(report):
+    """Average the report per mode, with the time saved relative to the full mode."""
+    summary = report.groupby("mode", sort=False)[
+        ["preprocessing_s", "wall_s", "brain_mask_dice", "segmentation_dice"]].mean()
+    summary["saved_s"] = summary.loc[DEFAULT_MODE, "wall_s"] - summary["wall_s"]
+    return summary
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", help="csv listing the inputs, or a directory of NIfTIs")
+    parser.add_argument("output_root", help="directory for the benchmark runs")
+    parser.add_argument("--age", help="template age for inputs without one")
+    parser.add_argument("--threads", type=int, help="thread budget of each run")
+    reduced = PREPROCESSING_MODES["reduced"]
+    parser.add_argument("--n4-shrink-factor", type=int, default=reduced["n4_shrink_factor"],
+                        help="N4 shrink factor of the reduced mode")
+    parser.add_argument("--n4-convergence", default=reduced["n4_convergence"],
+                        help="N4 convergence of the reduced mode")
+    parser.add_argument("--strip-factor", type=int, default=reduced["strip_factor"],
+                        help="SynthStrip downsampling factor of the reduced mode")
+    parser.add_argument("--no-head-mask", dest="head_mask", action="store_false",
+                        help="denoise the whole field of view in the reduced mode")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    modes = {"reduced": {"head_mask": args.head_mask,
+                         "n4_shrink_factor": args.n4_shrink_factor,
+                         "n4_convergence": args.n4_convergence,
+                         "strip_factor": args.strip_factor}}
+    report = run_benchmark(read_jobs(args.inputs, args.age), args.output_root, modes,
+                           args.threads)
+    print(summarise(report).to_string(float_format="%.3f"))
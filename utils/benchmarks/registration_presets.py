@@ -0,0 +1,113 @@
+"""Benchmark the registration presets: run time against segmentation overlap.
+
+Every preset is run on each subject of a reference set, from a fresh work
+directory. The run time of the pipeline is reported with the Dice overlap of the
+preset's ``Final_segmentation_atlas`` with that of the ``standard`` preset, per
+subject in ``registration_presets.csv`` and averaged per preset on stdout.
+
+The reference set is given as for batch mode (see ``utils.batch``): a csv listing
+the inputs, or a directory of NIfTI images with ``--age``.
+
+Example:
+    python3 -m utils.benchmarks.registration_presets reference.csv /data/bench \\
+        --threads 8
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import time
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from utils.batch import read_jobs
+from utils.pipeline import run_pipeline
+from utils.refine import FINAL_ATLAS
+from utils.registration import DEFAULT_PRESET, REGISTRATION_PRESETS
+
+log = logging.getLogger(__name__)
+
+REPORT_NAME = "registration_presets.csv"
+
+
+def dice(atlas, reference):
+    """Mean Dice overlap of the labels of two atlases.
+
+    Args:
+        atlas (numpy.ndarray): Atlas to score.
+        reference (numpy.ndarray): Reference atlas, on the same grid.
+
+    Returns:
+        float: Dice coefficient averaged over the non-zero labels of either atlas.
+    """
+    atlas = np.rint(atlas).astype(np.int32)
+    reference = np.rint(reference).astype(np.int32)
+    scores = []
+    for label in np.union1d(np.unique(atlas), np.unique(reference)):
+        if label == 0:
+            continue
+        a = atlas == label
+        b = reference == label
+        scores.append(2 * np.count_nonzero(a & b) / (np.count_nonzero(a) + np.count_nonzero(b)))
+    return float(np.mean(scores)) if scores else 1.0
+
+
+def run_benchmark(jobs, output_root, presets=None, threads=None):
+    """Run each preset on each subject and score it against the standard preset.
+
+    Args:
+        jobs (list): Subject descriptions from ``utils.batch.read_jobs``.
+        output_root (str): Directory for the work directories and the report.
+        presets (list, optional): Presets to run. Defaults to all of them; the
+            standard preset is always run as the reference.
+        threads (int, optional): Thread budget of each run.
+
+    Returns:
+        pandas.DataFrame: Run time and Dice overlap of each subject and preset.
+    """
+    presets = list(presets or REGISTRATION_PRESETS)
+    if DEFAULT_PRESET not in presets:
+        presets.insert(0, DEFAULT_PRESET)
+    else:
+        presets.sort(key=lambda p: p != DEFAULT_PRESET)
+
+    rows = []
+    for job in jobs:
+        reference = None
+        for preset in presets:
+            work_dir = os.path.join(output_root, preset, job["job"])
+            shutil.rmtree(work_dir, ignore_errors=True)
+            log.info("Running %s with the %s preset", job["job"], preset)
+            start = time.time()
+            run_pipeline(job["input"], job["age"], work_dir=work_dir, threads=threads,
+                         preset=preset)
+            wall = time.time() - start
+
+            atlas = np.asanyarray(nib.load(os.path.join(work_dir, FINAL_ATLAS)).dataobj)
+            if preset == DEFAULT_PRESET:
+                reference = atlas
+            rows.append({"subject": job["job"], "preset": preset,
+                         "wall_s": round(wall, 1), "dice": round(dice(atlas, reference), 4)})
+
+    report = pd.DataFrame(rows)
+    report.to_csv(os.path.join(output_root, REPORT_NAME), index=False)
+    return report
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", help="csv listing the inputs, or a directory of NIfTIs")
+    parser.add_argument("output_root", help="directory for the benchmark runs")
+    parser.add_argument("--age", help="template age for inputs without one")
+    parser.add_argument("--presets", nargs="+", choices=REGISTRATION_PRESETS,
+                        help="presets to compare (default: all)")
+    parser.add_argument("--threads", type=int, help="thread budget of each run")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    report = run_benchmark(read_jobs(args.inputs, args.age), args.output_root,
+                           args.presets, args.threads)
+    summary = report.groupby("preset", sort=False)[["wall_s", "dice"]].mean()
+    print(summary.to_string(float_format="%.3f"))
@@ -0,0 +1,102 @@
+"""Benchmark the gear startup: importing ``run.py`` and parsing the config.
+
+Each repeat starts a fresh interpreter that imports ``run`` and runs
+``parse_config`` on an offline gear directory (see ``utils.context``), the work
+done before the first pipeline step. The median time of the interpreter start, the
+import and ``parse_config`` are reported, with the heavy modules loaded by then,
+which should be none but those the demographics lookup needs, and the time until
+the demographics, pulled in the background, are available.
+
+Example:
+    python3 -m utils.benchmarks.startup --repeats 20 --output startup.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+from utils.context import write_gear_dir
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HEAVY_MODULES = ("numpy", "nibabel", "pandas", "matplotlib", "PIL", "flywheel",
+                 "flywheel_gear_toolkit")
+
+# Run in the fresh interpreter, timing from its first statement
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import run
+imported = time.perf_counter()
+heavy = json.loads(sys.argv[2])
+at_import = [m for m in heavy if m in sys.modules]
+from utils.context import OfflineContext
+from utils.parser import parse_config
+_, _, demographics, _ = parse_config(OfflineContext(sys.argv[1]))
+parsed = time.perf_counter()
+demographics.result()
+pulled = time.perf_counter()
+print(json.dumps({"import_s": imported - start, "parse_config_s": parsed - imported,
+                  "demographics_s": pulled - imported,
+                  "loaded_at_import": at_import,
+                  "loaded_at_demographics": [m for m in heavy if m in sys.modules]}))
+"""
+
+
+def probe(gear_dir):
+    """Time the startup in a fresh interpreter.
+
+    Args:
+        gear_dir (str): Offline gear directory.
+
+    Returns:
+        dict: Wall time of the whole process, of importing ``run``, of
+            ``parse_config`` and until the demographics are pulled, and the heavy
+            modules loaded after the import and once the demographics are in.
+    """
+    start = time.perf_counter()
+    result = sp.run([sys.executable, "-c", _PROBE, gear_dir, json.dumps(HEAVY_MODULES)],
+                    cwd=REPO_ROOT, check=True, stdout=sp.PIPE, stderr=sp.DEVNULL,
+                    universal_newlines=True)
+    total = time.perf_counter() - start
+    return dict(json.loads(result.stdout.strip().splitlines()[-1]), total_s=total)
+
+
+def run_benchmark(repeats=10, gear_dir=None):
+    """Time the startup over several repeats.
+
+    Args:
+        repeats (int, optional): Number of fresh interpreters started.
+        gear_dir (str, optional): Offline gear directory. Defaults to a temporary
+            one, with a placeholder input.
+
+    Returns:
+        dict: Median times in seconds and the heavy modules loaded.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if gear_dir is None:
+            gear_dir = write_gear_dir(tmp_dir, os.path.join(tmp_dir, "T2w.nii.gz"),
+                                      {"age": "12M"})
+        probes = [probe(gear_dir) for _ in range(repeats)]
+    results = {key: round(statistics.median(p[key] for p in probes), 4)
+               for key in ("total_s", "import_s", "parse_config_s", "demographics_s")}
+    results.update(repeats=repeats, loaded_at_import=probes[0]["loaded_at_import"],
+                   loaded_at_demographics=probes[0]["loaded_at_demographics"])
+    return results
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=10, help="interpreters started")
+    parser.add_argument("--gear-dir", help="offline gear directory to parse")
+    parser.add_argument("--output", help="json file for the results")
+    args = parser.parse_args()
+    results = run_benchmark(args.repeats, args.gear_dir)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
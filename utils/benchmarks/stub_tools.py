@@ -0,0 +1,237 @@
+"""Stand-ins for the ANTs, FSL and FreeSurfer executables, for offline benchmarks.
+
+Each stub accepts the command line the pipeline builds, reads its inputs in full
+and writes outputs of the real tool's grid, data type and count (for instance the
+5D float32 warp fields of ``antsRegistration``), so that the orchestration, the
+checkpointing and the file I/O of the pipeline are exercised as in production. The
+image processing itself is reduced to a few NumPy operations, so timings measure
+the pipeline rather than the tools. ``--version`` reports ``<tool> stub``.
+
+``install_stub_tools`` writes an executable per tool that dispatches to this
+module on its name; put the directory first on ``PATH``.
+
+Example:
+    >>> bin_dir = install_stub_tools("bench/bin")
+    >>> os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+"""
+
+import argparse
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+
+TOOLS = (
+    "DenoiseImage",
+    "N4BiasFieldCorrection",
+    "mri_synthstrip",
+    "fslmaths",
+    "antsRegistration",
+    "antsApplyTransforms",
+    "Atropos",
+)
+
+_DTYPES = {"char": np.int8, "uchar": np.uint8, "short": np.int16, "int": np.int32,
+           "float": np.float32, "double": np.float64}
+
+
+def _option(args, flag, default=None):
+    """Get the value following ``flag`` in a command line."""
+    return args[args.index(flag) + 1] if flag in args else default
+
+
+def _bracketed(value):
+    """Split an ANTs ``[a,b,...]`` argument."""
+    return value.strip("[]").split(",")
+
+
+def _save(data, reference, path, dtype=None):
+    """Save an array on the grid of a reference image."""
+    img = nib.Nifti1Image(data, reference.affine)
+    img.set_data_dtype(dtype or data.dtype)
+    nib.save(img, path)
+
+
+def _resample(data, shape):
+    """Nearest neighbour resampling of the first three axes to a grid size."""
+    index = np.ix_(*(np.minimum((np.arange(n) * data.shape[i]) // n, data.shape[i] - 1)
+                     for i, n in enumerate(shape)))
+    return data[index]
+
+
+def _dilate(mask):
+    """Dilate a binary mask by one voxel with a 3x3x3 kernel."""
+    padded = np.pad(mask, 1)
+    dilated = np.zeros_like(mask)
+    for offset in np.ndindex(3, 3, 3):
+        dilated |= padded[tuple(slice(o, o + n) for o, n in zip(offset, mask.shape))]
+    return dilated
+
+
+def denoise(args):
+    """DenoiseImage: rewrite the image as float32."""
+    img = nib.load(_option(args, "-i"))
+    _save(img.get_fdata(dtype=np.float32), img, _option(args, "-o"))
+
+
+def n4(args):
+    """N4BiasFieldCorrection: rewrite the image, and a flat bias field if asked."""
+    img = nib.load(_option(args, "-i"))
+    data = img.get_fdata(dtype=np.float32)
+    output = _bracketed(_option(args, "-o"))
+    _save(data, img, output[0])
+    if len(output) > 1:
+        _save(np.ones_like(data), img, output[1])
+
+
+def synthstrip(args):
+    """mri_synthstrip: threshold out the background and skull."""
+    img = nib.load(_option(args, "-i"))
+    data = img.get_fdata(dtype=np.float32)
+    foreground = data[data > 0]
+    threshold = 0.25 * np.percentile(foreground, 90) if foreground.size else 0
+    mask = data > threshold
+    if "-o" in args:
+        _save(data * mask, img, _option(args, "-o"), np.float32)
+    if "-m" in args:
+        _save(mask.astype(np.uint8), img, _option(args, "-m"))
+
+
+def fslmaths(args):
+    """fslmaths: the ``-dilM`` mask dilation, other operations copy the image."""
+    img = nib.load(args[0])
+    data = np.asanyarray(img.dataobj)
+    if "-dilM" in args:
+        mask = data > 0
+        for _ in range(args.count("-dilM")):
+            mask = _dilate(mask)
+        data = mask.astype(data.dtype)
+    output = args[-1]
+    compressed = os.environ.get("FSLOUTPUTTYPE", "NIFTI_GZ") == "NIFTI_GZ"
+    if not output.endswith((".nii", ".nii.gz")):
+        output += ".nii.gz" if compressed else ".nii"
+    _save(data, img, output)
+
+
+def ants_registration(args):
+    """antsRegistration: identity transforms on the fixed image grid."""
+    prefix, warped = _bracketed(_option(args, "--output"))
+    fixed_path, moving_path = _bracketed(_option(args, "--initial-moving-transform"))[:2]
+    fixed = nib.load(fixed_path)
+    moving = nib.load(moving_path).get_fdata(dtype=np.float32)
+    for mask in _bracketed(_option(args, "--masks", "[]")):
+        if mask:
+            np.asanyarray(nib.load(mask).dataobj)
+
+    with open(prefix + "0GenericAffine.mat", "wb") as f:
+        f.write(np.eye(4, dtype=np.float64)[:3].tobytes())
+    field = np.zeros(fixed.shape[:3] + (1, 3), dtype=np.float32)
+    for name in ("1Warp.nii.gz", "1InverseWarp.nii.gz"):
+        img = nib.Nifti1Image(field, fixed.affine)
+        img.header.set_intent("vector")
+        nib.save(img, prefix + name)
+    _save(_resample(moving, fixed.shape[:3]), fixed, warped)
+
+
+def ants_apply_transforms(args):
+    """antsApplyTransforms: nearest neighbour resampling, or a zero composite field."""
+    reference = nib.load(_option(args, "-r"))
+    for transform in (a for i, a in enumerate(args) if i and args[i - 1] == "-t"):
+        path = _bracketed(transform)[0]
+        if path.endswith((".nii", ".nii.gz")):
+            np.asanyarray(nib.load(path).dataobj)
+
+    output = _option(args, "-o")
+    if output.startswith("["):
+        # Composite displacement field
+        field = np.zeros(reference.shape[:3] + (1, 3), dtype=np.float32)
+        img = nib.Nifti1Image(field, reference.affine)
+        img.header.set_intent("vector")
+        nib.save(img, _bracketed(output)[0])
+        return
+
+    data = np.asanyarray(nib.load(_option(args, "-i")).dataobj)
+    dtype = _DTYPES.get(_option(args, "-u"), np.float32)
+    _save(_resample(data, reference.shape[:3]).astype(dtype), reference, output)
+
+
+def atropos(args):
+    """Atropos: intensity and prior weighted posteriors, and the segmentation."""
+    img = nib.load(_option(args, "-a"))
+    data = img.get_fdata(dtype=np.float32)
+    mask = np.asanyarray(nib.load(_option(args, "-x")).dataobj) > 0
+    # -i PriorProbabilityImages[classes,pattern,weight]
+    classes, prior_pattern = _bracketed(_option(args, "-i").partition("[")[2])[:2]
+    priors = [nib.load(prior_pattern % (i + 1)).get_fdata(dtype=np.float32)
+              for i in range(int(classes))]
+
+    # Class means at intensity quantiles: tissue, csf then skull, as the priors
+    quantiles = np.quantile(data[mask], [0.5, 0.9, 0.05]) if mask.any() else np.zeros(3)
+    scale = max(float(np.std(data[mask])) if mask.any() else 1.0, 1e-6)
+    likelihood = [np.exp(-0.5 * ((data - mean) / scale) ** 2) for mean in quantiles]
+    posteriors = [(lk * (0.5 + prior)).astype(np.float32)
+                  for lk, prior in zip(likelihood, priors)]
+    total = np.maximum(sum(posteriors), 1e-6)
+
+    segmentation, posterior_pattern = _bracketed(_option(args, "-o"))
+    for i, posterior in enumerate(posteriors):
+        _save(posterior / total * mask, img, posterior_pattern % (i + 1))
+    _save(((np.argmax(posteriors, axis=0) + 1) * mask).astype(np.uint8), img, segmentation)
+
+
+_STUBS = {
+    "DenoiseImage": denoise,
+    "N4BiasFieldCorrection": n4,
+    "mri_synthstrip": synthstrip,
+    "fslmaths": fslmaths,
+    "antsRegistration": ants_registration,
+    "antsApplyTransforms": ants_apply_transforms,
+    "Atropos": atropos,
+}
+
+
+def main(argv=None):
+    """Run the stub named by the executable, ``argv[0]``."""
+    argv = list(sys.argv if argv is None else argv)
+    tool = os.path.basename(argv[0])
+    if tool not in _STUBS:
+        raise SystemExit(f"No stub for {tool}")
+    if "--version" in argv[1:]:
+        print(f"{tool} stub")
+        return 0
+    _STUBS[tool](argv[1:])
+    return 0
+
+
+def install_stub_tools(bin_dir):
+    """Write an executable for every stub tool.
+
+    Args:
+        bin_dir (str): Directory for the executables, created if needed.
+
+    Returns:
+        str: The ``bin_dir``.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    repo_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    script = (
+        f"#!{sys.executable}\n"
+        "import sys\n"
+        f"sys.path.insert(0, {repo_root!r})\n"
+        "from utils.benchmarks.stub_tools import main\n"
+        "sys.exit(main())\n"
+    )
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    return bin_dir
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("bin_dir", help="directory for the stub executables")
+    args = parser.parse_args()
+    print(install_stub_tools(args.bin_dir))
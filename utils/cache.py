@@ -0,0 +1,157 @@
+"""Persistent cache of the registration outputs.
+
+Reprocessing a session after a change downstream of the registration (label
+definitions, Atropos weights, a failed QC) used to redo the denoising, bias
+correction, brain extraction and SyN registration, although none of their outputs
+change. The cache keeps the bias corrected image, which Atropos segments, the brain
+extracted image and mask and the registration transforms, keyed by the content hash
+of the input, the template and the exact commands of those steps, in a directory
+that outlives the work directory. On a hit the files are restored and the pipeline
+starts at the prior warps (Step 2).
+
+The cache is bounded in size: once it grows past its limit, the least recently
+used entries are evicted.
+
+Example:
+    >>> cache = TransformCache("/data/minimorph-cache", max_bytes=20e9)
+    >>> if not cache.restore(key, files):
+    ...     run_registration()
+    ...     cache.store(key, files)
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+log = logging.getLogger(__name__)
+
+ENTRY_NAME = "entry.json"
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+
+def cache_key(fields):
+    """Hash the fields identifying a cache entry.
+
+    Args:
+        fields (dict): JSON serialisable description of the entry, such as input
+            hashes, parameters and tool versions.
+
+    Returns:
+        str: The key.
+    """
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+class TransformCache:
+    """A size-bounded directory of cached registration outputs.
+
+    Each entry is a directory named by its key, holding the cached files and an
+    ``entry.json`` manifest whose modification time records the last use.
+
+    Args:
+        directory (str): Cache directory, created if needed.
+        max_bytes (int, optional): Size above which the least recently used
+            entries are evicted. Defaults to 20 GiB.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def restore(self, key, files):
+        """Copy the files of an entry to their places, if the entry exists.
+
+        Args:
+            key (str): Entry key.
+            files (list): Paths to restore, matched to the cached files by name.
+
+        Returns:
+            bool: True on a cache hit.
+        """
+        entry = self._entry(key)
+        manifest = os.path.join(entry, ENTRY_NAME)
+        names = [os.path.basename(f) for f in files]
+        if not os.path.exists(manifest) or not all(
+            os.path.exists(os.path.join(entry, n)) for n in names
+        ):
+            log.info("Transform cache miss for %s", key[:12])
+            return False
+
+        try:
+            for name, path in zip(names, files):
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                shutil.copy2(os.path.join(entry, name), path)
+            os.utime(manifest)
+        except FileNotFoundError:
+            # Evicted by a concurrent run while being restored
+            log.info("Transform cache miss for %s, evicted while restoring", key[:12])
+            return False
+        log.info("Transform cache hit for %s, restored %d files", key[:12], len(files))
+        return True
+
+    def store(self, key, files, fields=None):
+        """Add the files to the cache under a key, then evict old entries.
+
+        The entry is written to a temporary directory and renamed into place, so
+        concurrent runs never see a partial entry.
+
+        Args:
+            key (str): Entry key.
+            files (list): Paths of the files to cache.
+            fields (dict, optional): Description of the entry, kept in its manifest.
+        """
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        tmp_entry = f"{entry}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        for path in files:
+            shutil.copy2(path, os.path.join(tmp_entry, os.path.basename(path)))
+        with open(os.path.join(tmp_entry, ENTRY_NAME), "w") as f:
+            json.dump({"created": time.time(), "fields": fields or {},
+                       "files": [os.path.basename(p) for p in files]}, f, indent=2)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Stored by a concurrent run in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        log.info("Stored %d files in the transform cache as %s", len(files), key[:12])
+        self.evict(keep=key)
+
+    def entries(self):
+        """Get the complete entries as (last use, size in bytes, key), oldest first."""
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            manifest = os.path.join(entry, ENTRY_NAME)
+            if not os.path.exists(manifest):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, n)) for n in os.listdir(entry))
+            entries.append((os.path.getmtime(manifest), size, key))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """Evict the least recently used entries until the cache fits its limit.
+
+        Args:
+            keep (str, optional): Key never evicted, the entry just stored.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+            log.info("Evicted %s from the transform cache", key[:12])
@@ -0,0 +1,168 @@
+"""Content-hash checkpoints for pipeline stages.
+
+Each stage records a manifest of its input hashes, parameters, tool versions and
+output hashes once it completes. On a rerun a stage whose manifest still matches is
+skipped, so a retry after a late failure resumes at the first stale stage instead
+of the start of the pipeline.
+
+Example:
+    >>> checkpoint = Checkpoint("n4", inputs=[dn], outputs=[dn_bc],
+    ...                         params={"command": command}, tools=["N4BiasFieldCorrection"])
+    >>> exec_command(command, checkpoint=checkpoint)
+"""
+
+import hashlib
+import importlib
+import json
+import logging
+import os
+import shutil
+import subprocess as sp
+from functools import lru_cache
+
+log = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = ".checkpoint.json"
+_CHUNK_SIZE = 1 << 20
+
+# Hashes already computed in this process, keyed by (path, size, mtime)
+_hash_cache = {}
+
+
+def file_hash(path, refresh=False):
+    """Get the sha256 of a file's content, computed once per file version.
+
+    With ``refresh`` the content is hashed again, even when a hash of this
+    version is already known, e.g. one recorded from an index.
+    """
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if refresh or key not in _hash_cache:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                sha.update(chunk)
+        _hash_cache[key] = sha.hexdigest()
+    return _hash_cache[key]
+
+
+def record_hash(path, digest, stat=None):
+    """Record the sha256 of a file's current version, e.g. from a template index.
+
+    Args:
+        path (str): The file.
+        digest (str): Its sha256, hex encoded.
+        stat (os.stat_result, optional): The file's stat, if already taken.
+    """
+    stat = stat or os.stat(path)
+    _hash_cache[(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)] = digest
+
+
+@lru_cache(maxsize=None)
+def tool_version(tool):
+    """Get a version string for an executable or a Python module.
+
+    Executables are asked for ``--version``; when that is not supported the content
+    hash of the executable is used instead. Python modules report ``__version__``,
+    or the hash of their source file.
+    """
+    executable = shutil.which(tool)
+    if executable:
+        try:
+            result = sp.run(
+                [executable, "--version"],
+                stdout=sp.PIPE,
+                stderr=sp.STDOUT,
+                universal_newlines=True,
+                timeout=30,
+            )
+            if result.returncode == 0 and result.stdout.strip():
+                return result.stdout.strip()
+        except (OSError, sp.SubprocessError):
+            pass
+        return "sha256:" + file_hash(executable)
+
+    try:
+        module = importlib.import_module(tool)
+    except ImportError:
+        return "missing"
+    version = getattr(module, "__version__", None)
+    if version:
+        return str(version)
+    return "sha256:" + file_hash(module.__file__)
+
+
+class Checkpoint:
+    """Manifest of a completed pipeline stage.
+
+    Args:
+        stage (str): Name of the stage, also names the manifest file.
+        inputs (list): Paths of the files the stage reads.
+        outputs (list): Paths of the files the stage writes.
+        params (dict, optional): JSON serialisable parameters of the stage.
+        tools (list, optional): Executables or Python modules whose versions the
+            outputs depend on.
+        directory (str, optional): Where to keep the manifest. Defaults to the
+            directory of the first output.
+    """
+
+    def __init__(self, stage, inputs=(), outputs=(), params=None, tools=(), directory=None):
+        self.stage = stage
+        self.inputs = [str(p) for p in inputs]
+        self.outputs = [str(p) for p in outputs]
+        self.params = params or {}
+        self.tools = list(tools)
+        directory = directory or os.path.dirname(self.outputs[0])
+        self.path = os.path.join(directory, stage + MANIFEST_SUFFIX)
+
+    def _describe(self):
+        return {
+            "stage": self.stage,
+            "inputs": {p: file_hash(p) for p in self.inputs},
+            "params": json.loads(json.dumps(self.params, default=str)),
+            "tools": {t: tool_version(t) for t in self.tools},
+        }
+
+    def is_fresh(self):
+        """Check whether the recorded manifest still matches the stage.
+
+        Returns:
+            bool: True if the inputs, parameters and tool versions are unchanged and
+                every output is still in place with its recorded content.
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            manifest = json.load(f)
+
+        missing = [p for p in self.inputs + self.outputs if not os.path.exists(p)]
+        if missing:
+            log.info("Checkpoint %s is stale, missing %s", self.stage, ", ".join(missing))
+            return False
+
+        current = self._describe()
+        for key in ("inputs", "params", "tools"):
+            if manifest.get(key) != current[key]:
+                log.info("Checkpoint %s is stale, %s changed", self.stage, key)
+                return False
+
+        outputs = {p: file_hash(p) for p in self.outputs}
+        if manifest.get("outputs") != outputs:
+            log.info("Checkpoint %s is stale, outputs changed", self.stage)
+            return False
+        return True
+
+    def save(self):
+        """Record the manifest for the outputs now in place."""
+        manifest = self._describe()
+        manifest["outputs"] = {p: file_hash(p) for p in self.outputs}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.path)
+        log.info("Checkpoint %s saved to %s", self.stage, self.path)
+
+    def invalidate(self):
+        """Remove the recorded manifest."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
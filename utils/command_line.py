@@ -33,10 +33,20 @@ built from gear configuration options.
 """
 
 import logging
+import os
 import subprocess as sp
+import threading
+import time
+from collections import deque
+
+from utils import profiler
 
 log = logging.getLogger(__name__)
 
+# Number of trailing stderr lines kept, when it is logged as it arrives, for the
+# error message of a failed command
+STDERR_TAIL_LINES = 200
+
 
 def _remove_prohibited_values(param_list):
     """
@@ -109,6 +119,61 @@ def build_command_list(command, param_list, include_keys=True):
     return command
 
 
+def _pump(process, echo, tail_lines=STDERR_TAIL_LINES):
+    """Drain stdout and stderr of a process concurrently until both are closed.
+
+    stderr is read in a separate thread, so a tool writing a lot to stderr never
+    blocks on a full pipe while stdout is read. When the lines are echoed only the
+    last ``tail_lines`` lines of stderr are kept, as the rest is in the log;
+    otherwise all of it is. The process is not waited on, so that it can be
+    reaped with its resource usage by ``_reap``.
+
+    Args:
+        process (subprocess.Popen): Process with text stdout and stderr pipes.
+        echo (bool): Log each line as it arrives instead of keeping stdout.
+        tail_lines (int, optional): Number of stderr lines kept when echoing.
+
+    Returns:
+        tuple: stdout (empty when echoed) and stderr (its tail when echoed).
+    """
+    name = os.path.basename(process.args[0]) if isinstance(process.args, list) else "sh"
+    stdout = []
+    stderr = deque(maxlen=tail_lines if echo else None)
+
+    def drain_stderr():
+        for line in process.stderr:
+            stderr.append(line)
+            if echo:
+                log.info("%s [stderr] %s", name, line.rstrip())
+
+    reader = threading.Thread(target=drain_stderr, daemon=True)
+    reader.start()
+    for line in process.stdout:
+        if echo:
+            log.info("%s %s", name, line.rstrip())
+        else:
+            stdout.append(line)
+    reader.join()
+    process.stdout.close()
+    process.stderr.close()
+    return "".join(stdout), "".join(stderr)
+
+
+def _reap(process):
+    """Wait for a process to exit.
+
+    Returns:
+        tuple: The exit code, and the ``resource.struct_rusage`` of the process (or
+            None if it had already been waited on).
+    """
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait(), None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+
 def exec_command(
     command,
     dry_run=False,
@@ -116,6 +181,8 @@ def exec_command(
     shell=False,
     stdout_msg=None,
     cont_output=False,
+    checkpoint=None,
+    stage=None,
 ):
     """
     An abstraction to execute prepared shell commands using the subprocess module.
@@ -133,10 +200,19 @@ def exec_command(
         stdout_msg (string, optional): A string to notify the user where the
             stdout/stderr has been redirected to. Defaults to None.
         cont_output (bool, optional): Used to provide continuous output of
-            stdout without waiting until the completion of the shell command.
-            Defaults to False.
+            stdout and stderr, logged line by line without waiting until the
+            completion of the shell command. Defaults to False.
+        checkpoint (utils.checkpoint.Checkpoint, optional): Manifest of the stage
+            the command belongs to. The command is skipped if the manifest is up to
+            date, and the manifest is saved once the command succeeds. Defaults to
+            None.
+        stage (str, optional): Pipeline stage the command is recorded under when
+            profiling is enabled (see ``utils.profiler``). Defaults to the stage of
+            the enclosing profiler span.
     Returns:
-        stdout, stderr, returncode
+        stdout, stderr, returncode: with continuous output stdout is empty and
+        stderr holds its last ``STDERR_TAIL_LINES`` lines, both having been logged
+        as they arrived; otherwise both are complete.
     Raises:
         RuntimeError: If the return value from the command-line function is not zero.
 
@@ -148,11 +224,20 @@ def exec_command(
             >>> command = build_command_list(command, params, include_keys=False)
             >>> exec_command(command)
     """
+    if checkpoint is not None and checkpoint.is_fresh():
+        log.info(
+            "Checkpoint %s is up to date, skipping command: \n %s \n\n",
+            checkpoint.stage,
+            " ".join(command),
+        )
+        return "", "", 0
+
     log.info("Executing command: \n %s \n\n", " ".join(command))
     if not dry_run:
         # The "shell" parameter is needed for bash output redirects
         # (e.g. >,>>,&>)
 
+        start = time.time()
         result = sp.Popen(
             command,
             stdout=sp.PIPE,
@@ -167,27 +252,25 @@ def exec_command(
             log.info(stdout_msg)
 
         # if continuous stdout is desired... and we are not redirecting output
-        if cont_output and not (shell and (">" in command)) and (stdout_msg is None):
-            while True:
-                stdout = result.stdout.readline()
-                if stdout == "" and result.poll() is not None:
-                    break
-                if stdout:
-                    print(stdout.rstrip())
-
-            returncode = result.poll()
-            stderr = "".join(result.stderr.readlines())
-        else:
-            stdout, stderr = result.communicate()
+        echo = cont_output and not (shell and (">" in command)) and (stdout_msg is None)
+        stdout, stderr = _pump(result, echo)
+        if not echo and stdout_msg is None:
+            log.info(stdout)
 
-            returncode = result.returncode
-            if stdout_msg is None:
-                log.info(stdout)
+        # Reap the child ourselves to get its resource usage
+        returncode, usage = _reap(result)
+        if usage is not None:
+            profiler.record_process(command, stage, start, time.time(), usage, returncode)
 
         log.info("Command return code: %s", returncode)
 
         if returncode != 0:
             log.error(stderr)
-            raise RuntimeError("The following command has failed: \n{}".format(command))
+            raise RuntimeError(
+                "The following command has failed: \n{}\n{}".format(command, stderr)
+            )
+
+        if checkpoint is not None:
+            checkpoint.save()
 
         return stdout, stderr, returncode
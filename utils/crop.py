@@ -0,0 +1,148 @@
+"""Cropping to the brain bounding box, and pasting results back to the native grid.
+
+The inputs are padded infant heads, so most of the native grid is background.
+The registration, the prior and mask warps and Atropos run on the bounding box of
+the dilated brain mask plus a margin, and the final segmentation atlases are
+pasted back into the native grid. The cropped images keep their world coordinates
+(the affine is shifted to the box origin), so transforms computed on them apply
+unchanged.
+
+Example:
+    >>> box = crop_images(mask, {bet: bet_crop, mask: mask_crop}, box_path)
+    >>> uncrop_image(atlas_crop, native_image, atlas, box_path)
+"""
+
+import argparse
+import json
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+CROP_DIR = "cropped"
+CROP_BOX = "crop_box.json"
+# Margin kept around the dilated brain mask
+CROP_MARGIN_MM = 10.0
+
+
+def bounding_box(mask, margin=(0, 0, 0)):
+    """Get the bounding box of the non-zero voxels of a mask, grown by a margin.
+
+    Args:
+        mask (numpy.ndarray): 3D mask.
+        margin (tuple, optional): Margin in voxels along each axis.
+
+    Returns:
+        list: ``[start, stop)`` voxel range along each axis, clipped to the grid. The
+            whole grid for an empty mask.
+    """
+    box = []
+    for axis, size in enumerate(mask.shape[:3]):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=other))
+        if nonzero.size == 0:
+            return [[0, s] for s in mask.shape[:3]]
+        box.append([max(0, int(nonzero[0]) - margin[axis]),
+                    min(size, int(nonzero[-1]) + 1 + margin[axis])])
+    return box
+
+
+def crop_images(mask_path, images, box_path, margin_mm=CROP_MARGIN_MM):
+    """Crop images to the bounding box of a brain mask.
+
+    Args:
+        mask_path (str): Brain mask defining the box.
+        images (dict): Paths of the images to crop, on the mask's grid, mapped to
+            the paths of the cropped images.
+        box_path (str): Where to save the box, for ``uncrop_image``.
+        margin_mm (float, optional): Margin around the mask in mm.
+
+    Returns:
+        list: The voxel box.
+    """
+    mask_img = nib.load(mask_path)
+    zooms = mask_img.header.get_zooms()[:3]
+    margin = tuple(int(np.ceil(margin_mm / z)) for z in zooms)
+    box = bounding_box(np.asanyarray(mask_img.dataobj) > 0, margin)
+
+    kept = np.prod([stop - start for start, stop in box]) / np.prod(mask_img.shape[:3])
+    log.info("Cropping to %s, %.0f%% of the native grid", box, 100 * kept)
+
+    index = tuple(slice(start, stop) for start, stop in box)
+    for path, output in images.items():
+        img = nib.load(path)
+        if img.shape[:3] != mask_img.shape[:3]:
+            raise ValueError(f"{path} is not on the grid of {mask_path}")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        nib.save(img.slicer[index], output)
+
+    os.makedirs(os.path.dirname(box_path) or ".", exist_ok=True)
+    with open(box_path, "w") as f:
+        json.dump({"shape": list(mask_img.shape[:3]), "box": box}, f)
+    return box
+
+
+def uncrop_image(cropped_path, reference_path, output, box_path):
+    """Paste a cropped image back into the native grid, zero outside the box.
+
+    Args:
+        cropped_path (str): Image on the cropped grid.
+        reference_path (str): Image on the native grid, giving its affine.
+        output (str): Where to write the native grid image.
+        box_path (str): Box saved by ``crop_images``.
+
+    Returns:
+        str: The ``output`` path.
+    """
+    with open(box_path) as f:
+        box = json.load(f)["box"]
+    cropped = nib.load(cropped_path)
+    reference = nib.load(reference_path)
+
+    data = np.asanyarray(cropped.dataobj)
+    native = np.zeros(reference.shape[:3] + data.shape[3:], dtype=data.dtype)
+    native[tuple(slice(start, stop) for start, stop in box)] = data
+
+    img = nib.Nifti1Image(native, reference.affine, cropped.header)
+    img.set_qform(*reference.header.get_qform(coded=True))
+    img.set_sform(*reference.header.get_sform(coded=True))
+    nib.save(img, output)
+    return output
+
+
+def uncrop_images(images, reference_path, box_path):
+    """Paste cropped images back into the native grid.
+
+    Args:
+        images (dict): Paths of the cropped images mapped to the native outputs.
+        reference_path (str): Image on the native grid.
+        box_path (str): Box saved by ``crop_images``.
+    """
+    for cropped_path, output in images.items():
+        uncrop_image(cropped_path, reference_path, output, box_path)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    crop_parser = subparsers.add_parser("crop", help="crop images to a mask's box")
+    crop_parser.add_argument("mask", help="brain mask defining the box")
+    crop_parser.add_argument("box", help="box file to write")
+    crop_parser.add_argument("images", nargs="+", help="input:output image pairs")
+    crop_parser.add_argument("--margin", type=float, default=CROP_MARGIN_MM,
+                             help="margin in mm")
+    uncrop_parser = subparsers.add_parser("uncrop", help="paste an image back")
+    uncrop_parser.add_argument("cropped", help="image on the cropped grid")
+    uncrop_parser.add_argument("reference", help="image on the native grid")
+    uncrop_parser.add_argument("output", help="native grid image to write")
+    uncrop_parser.add_argument("box", help="box file written by crop")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.action == "crop":
+        crop_images(args.mask, dict(pair.split(":", 1) for pair in args.images),
+                    args.box, args.margin)
+    else:
+        uncrop_image(args.cropped, args.reference, args.output, args.box)
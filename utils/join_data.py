@@ -1,37 +1,52 @@
-import flywheel
 import json
 import pandas as pd
 from datetime import datetime
 import re
 import os
-import shutil
 
 import logging
 
+from utils.publish import atomic_write, publish_nifti
+from utils.storage import NIFTI_GZ
+
 
 log = logging.getLogger(__name__)
 
 #  Module to identify the correct template use for the subject VBM analysis based on age at scan
 #  Need to get subject identifiers from inside running container in order to find the correct template from the SDK
 
+def segmentation_output(output_dir, acq):
+    """Get the published path of the segmentation of an acquisition."""
+    return os.path.join(output_dir, acq + '_segmentation.nii.gz')
+
     # -------------------  Concatenate the data  -------------------  #
 
-def housekeeping(demographics):
+def housekeeping(demographics, work_dir='/flywheel/v0/work', output_dir='/flywheel/v0/output',
+                 ext=NIFTI_GZ, threads=1, publisher=None):
+    """Publish the volumes table and the segmentation.
+
+    With a ``utils.publish.Publisher`` the segmentation is usually published
+    already, as soon as the pipeline wrote it; otherwise it is published here.
+    """
 
     acq = demographics['acquisition'].values[0]
     sub = demographics['subject'].values[0]
 
-    filePath = '/flywheel/v0/work/All_volumes.csv'
+    filePath = os.path.join(work_dir, 'All_volumes.csv')
     volumes = pd.read_csv(filePath, sep='\s+', engine='python') #index_col=False,
     df = pd.concat([demographics.reset_index(drop=True), volumes.reset_index(drop=True)], axis=1)
     out_name = f"{acq}_volumes.csv"
-    outdir = ('/flywheel/v0/output/' + out_name)
-    df.to_csv(outdir, index=False)
-
-    seg_file = '/flywheel/v0/work/Final_segmentation_atlas_with_callosum.nii.gz'
-    new_seg_file = '/flywheel/v0/output/' + acq + '_segmentation.nii.gz'
-    shutil.copy(seg_file, new_seg_file)
-
-    QC_montage = '/flywheel/v0/work/montage_final_segmentation_atlas_with_callosum.png'
-    new_QC_montage = '/flywheel/v0/output/' + acq + '_QC-montage.png'
-    shutil.copy(QC_montage, new_QC_montage)
\ No newline at end of file
+    outdir = os.path.join(output_dir, out_name)
+    with atomic_write(outdir, 'w') as f:
+        df.to_csv(f, index=False)
+
+    # Intermediates may be uncompressed (see utils/storage.py), the published
+    # segmentation is always gzipped
+    seg_file = os.path.join(work_dir, 'Final_segmentation_atlas_with_callosum' + ext)
+    new_seg_file = segmentation_output(output_dir, acq)
+    if publisher is None:
+        publish_nifti(seg_file, new_seg_file, threads)
+    else:
+        publisher.publish(seg_file, new_seg_file).result()
+
+    return outdir
\ No newline at end of file
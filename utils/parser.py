@@ -1,34 +1,127 @@
 """Parser module to parse gear config.json."""
 
-from typing import Tuple
-from flywheel_gear_toolkit import GearToolkitContext
-# from utils.curate_output import demo
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Tuple
+import math
 import sys
 import os
 
-from shared.utils.curate_output import demo
+from utils import profiler
+from utils.context import OfflineContext
+from utils.threads import limit_process_threads, thread_budget
 import warnings
 
+if TYPE_CHECKING:
+    from flywheel_gear_toolkit import GearToolkitContext
+
 
 import logging
 
 
 log = logging.getLogger(__name__)
 
+TEMPLATE_AGES = ('3M', '6M', '12M', '18M', '24M')
+
+
+def age_to_template(age):
+    """Select the template for an age in months.
+
+    Args:
+        age (str or float): Age in months, or a template age such as "12M".
+
+    Returns:
+        str: The template age.
+
+    Raises:
+        ValueError: If the age is not a number of months, e.g. missing (NaN).
+    """
+    if str(age) in TEMPLATE_AGES:
+        return str(age)
+    age_demo = float(age)
+    if not math.isfinite(age_demo):
+        raise ValueError(f"Age {age!r} is not a number of months")
+    log.info(age_demo)
+    if age_demo < 5:
+        age_template = '3M'
+    elif age_demo < 10:
+        age_template = '6M'
+    elif age_demo < 16:
+        age_template = '12M'
+    elif age_demo < 22:
+        age_template = '18M'
+    else:
+        # The oldest template is used for all older subjects
+        age_template = '24M'
+    return age_template
+
+
+def pull_demographics(gear_context):
+    """Get the demographics of the session, from the Flywheel API or offline files.
+
+    The Flywheel SDK, and pandas, are imported only here, when the lookup runs.
+
+    Returns:
+        pandas.DataFrame: A single row with the subject, session and acquisition
+            labels and the age.
+    """
+    with profiler.span("demographics"):
+        if isinstance(gear_context, OfflineContext):
+            return gear_context.demographics()
+        from shared.utils.curate_output import demo
+
+        return demo(gear_context)
+
+
+def demographics_age(demographics):
+    """Select the template from the age in the demographics.
+
+    Args:
+        demographics (concurrent.futures.Future): The demographics lookup.
+
+    Returns:
+        str: The template age, None if the demographics give no usable age.
+    """
+    age_demo = demographics.result()['age'].values[0]
+    log.info(f"Age from demographics:  {age_demo}")
+    age_template = None
+    try:
+        age_template = age_to_template(age_demo)
+
+    except ValueError as ve:
+        log.exception(f"Caught a ValueError: {ve}")
+    except TypeError as te:
+        log.exception(f"Caught a TypeError: {te}")
+    except Exception as e:
+        log.exception(f"Caught a general exception: {e}")
+    log.info(f"Age template is: {age_template}")
+    return age_template
+
+
 def parse_config(
-    gear_context: GearToolkitContext,
+    gear_context: "GearToolkitContext",
      
-) -> Tuple[str, str]: # Add dict for each set of outputs
+) -> Tuple[str, object, Future, dict]: # Add dict for each set of outputs
     """Parse the config and other options from the context, both gear and app options.
 
+    The demographics are pulled in the background, so that the preprocessing can
+    start while the Flywheel API answers. Wait for them with ``.result()``.
+
     Returns:
-        gear_inputs
+        input: path to the input image
+        age_template: age of the template to use, or a Future of it when the age
+            comes from the demographics
+        demographics: Future of the demographics of the session
         gear_options: options for the gear
-        app_options: options to pass to the app
     """
+    # Bound the threaded runtimes of the gear before the lookup, or a stage,
+    # loads them
+    threads = thread_budget(gear_context.config.get("threads"))
+    limit_process_threads(threads)
+
     # Gather demographic data from the session
-    log.info("Pulling demographics...")
-    demographics = demo(gear_context)
+    log.info("Pulling demographics in the background...")
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="demographics")
+    demographics = executor.submit(pull_demographics, gear_context)
 
     log.info("Running parse_config...")
 
@@ -37,33 +130,25 @@ def parse_config(
    
     if age_template == "None" or age_template is None:
         log.warning("Age is not provided in the config.json file. Checking for age in dicom headers...")
-        age_demo = demographics['age'].values[0]
-        log.info(f"Age from demographics:  {age_demo}")
-        #age_demo = age_demo.replace('M', '') 
-        try:
-            age_demo = float(age_demo)
-            log.info(age_demo)
-            if age_demo < 5:
-                age_template = '3M'
-            elif age_demo < 10:
-                age_template = '6M'
-            elif age_demo < 16:
-                age_template = '12M'       
-            elif age_demo < 22:
-                age_template = '18M'        
-            elif age_demo <= 30 or age_demo > 30: #this change was made to account for those above 30. Redundant code but needs cleaning when we have more templates
-                age_template = '24M'
-            else:
-                age_template = None
-                ValueError("Age is not provided in config.json file or dicom headers")
-
-        except ValueError as ve:
-            log.exception(f"Caught a ValueError: {ve}")
-        except TypeError as te:
-            log.exception(f"Caught a TypeError: {te}")
-        except Exception as e:
-            log.exception(f"Caught a general exception: {e}")
-    
-            
-    log.info(f"Age template is: {age_template}")
-    return input, age_template, demographics
\ No newline at end of file
+        # Resolved on the lookup thread once the demographics arrive
+        age_template = executor.submit(demographics_age, demographics)
+    else:
+        log.info(f"Age template is: {age_template}")
+    executor.shutdown(wait=False)
+
+    # 0 is a valid size, keeping only the entry just stored
+    cache_size_gb = gear_context.config.get("transform_cache_size_gb")
+    gear_options = {
+        "threads": threads,
+        "qc_slices": max(1, int(gear_context.config.get("qc_slices") or 1)),
+        "storage": gear_context.config.get("storage") or "compressed",
+        "crop": gear_context.config.get("crop", False),
+        "preprocessing": gear_context.config.get("preprocessing") or "full",
+        "registration_preset": gear_context.config.get("registration_preset") or "standard",
+        "atropos_iterations": max(1, int(gear_context.config.get("atropos_iterations") or 15)),
+        "atropos_convergence": float(gear_context.config.get("atropos_convergence", 0.001)),
+        "transform_cache": gear_context.config.get("transform_cache") or None,
+        "transform_cache_size_gb": cache_size_gb if cache_size_gb is not None else 20,
+        "template_store": gear_context.config.get("template_store") or None,
+    }
+    return input, age_template, demographics, gear_options
\ No newline at end of file
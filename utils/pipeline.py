@@ -0,0 +1,658 @@
+"""The MiniMORPH segmentation pipeline as a graph of checkpointed steps.
+
+Each step declares the files it reads and writes and either a command, run through
+``exec_command``, or a Python function. The steps are run by ``utils.scheduler``,
+which derives their dependencies from the declared files and runs independent
+steps concurrently. Every step is checkpointed (see ``utils.checkpoint``) so that a
+rerun skips the steps whose inputs, parameters and tools are unchanged and resumes
+at the first stale one.
+
+Outside of Flywheel the pipeline is run from the command line, as ``app/main.sh``
+does, with the final atlases, volumes and QC montages written to an output
+directory.
+
+Example:
+    >>> from utils.pipeline import run_pipeline
+    >>> run_pipeline("/flywheel/v0/input/input/T2w.nii.gz", "12M")
+
+    python3 -m utils.pipeline T2w.nii.gz 12M /data/work --output-dir /data/output
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import os
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from utils import profiler
+from utils.checkpoint import Checkpoint, file_hash, tool_version
+from utils.cache import DEFAULT_MAX_BYTES, TransformCache, cache_key
+from utils.command_line import exec_command
+from utils.crop import CROP_BOX, CROP_DIR, CROP_MARGIN_MM, crop_images, uncrop_images
+from utils.preprocess import DEFAULT_MODE, HEAD_MASK, PREPROCESSING_MODES, make_head_mask
+from utils.preprocess import preprocessing_settings, strip_brain
+from utils.refine import FINAL_ATLAS, FINAL_ATLAS_CALLOSUM, MASKS, POSTERIORS, WARPED_MASKS
+from utils.refine import refine_segmentation
+from utils.registration import DEFAULT_PRESET, REGISTRATION_PRESETS, registration_command
+from utils.scheduler import run_graph
+from utils.segmentation import DEFAULT_CONVERGENCE, DEFAULT_ITERATIONS, segment_tissues
+from utils.storage import NIFTI, NIFTI_GZ, STORAGE_POLICIES, intermediate_ext, nifti
+from utils.storage import release_work_dir, resolve_work_dir
+from utils.templates import load_bundle
+from utils.threads import thread_budget, thread_environ
+from utils.transforms import NATIVE_WARP, PRIORS, warp_template_images
+from utils.volumes import VOLUMES_NAME, extract_volumes
+
+log = logging.getLogger(__name__)
+
+FLYWHEEL_BASE = "/flywheel/v0"
+WORK_DIR = os.path.join(FLYWHEEL_BASE, "work")
+OUTPUT_DIR = os.path.join(FLYWHEEL_BASE, "output")
+TEMPLATES_DIR = os.path.join(FLYWHEEL_BASE, "app", "templates")
+
+# Steps skipped on a transform cache hit, and those whose outputs are cached
+CACHED_STEPS = ("head_mask", "denoise", "n4", "synthstrip", "registration")
+CACHED_OUTPUT_STEPS = ("n4", "synthstrip", "registration")
+# Age of the steps built while the template age is looked up
+TEMPLATE_PENDING = "pending"
+
+
+@dataclass
+class Step:
+    """A pipeline step.
+
+    Attributes:
+        name (str): Name of the step, also names its checkpoint.
+        inputs (list): Paths of the files the step reads.
+        outputs (list): Paths of the files the step writes.
+        command (list, optional): Command line to run with ``exec_command``.
+        func (callable, optional): Python function to call instead of a command.
+        kwargs (dict): Keyword arguments of ``func``.
+        tools (list): Executables or Python modules the outputs depend on. Defaults
+            to the executable of ``command``.
+        threads (int, optional): Threads the step can make use of, None for as
+            many as the budget allows. Defaults to 1.
+        environ (dict): Environment variables set for ``command``, or for the tools
+            ``func`` runs when it takes an ``environ`` argument.
+    """
+
+    name: str
+    inputs: List[str]
+    outputs: List[str]
+    command: Optional[List[str]] = None
+    func: Optional[Callable] = None
+    kwargs: dict = field(default_factory=dict)
+    tools: List[str] = field(default_factory=list)
+    threads: Optional[int] = 1
+    environ: dict = field(default_factory=dict)
+
+    def checkpoint(self, directory):
+        """Get the checkpoint of this step, with its manifest kept in ``directory``."""
+        if self.command is not None:
+            params = {"command": self.command}
+            tools = self.tools or [self.command[0]]
+        else:
+            params = {"func": self.func.__qualname__, "kwargs": self.kwargs}
+            tools = self.tools or [self.func.__module__]
+        return Checkpoint(self.name, self.inputs, self.outputs, params, tools, directory)
+
+
+def run_step(step, work_dir=WORK_DIR, threads=1):
+    """Run a step unless its checkpoint is up to date.
+
+    Args:
+        step (Step): The step to run.
+        work_dir (str, optional): Where the checkpoint manifests are kept. Defaults
+            to ``/flywheel/v0/work``.
+        threads (int, optional): Threads granted to the step, passed through their
+            environment to its command, or to the tools its function runs when it
+            takes an ``environ`` argument. A function taking a ``threads``
+            argument is also given the count. Defaults to 1.
+    """
+    checkpoint = step.checkpoint(work_dir)
+    environ = thread_environ(threads)
+    environ.update(step.environ)
+    if step.command is not None:
+        exec_command(
+            step.command,
+            environ=environ,
+            cont_output=True,
+            checkpoint=checkpoint,
+            stage=step.name,
+        )
+        return
+
+    if checkpoint.is_fresh():
+        log.info("Checkpoint %s is up to date, skipping %s", step.name, step.func.__name__)
+        return
+    log.info("Running %s", step.name)
+    # The environment and thread count are not parameters of the outputs, so they
+    # are kept out of the checkpointed kwargs
+    kwargs = dict(step.kwargs)
+    parameters = inspect.signature(step.func).parameters
+    if "environ" in parameters:
+        kwargs["environ"] = environ
+    if "threads" in parameters:
+        kwargs["threads"] = threads
+    with profiler.span(step.name):
+        step.func(**kwargs)
+    checkpoint.save()
+
+
+def build_steps(input_path, age, work_dir=WORK_DIR, template_dir=None, stack_dir=None,
+                ext=NIFTI_GZ, crop=False, preset=DEFAULT_PRESET,
+                atropos_iterations=DEFAULT_ITERATIONS,
+                atropos_convergence=DEFAULT_CONVERGENCE, preprocessing=DEFAULT_MODE,
+                bundle=None):
+    """Describe the segmentation pipeline for one input image.
+
+    Args:
+        input_path (str): Native space T2w input image.
+        age (str): Template age, e.g. "12M".
+        work_dir (str, optional): Directory for the pipeline files. Defaults to
+            ``/flywheel/v0/work``.
+        template_dir (str, optional): Age specific template directory. Defaults to
+            ``/flywheel/v0/app/templates/<age>``.
+        stack_dir (str, optional): Directory of template stacks shared between
+            subjects (see ``utils.transforms.stack_templates``).
+        ext (str, optional): Extension of the NIfTI intermediates, ``.nii.gz`` or
+            ``.nii`` (see ``utils.storage``). The registration warp fields are
+            always written compressed by antsRegistration.
+        crop (bool, optional): Run the registration, the warps and Atropos on the
+            bounding box of the dilated brain mask (see ``utils.crop``) and paste
+            the final atlases back into the native grid. The registration sees a
+            smaller field of view, so the results differ slightly from those of
+            the full grid. Defaults to False.
+        preset (str, optional): Registration preset, see ``utils.registration``.
+            Defaults to "standard".
+        atropos_iterations (int, optional): Maximum number of Atropos rounds, see
+            ``utils.segmentation``.
+        atropos_convergence (float, optional): Posterior change the Atropos
+            rounds stop at.
+        preprocessing (str or dict, optional): Preprocessing mode, or its
+            settings, see ``utils.preprocess``. Defaults to "full".
+        bundle (utils.templates.TemplateBundle, optional): Validated template
+            bundle, whose derived products are read instead of the template
+            files where available.
+
+    Returns:
+        list: The ``Step`` objects, in the order of the pipeline stages. The order
+            they run in is derived from their inputs and outputs.
+    """
+    template_dir = template_dir or os.path.join(TEMPLATES_DIR, age)
+    preprocessing = preprocessing_settings(preprocessing)
+
+    def work(name):
+        return os.path.join(work_dir, name)
+
+    def intermediate(name):
+        return work(nifti(name, ext))
+
+    def template(name):
+        return os.path.join(template_dir, name)
+
+    template_image = template(f"template_{age}_degibbs_padded.nii.gz")
+    template_mask = template("brainMask.nii.gz")
+    if bundle is not None:
+        template_image = bundle.path("template")
+        template_mask = bundle.path("brain_mask")
+        stack_dir = stack_dir or bundle.derived_dir
+    template_priors = [template(f"{p}.nii.gz") for p in PRIORS]
+    template_masks = [template(f"{m}.nii.gz") for m in MASKS]
+
+    denoised = intermediate("DN")
+    bias_corrected = intermediate("DN_BC")
+    native_bet_image = intermediate("native_bet_image")
+    native_brain_mask = intermediate("native_brain_mask")
+    native_brain_mask_dil = intermediate("native_brain_mask_dil")
+    affine = work("bet_0GenericAffine.mat")
+    warp = work("bet_1Warp.nii.gz")
+    inverse_warp = work("bet_1InverseWarp.nii.gz")
+    warped = intermediate("bet_Warped")
+    priors = [intermediate(p) for p in PRIORS]
+    posteriors = [intermediate(p) for p in POSTERIORS]
+    final_atlas = intermediate(FINAL_ATLAS)
+    final_atlas_callosum = intermediate(FINAL_ATLAS_CALLOSUM)
+    warped_masks = work(WARPED_MASKS)
+
+    # Images the registration and segmentation run on, cropped to the brain
+    if crop:
+        crop_dir = work(CROP_DIR)
+        crop_box = work(CROP_BOX)
+
+        def cropped(name):
+            return os.path.join(crop_dir, nifti(name, ext))
+
+        segmentation_input = cropped("DN_BC")
+        reference = cropped("native_bet_image")
+        reference_mask = cropped("native_brain_mask")
+        segmentation_mask = cropped("native_brain_mask_dil")
+        atlases = [cropped(FINAL_ATLAS), cropped(FINAL_ATLAS_CALLOSUM)]
+    else:
+        segmentation_input = bias_corrected
+        reference = native_bet_image
+        reference_mask = native_brain_mask
+        segmentation_mask = native_brain_mask_dil
+        atlases = [final_atlas, final_atlas_callosum]
+
+    crop_step = uncrop_step = None
+    if crop:
+        # Crop to the brain once the dilated mask is known
+        crop_step = Step(
+            "crop",
+            [bias_corrected, native_bet_image, native_brain_mask, native_brain_mask_dil],
+            [segmentation_input, reference, reference_mask, segmentation_mask, crop_box],
+            func=crop_images,
+            kwargs={
+                "mask_path": native_brain_mask_dil,
+                "images": {bias_corrected: segmentation_input,
+                           native_bet_image: reference,
+                           native_brain_mask: reference_mask,
+                           native_brain_mask_dil: segmentation_mask},
+                "box_path": crop_box,
+                "margin_mm": CROP_MARGIN_MM,
+            },
+        )
+        # Paste the final atlases back into the native grid
+        uncrop_step = Step(
+            "uncrop",
+            atlases + [input_path, crop_box],
+            [final_atlas, final_atlas_callosum],
+            func=uncrop_images,
+            kwargs={"images": dict(zip(atlases, [final_atlas, final_atlas_callosum])),
+                    "reference_path": input_path, "box_path": crop_box},
+        )
+
+    # Step 1 at native resolution, or restricted to the head and downsampled
+    head_mask_step = None
+    head_mask_inputs = []
+    head_mask_args = []
+    if preprocessing["head_mask"]:
+        head_mask = intermediate(HEAD_MASK)
+        head_mask_step = Step("head_mask", [input_path], [head_mask], func=make_head_mask,
+                              kwargs={"image": input_path, "output": head_mask})
+        head_mask_inputs = [head_mask]
+        head_mask_args = ["-x", head_mask]
+    n4_args = []
+    if preprocessing["n4_shrink_factor"]:
+        n4_args += ["-s", str(preprocessing["n4_shrink_factor"])]
+    if preprocessing["n4_convergence"]:
+        n4_args += ["-c", preprocessing["n4_convergence"]]
+    if preprocessing["strip_factor"] > 1:
+        strip_step = Step(
+            "synthstrip",
+            [bias_corrected],
+            [native_bet_image, native_brain_mask],
+            func=strip_brain,
+            kwargs={"image": bias_corrected, "bet_image": native_bet_image,
+                    "mask": native_brain_mask, "factor": preprocessing["strip_factor"]},
+            tools=["utils.preprocess", "mri_synthstrip", "antsApplyTransforms"],
+            threads=None,
+        )
+    else:
+        strip_step = Step(
+            "synthstrip",
+            [bias_corrected],
+            [native_bet_image, native_brain_mask],
+            ["mri_synthstrip", "-i", bias_corrected, "-o", native_bet_image,
+             "-m", native_brain_mask, "-b", "2"],
+            threads=None,
+        )
+
+    steps = [
+        # Step 1: bet image to help with registration to template
+        head_mask_step,
+        Step(
+            "denoise",
+            [input_path] + head_mask_inputs,
+            [denoised],
+            ["DenoiseImage", "-i", input_path] + head_mask_args + ["-o", denoised],
+            threads=None,
+        ),
+        Step(
+            "n4",
+            [denoised] + head_mask_inputs,
+            [bias_corrected],
+            ["N4BiasFieldCorrection", "-i", denoised] + head_mask_args + n4_args
+            + ["-o", bias_corrected],
+            threads=None,
+        ),
+        strip_step,
+        Step(
+            "brain_mask_dilation",
+            [native_brain_mask],
+            [native_brain_mask_dil],
+            ["fslmaths", native_brain_mask, "-dilM", "-dilM", native_brain_mask_dil],
+            environ={"FSLOUTPUTTYPE": "NIFTI" if ext == NIFTI else "NIFTI_GZ"},
+        ),
+        crop_step,
+        Step(
+            "registration",
+            [template_image, template_mask, reference, reference_mask],
+            [affine, warp, inverse_warp, warped],
+            registration_command(template_image, template_mask, reference,
+                                 reference_mask, work("bet_"), warped, preset),
+            threads=None,
+        ),
+        # Step 2: apply registration to segmentation priors and masks
+        Step(
+            "transforms",
+            [reference, affine, inverse_warp] + template_priors + template_masks,
+            [intermediate(NATIVE_WARP)] + priors + [warped_masks],
+            func=warp_template_images,
+            kwargs={"template_dir": template_dir, "reference": reference,
+                    "work_dir": work_dir, "stack_dir": stack_dir, "ext": ext},
+            tools=["utils.transforms", "antsApplyTransforms"],
+            threads=None,
+        ),
+        # Step 3: segment the bias corrected image with Atropos
+        Step(
+            "atropos",
+            [segmentation_input, segmentation_mask] + priors,
+            posteriors,
+            func=segment_tissues,
+            kwargs={"image": segmentation_input, "mask": segmentation_mask,
+                    "priors": intermediate("prior%d_scale"), "work_dir": work_dir,
+                    "ext": ext, "iterations": atropos_iterations,
+                    "convergence": atropos_convergence},
+            tools=["utils.segmentation", "Atropos", "N4BiasFieldCorrection"],
+            threads=None,
+        ),
+        # Step 4-5: refine the posteriors into the final segmentation atlas
+        Step(
+            "refinement",
+            posteriors + [warped_masks],
+            atlases,
+            func=refine_segmentation,
+            kwargs={"work_dir": work_dir, "output_dir": os.path.dirname(atlases[0]),
+                    "ext": ext},
+        ),
+        uncrop_step,
+        # Step 6: volume estimation (the QC montage is written by the QC step)
+        Step(
+            "volumes",
+            [final_atlas_callosum],
+            [work(VOLUMES_NAME)],
+            func=extract_volumes,
+            kwargs={"age": age, "work_dir": work_dir, "atlas": final_atlas_callosum},
+        ),
+    ]
+    return [step for step in steps if step is not None]
+
+
+def qc_step(input_path, subject_label, work_dir=WORK_DIR, output_dir=OUTPUT_DIR,
+            slices=1, threads=1, acquisition=None, ext=NIFTI_GZ):
+    """Describe the segmentation QC step, run after housekeeping.
+
+    Args:
+        input_path (str): Native space T2w input image.
+        subject_label (str): Subject label used to name the QC files.
+        work_dir (str, optional): Directory holding the final atlas.
+        output_dir (str, optional): Directory for the QC files.
+        slices (int, optional): Number of QC slices per plane.
+        threads (int, optional): Number of slices rendered at once, granted when
+            the step runs (see ``run_step``).
+        acquisition (str, optional): Acquisition label. When given, the QC montage
+            is written to ``<output_dir>/<acquisition>_QC-montage.png``.
+        ext (str, optional): Extension of the NIfTI intermediates.
+
+    Returns:
+        Step: The QC step.
+    """
+    # PIL and matplotlib are only needed for the QC
+    from utils.Inspect_segmentations import PLANES, SegQC, gif_name
+
+    atlas = os.path.join(work_dir, nifti(FINAL_ATLAS_CALLOSUM, ext))
+    inputs = [input_path, atlas]
+    outputs = [os.path.join(output_dir, gif_name(subject_label, p, k, slices))
+               for p in PLANES for k in range(slices)]
+    outputs.append(os.path.join(output_dir, "registration_check.html"))
+    kwargs = {"input_image_path": input_path, "atlas_image_path": atlas,
+              "subj": subject_label, "overlay_dir": output_dir, "slices": slices}
+    if acquisition is not None:
+        bet_image = os.path.join(work_dir, "native_bet_image" + ext)
+        montage = os.path.join(output_dir, f"{acquisition}_QC-montage.png")
+        inputs.append(bet_image)
+        outputs.append(montage)
+        kwargs.update(bet_image_path=bet_image, montage_path=montage)
+    return Step("qc", inputs, outputs, func=SegQC, kwargs=kwargs, threads=threads)
+
+
+def transform_cache_files(steps, input_path, work_dir):
+    """Describe the transform cache entry of a subject.
+
+    The key covers the input content, the content of the template files and the
+    parameters and tool versions of the registration and of the steps it depends
+    on, with the work directory and input paths abstracted so that the entry is
+    shared between runs. The steps between the cached ones (the mask dilation and
+    the crop) are cheap and rerun on a hit.
+
+    Args:
+        steps (list): Steps from ``build_steps``.
+        input_path (str): Native space T2w input image.
+        work_dir (str): Work directory of the steps.
+
+    Returns:
+        tuple: The key, the paths of the cached files and the fields of the key.
+    """
+    producers = {o: s for s in steps for o in s.outputs}
+    keyed = {"registration"}
+    pending = [s for s in steps if s.name == "registration"]
+    while pending:
+        for path in pending.pop().inputs:
+            step = producers.get(path)
+            if step is not None and step.name not in keyed:
+                keyed.add(step.name)
+                pending.append(step)
+    keyed = [s for s in steps if s.name in keyed]
+    external = sorted({i for s in keyed for i in s.inputs} - set(producers) - {input_path})
+    replacements = [(work_dir, "<work>"), (input_path, "<input>")]
+    replacements += [(path, os.path.basename(path)) for path in external]
+
+    def abstract(arg):
+        for path, name in replacements:
+            arg = arg.replace(path, name)
+        return arg
+
+    def params(step):
+        if step.command is not None:
+            return [abstract(a) for a in step.command]
+        return {"func": step.func.__qualname__,
+                "kwargs": abstract(json.dumps(step.kwargs, sort_keys=True))}
+
+    fields = {
+        "input": file_hash(input_path),
+        "templates": {os.path.basename(p): file_hash(p) for p in external},
+        "steps": {s.name: params(s) for s in keyed},
+        "tools": {t: tool_version(t) for s in keyed
+                  for t in s.tools or [s.command[0] if s.command else s.func.__module__]},
+    }
+    cached = [s for s in keyed if s.name in CACHED_STEPS]
+    files = [o for s in cached if s.name in CACHED_OUTPUT_STEPS for o in s.outputs]
+    return cache_key(fields), files, fields
+
+
+def template_free_steps(steps, template_dir):
+    """Get the steps that use no template file, directly or through other steps.
+
+    Args:
+        steps (list): Steps from ``build_steps``, in their dependency order.
+        template_dir (str): Template directory of the steps.
+
+    Returns:
+        list: The steps that can run before the template is known.
+    """
+    template_dir = os.path.join(template_dir, "")
+    dependent = set()
+    free = []
+    for step in steps:
+        if any(i.startswith(template_dir) or i in dependent for i in step.inputs):
+            dependent.update(step.outputs)
+        else:
+            free.append(step)
+    return free
+
+
+def run_pipeline(input_path, age, work_dir=WORK_DIR, template_dir=None, threads=None,
+                 stack_dir=None, ext=NIFTI_GZ, crop=False, preset=DEFAULT_PRESET,
+                 cache=None, on_complete=None, atropos_iterations=DEFAULT_ITERATIONS,
+                 atropos_convergence=DEFAULT_CONVERGENCE, preprocessing=DEFAULT_MODE,
+                 template_store=None, verify_template=True):
+    """Run the segmentation pipeline, resuming at the first stale step.
+
+    Args:
+        input_path (str): Native space T2w input image.
+        age (str or concurrent.futures.Future): Template age, e.g. "12M", or a
+            future of it, such as the age from the demographics lookup. The steps
+            that do not use the template run while it is pending.
+        work_dir (str, optional): Directory for the pipeline files. Defaults to
+            ``/flywheel/v0/work``.
+        template_dir (str, optional): Age specific template directory.
+        threads (int, optional): Thread budget shared by concurrent steps.
+            Defaults to the CPUs available to the container.
+        stack_dir (str, optional): Directory of template stacks shared between
+            subjects.
+        ext (str, optional): Extension of the NIfTI intermediates, see
+            ``utils.storage``. Defaults to ``.nii.gz``.
+        crop (bool, optional): Run the heavy steps on the brain bounding box.
+            Defaults to False.
+        preset (str, optional): Registration preset, see ``utils.registration``.
+            Defaults to "standard".
+        cache (utils.cache.TransformCache, optional): Transform cache. On a hit
+            the pipeline starts at the prior warps, on a miss the registration
+            outputs are stored once the pipeline completes.
+        on_complete (callable, optional): Called with each step as it completes,
+            see ``utils.scheduler.run_graph``. Used to publish the outputs early.
+        atropos_iterations (int, optional): Maximum number of Atropos rounds.
+        atropos_convergence (float, optional): Posterior change the Atropos
+            rounds stop at.
+        preprocessing (str or dict, optional): Preprocessing mode, see
+            ``utils.preprocess``. Defaults to "full".
+        template_store (str, optional): Template store shared by the runs of the
+            node, see ``utils.templates.shared_store``. Used for templates without
+            derived products.
+        verify_template (bool, optional): Check the template files against their
+            index, see ``utils.templates.load_bundle``. Defaults to True.
+    """
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"Input file not found: {input_path}")
+    os.makedirs(work_dir, exist_ok=True)
+    budget = threads or thread_budget()
+
+    def run(step, granted):
+        run_step(step, work_dir, granted)
+
+    if isinstance(age, Future):
+        # Preprocess while the age is looked up. Their checkpoints do not depend
+        # on the template, so the steps are skipped once the whole graph runs.
+        # The cache lookup needs the template, and saves more than that.
+        if cache is None and not age.done():
+            pending_dir = template_dir or os.path.join(TEMPLATES_DIR, TEMPLATE_PENDING)
+            steps = build_steps(input_path, TEMPLATE_PENDING, work_dir, pending_dir,
+                                stack_dir, ext, crop, preset, atropos_iterations,
+                                atropos_convergence, preprocessing)
+            log.info("Preprocessing while the template age is looked up")
+            run_graph(template_free_steps(steps, pending_dir), run, budget, on_complete)
+        with profiler.span("wait_for_age"):
+            age = age.result()
+        if age is None:
+            raise ValueError("No template age: set the age config option")
+
+    # Validate the template before the first step that uses it
+    template_dir = template_dir or os.path.join(TEMPLATES_DIR, age)
+    with profiler.span("templates"):
+        bundle = load_bundle(template_dir, age, verify=verify_template,
+                             store=template_store)
+    steps = build_steps(input_path, age, work_dir, template_dir, stack_dir, ext, crop,
+                        preset, atropos_iterations, atropos_convergence, preprocessing,
+                        bundle)
+    hit = False
+    if cache is not None:
+        key, files, fields = transform_cache_files(steps, input_path, work_dir)
+        hit = cache.restore(key, files)
+        if hit:
+            steps = [s for s in steps if s.name not in CACHED_STEPS]
+
+    try:
+        run_graph(steps, run, budget, on_complete)
+    finally:
+        # Cache the registration once it completed, even if a later step failed
+        if cache is not None and not hit and all(
+            s.checkpoint(work_dir).is_fresh() for s in steps if s.name in CACHED_OUTPUT_STEPS
+        ):
+            cache.store(key, files, fields)
+
+
+def write_outputs(work_dir, output_dir, ext=NIFTI_GZ, threads=1):
+    """Write the outputs of a pipeline run outside of Flywheel.
+
+    The final atlases are published compressed with the volumes, and the QC
+    montage of each atlas is written next to them.
+
+    Args:
+        work_dir (str): Work directory of the pipeline.
+        output_dir (str): Directory for the outputs.
+        ext (str, optional): Extension of the NIfTI intermediates.
+        threads (int, optional): Threads used to compress the atlases.
+    """
+    # PIL and matplotlib are only needed for the QC
+    from utils.Inspect_segmentations import QCMontage
+    from utils.publish import publish_file, publish_nifti
+
+    os.makedirs(output_dir, exist_ok=True)
+    bet_image = os.path.join(work_dir, nifti("native_bet_image", ext))
+    for atlas in (FINAL_ATLAS, FINAL_ATLAS_CALLOSUM):
+        atlas_path = os.path.join(work_dir, nifti(atlas, ext))
+        publish_nifti(atlas_path, os.path.join(output_dir, atlas), threads)
+        montage = "montage_" + nifti(atlas, "").lower() + ".png"
+        QCMontage(bet_image, atlas_path, os.path.join(output_dir, montage))
+    publish_file(os.path.join(work_dir, VOLUMES_NAME), os.path.join(output_dir, VOLUMES_NAME))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    from utils.parser import age_to_template
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="native space T2w input image")
+    parser.add_argument("age", help="template age, e.g. 12M, or age in months")
+    parser.add_argument("work_dir", nargs="?", default=WORK_DIR)
+    parser.add_argument("--output-dir", help="directory for the final atlases, volumes "
+                                             "and QC montages (default: the work directory)")
+    parser.add_argument("--threads", type=int, help="thread budget (default: the CPUs available)")
+    parser.add_argument("--storage", choices=STORAGE_POLICIES, default="compressed",
+                        help="storage policy of the intermediates")
+    parser.add_argument("--crop", action="store_true",
+                        help="run the heavy steps on the brain box instead of the full grid")
+    parser.add_argument("--preprocessing", choices=PREPROCESSING_MODES, default=DEFAULT_MODE,
+                        help="preprocessing mode")
+    parser.add_argument("--registration-preset", choices=REGISTRATION_PRESETS,
+                        default=DEFAULT_PRESET, help="registration speed preset")
+    parser.add_argument("--atropos-iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="maximum number of Atropos rounds")
+    parser.add_argument("--atropos-convergence", type=float, default=DEFAULT_CONVERGENCE,
+                        help="mean posterior change the Atropos rounds stop at")
+    parser.add_argument("--transform-cache", help="transform cache directory")
+    parser.add_argument("--transform-cache-size-gb", type=float,
+                        default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="size limit of the transform cache")
+    parser.add_argument("--template-store", help="template store shared by the runs of the node")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    budget = thread_budget(args.threads)
+    run_dir = resolve_work_dir(args.storage, args.work_dir, args.input)
+    run_ext = intermediate_ext(args.storage)
+    transform_cache = None
+    if args.transform_cache:
+        transform_cache = TransformCache(args.transform_cache,
+                                         args.transform_cache_size_gb * 1024 ** 3)
+    run_pipeline(args.input, age_to_template(args.age), work_dir=run_dir, threads=budget,
+                 ext=run_ext, crop=args.crop, preset=args.registration_preset,
+                 cache=transform_cache, atropos_iterations=args.atropos_iterations,
+                 atropos_convergence=args.atropos_convergence,
+                 preprocessing=args.preprocessing, template_store=args.template_store)
+    write_outputs(run_dir, args.output_dir or args.work_dir, run_ext, budget)
+    release_work_dir(run_dir)
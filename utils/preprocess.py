@@ -0,0 +1,218 @@
+"""Preprocessing modes: denoising, bias correction and brain extraction settings.
+
+Step 1 denoises the input, corrects its bias field and extracts the brain, all at
+the native resolution of the (usually upsampled) input. The modes trade the run
+time of these steps against the accuracy of the brain mask:
+
+* ``full``: the preprocessing of ``app/main.sh``, on the whole field of view.
+* ``reduced``: ``DenoiseImage`` and N4 are restricted to a coarse head mask,
+  computed from a 4x downsampled input; N4 fits its bias field on a 4x shrunk
+  grid with fewer iterations; SynthStrip runs on a 2x downsampled copy of the
+  bias corrected image and its mask is resampled back to the native grid.
+
+The settings of a mode can be tuned by passing a dict of them instead of its
+name (see ``preprocessing_settings``). ``python3 -m utils.benchmarks.preprocessing``
+measures the time saved by a mode and the Dice overlap of its brain mask and
+segmentation with those of ``full``.
+
+Example:
+    >>> settings = preprocessing_settings("reduced")
+    >>> make_head_mask("T2w.nii.gz", "work/head_mask.nii.gz")
+    >>> strip_brain("work/DN_BC.nii.gz", "work/native_bet_image.nii.gz",
+    ...             "work/native_brain_mask.nii.gz", factor=2)
+"""
+
+import argparse
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils.command_line import exec_command
+
+log = logging.getLogger(__name__)
+
+HEAD_MASK = "head_mask.nii.gz"
+
+PREPROCESSING_MODES = {
+    "full": {
+        "head_mask": False,
+        "n4_shrink_factor": None,
+        "n4_convergence": None,
+        "strip_factor": 1,
+    },
+    "reduced": {
+        "head_mask": True,
+        "n4_shrink_factor": 4,
+        "n4_convergence": "[50x50x30,1e-5]",
+        "strip_factor": 2,
+    },
+}
+DEFAULT_MODE = "full"
+
+# Coarse head mask: downsampling factor, threshold as a fraction of the 99th
+# intensity percentile, and dilations (of the downsampled voxels)
+HEAD_MASK_FACTOR = 4
+HEAD_MASK_FRACTION = 0.05
+HEAD_MASK_DILATIONS = 2
+# SynthStrip border of app/main.sh, in mm
+STRIP_BORDER = 2
+
+
+def preprocessing_settings(mode=DEFAULT_MODE):
+    """Get the settings of a preprocessing mode.
+
+    Args:
+        mode (str or dict): One of ``PREPROCESSING_MODES``, or settings overriding
+            those of ``full``.
+
+    Returns:
+        dict: The settings.
+
+    Raises:
+        ValueError: If the mode or a setting is unknown.
+    """
+    if isinstance(mode, dict):
+        unknown = set(mode) - set(PREPROCESSING_MODES[DEFAULT_MODE])
+        if unknown:
+            raise ValueError("Unknown preprocessing settings " + ", ".join(sorted(unknown)))
+        return dict(PREPROCESSING_MODES[DEFAULT_MODE], **mode)
+    if mode not in PREPROCESSING_MODES:
+        raise ValueError(f"Unknown preprocessing mode {mode!r}, expected one of "
+                         + ", ".join(PREPROCESSING_MODES))
+    return dict(PREPROCESSING_MODES[mode])
+
+
+def block_mean(data, factor):
+    """Downsample an array by averaging ``factor`` wide blocks of voxels.
+
+    The array is zero padded to a multiple of ``factor`` along each axis.
+    """
+    padded = np.pad(data, [(0, -n % factor) for n in data.shape])
+    shape = []
+    for n in padded.shape:
+        shape += [n // factor, factor]
+    return padded.reshape(shape).mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+def downsampled_affine(affine, factor):
+    """Get the affine of a grid downsampled by ``block_mean``."""
+    affine = affine.copy()
+    affine[:3, 3] += affine[:3, :3] @ np.full(3, (factor - 1) / 2)
+    affine[:3, :3] *= factor
+    return affine
+
+
+def _dilate(mask):
+    """Dilate a binary mask by one voxel with a 3x3x3 kernel."""
+    padded = np.pad(mask, 1)
+    dilated = np.zeros_like(mask)
+    for offset in np.ndindex(3, 3, 3):
+        dilated |= padded[tuple(slice(o, o + n) for o, n in zip(offset, mask.shape))]
+    return dilated
+
+
+def make_head_mask(image, output, factor=HEAD_MASK_FACTOR, fraction=HEAD_MASK_FRACTION,
+                   dilations=HEAD_MASK_DILATIONS):
+    """Write a coarse mask of the head, to restrict the denoising and N4 to.
+
+    The image is downsampled, thresholded above the background and dilated, and
+    the mask is brought back to the native grid.
+
+    Args:
+        image (str): Native space input image.
+        output (str): Path of the mask, on the grid of ``image``.
+        factor (int, optional): Downsampling factor.
+        fraction (float, optional): Threshold, as a fraction of the 99th
+            percentile of the downsampled image.
+        dilations (int, optional): Dilations of the downsampled mask.
+
+    Returns:
+        str: The ``output`` path.
+    """
+    img = nib.load(image)
+    data = np.asanyarray(img.dataobj, dtype=np.float32)
+    coarse = block_mean(data, factor)
+    foreground = coarse[coarse > 0]
+    threshold = fraction * np.percentile(foreground, 99) if foreground.size else 0
+    mask = coarse > threshold
+    for _ in range(dilations):
+        mask = _dilate(mask)
+    for axis in range(3):
+        mask = np.repeat(mask, factor, axis=axis)
+    mask = mask[tuple(slice(n) for n in data.shape)]
+    log.info("Head mask covers %.0f%% of the field of view", 100 * mask.mean())
+
+    out = nib.Nifti1Image(mask.astype(np.uint8), img.affine, img.header)
+    out.set_data_dtype(np.uint8)
+    nib.save(out, output)
+    return output
+
+
+def strip_brain(image, bet_image, mask, factor=2, border=STRIP_BORDER, environ=None):
+    """Extract the brain with SynthStrip on a downsampled copy of the image.
+
+    The brain mask is resampled back to the native grid with nearest neighbour
+    interpolation, and the brain extracted image is computed there.
+
+    Args:
+        image (str): Bias corrected native image.
+        bet_image (str): Path of the brain extracted image.
+        mask (str): Path of the brain mask.
+        factor (int, optional): Downsampling factor. 1 runs SynthStrip on the
+            native image.
+        border (int, optional): SynthStrip mask border, in mm.
+        environ (dict, optional): Environment of SynthStrip and
+            antsApplyTransforms, e.g. limiting their threads (see ``utils.threads``).
+
+    Returns:
+        tuple: The ``bet_image`` and ``mask`` paths.
+    """
+    if factor <= 1:
+        exec_command(["mri_synthstrip", "-i", image, "-o", bet_image, "-m", mask,
+                      "-b", str(border)], environ=environ)
+        return bet_image, mask
+
+    work_dir = os.path.dirname(os.path.abspath(mask))
+    coarse_image = os.path.join(work_dir, "synthstrip_input_coarse.nii")
+    coarse_mask = os.path.join(work_dir, "synthstrip_mask_coarse.nii")
+    img = nib.load(image)
+    data = np.asanyarray(img.dataobj, dtype=np.float32)
+    nib.save(nib.Nifti1Image(block_mean(data, factor),
+                             downsampled_affine(img.affine, factor)), coarse_image)
+    try:
+        exec_command(["mri_synthstrip", "-i", coarse_image, "-m", coarse_mask,
+                      "-b", str(border)], environ=environ)
+        exec_command(["antsApplyTransforms", "-d", "3", "-i", coarse_mask, "-r", image,
+                      "-o", mask, "-n", "NearestNeighbor", "-t", "identity",
+                      "-u", "uchar"], environ=environ)
+    finally:
+        for path in (coarse_image, coarse_mask):
+            if os.path.exists(path):
+                os.remove(path)
+
+    brain = np.asanyarray(nib.load(mask).dataobj) > 0
+    bet = nib.Nifti1Image(data * brain, img.affine, img.header)
+    bet.set_data_dtype(np.float32)
+    nib.save(bet, bet_image)
+    return bet_image, mask
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    head_parser = subparsers.add_parser("head_mask", help="write a coarse head mask")
+    head_parser.add_argument("image", help="native space input image")
+    head_parser.add_argument("output", help="head mask")
+    strip_parser = subparsers.add_parser("strip", help="run SynthStrip at low resolution")
+    strip_parser.add_argument("image", help="bias corrected image")
+    strip_parser.add_argument("bet_image", help="brain extracted image")
+    strip_parser.add_argument("mask", help="brain mask")
+    strip_parser.add_argument("--factor", type=int, default=2, help="downsampling factor")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.action == "head_mask":
+        make_head_mask(args.image, args.output)
+    else:
+        strip_brain(args.image, args.bet_image, args.mask, args.factor)
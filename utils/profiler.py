@@ -0,0 +1,185 @@
+"""Resource profiling of the pipeline commands and Python stages.
+
+When enabled, ``exec_command`` records the wall time, user/sys CPU time, peak RSS
+and block I/O of every child process (from ``wait4`` on the child), and the Python
+stages record the same measures through the ``span`` context manager. The records
+are written as a Chrome trace (``chrome://tracing`` or https://ui.perfetto.dev),
+tagged with the pipeline stage they belong to. The peak RSS of a child process is
+never below that of the gear process it was forked from, so small commands report
+the gear's footprint.
+
+Example:
+    >>> from utils import profiler
+    >>> profiler.enable("/flywheel/v0/output/pipeline_trace.json")
+    >>> with profiler.span("housekeeping"):
+    ...     housekeeping(demographics)
+    >>> profiler.write()
+"""
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+TRACE_NAME = "pipeline_trace.json"
+
+# Block I/O is counted by the kernel in 512 byte units
+_BLOCK_SIZE = 512
+# Per-thread CPU time where the platform supports it
+_RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+_tracer = None
+_local = threading.local()
+
+
+class Tracer:
+    """Collects trace events and writes them as a Chrome trace.
+
+    Args:
+        path (str): Where to write the trace.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, name, stage, start, end, **args):
+        """Record a complete event.
+
+        Args:
+            name (str): Event name.
+            stage (str): Pipeline stage, the event category.
+            start (float): Start, as ``time.time()``.
+            end (float): End, as ``time.time()``.
+            **args: Measures shown with the event.
+        """
+        event = {
+            "name": name,
+            "cat": stage or "pipeline",
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int((end - start) * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": dict(args, wall_s=round(end - start, 3)),
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def write(self):
+        """Write the trace, replacing any previous one atomically."""
+        with self._lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(trace, f)
+        os.replace(tmp_path, self.path)
+        log.info("Resource trace written to %s", self.path)
+
+
+def enable(path):
+    """Start profiling, collecting the events for a trace written to ``path``."""
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def disable():
+    """Stop profiling, discarding events not yet written."""
+    global _tracer
+    _tracer = None
+
+
+def active():
+    """Get the active tracer, or None when profiling is disabled."""
+    return _tracer
+
+
+def write():
+    """Write the trace of the active tracer, if any."""
+    if _tracer is not None:
+        _tracer.write()
+
+
+def current_stage():
+    """Get the stage of the innermost span open in this thread."""
+    return getattr(_local, "stage", None)
+
+
+def rusage_measures(usage):
+    """Convert a ``resource.struct_rusage`` to trace measures."""
+    return {
+        "user_cpu_s": round(usage.ru_utime, 3),
+        "sys_cpu_s": round(usage.ru_stime, 3),
+        "max_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "read_bytes": usage.ru_inblock * _BLOCK_SIZE,
+        "write_bytes": usage.ru_oublock * _BLOCK_SIZE,
+    }
+
+
+def record_process(command, stage, start, end, usage, returncode):
+    """Record a finished child process.
+
+    Args:
+        command (list): The command that was run.
+        stage (str): Pipeline stage, defaults to the stage of the open span.
+        start (float): Start, as ``time.time()``.
+        end (float): End, as ``time.time()``.
+        usage (resource.struct_rusage): Resource usage of the child from ``wait4``.
+        returncode (int): Exit code of the child.
+    """
+    if _tracer is None:
+        return
+    name = os.path.basename(command[0]) if isinstance(command, list) else command
+    _tracer.record(
+        name,
+        stage or current_stage(),
+        start,
+        end,
+        command=" ".join(command) if isinstance(command, list) else command,
+        returncode=returncode,
+        **rusage_measures(usage),
+    )
+
+
+@contextmanager
+def span(name, stage=None):
+    """Record a Python stage.
+
+    CPU time is that of the calling thread where the platform reports it, peak RSS
+    is that of the whole process. Commands run inside the span are tagged with its
+    stage.
+
+    Args:
+        name (str): Span name.
+        stage (str, optional): Pipeline stage. Defaults to ``name``.
+    """
+    stage = stage or name
+    previous = current_stage()
+    _local.stage = stage
+    start = time.time()
+    usage_start = resource.getrusage(_RUSAGE_THREAD)
+    try:
+        yield
+    finally:
+        _local.stage = previous
+        if _tracer is not None:
+            end = time.time()
+            usage = resource.getrusage(_RUSAGE_THREAD)
+            measures = {
+                "user_cpu_s": round(usage.ru_utime - usage_start.ru_utime, 3),
+                "sys_cpu_s": round(usage.ru_stime - usage_start.ru_stime, 3),
+                "max_rss_mb": round(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+                ),
+                "read_bytes": (usage.ru_inblock - usage_start.ru_inblock) * _BLOCK_SIZE,
+                "write_bytes": (usage.ru_oublock - usage_start.ru_oublock) * _BLOCK_SIZE,
+            }
+            _tracer.record(name, stage, start, end, **measures)
@@ -0,0 +1,190 @@
+"""Publishing of the gear outputs.
+
+Outputs are published as soon as the step producing them completes, rather than
+copied once the whole pipeline has finished, and every published file appears
+atomically: it is written under a temporary name in the output directory and
+renamed into place, so a run that fails part way leaves each output it finished
+complete, and none half written.
+
+A work file is published as a reflink (copy-on-write clone) on file systems
+supporting them (XFS, Btrfs), without copying its data, and as a copy otherwise.
+Work files are not moved, as later steps and the checkpoints still read them, and
+are not hard linked, as a step rerun in the same work directory would rewrite the
+published output in place. Uncompressed NIfTI intermediates are compressed on
+publishing instead (see ``utils.storage``).
+
+Example:
+    >>> publisher = Publisher(threads=8)
+    >>> publisher.expect(atlas, lambda: os.path.join(output_dir, label() + ".nii.gz"))
+    >>> run_pipeline(input_path, age, on_complete=publisher.step_complete)
+    >>> publisher.wait()
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from utils.storage import NIFTI_GZ, gzip_file
+
+log = logging.getLogger(__name__)
+
+# ioctl cloning a file's extents into another, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _temporary_path(path):
+    """Get a temporary name for ``path``, in the same directory."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+@contextmanager
+def atomic_write(path, mode="wb"):
+    """Open a file to write, replacing ``path`` with it only once it is complete.
+
+    Args:
+        path (str): File to write.
+        mode (str, optional): Mode the temporary file is opened in. Defaults to "wb".
+
+    Yields:
+        file: The open temporary file.
+    """
+    tmp_path = _temporary_path(path)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _reflink(src, dst):
+    """Clone ``src`` to the new file ``dst``, raising OSError where unsupported."""
+    import fcntl
+
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError:
+            fout.close()
+            os.remove(dst)
+            raise
+
+
+def publish_file(src, dst):
+    """Publish a file atomically, as a copy-on-write clone of ``src`` where possible.
+
+    Args:
+        src (str): File to publish.
+        dst (str): Published path, replaced if it exists.
+
+    Returns:
+        str: How the file was published: "reflink" or "copy".
+    """
+    tmp_path = _temporary_path(dst)
+    try:
+        try:
+            _reflink(src, tmp_path)
+            method = "reflink"
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+            method = "copy"
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return method
+
+
+def publish_nifti(src, dst, threads=1):
+    """Publish a NIfTI image as ``.nii.gz``, compressing it if it is not already.
+
+    Args:
+        src (str): Image in the work directory, ``.nii`` or ``.nii.gz``.
+        dst (str): Published ``.nii.gz`` path.
+        threads (int, optional): Threads used to compress. Defaults to 1.
+    """
+    start = time.time()
+    if src.endswith(NIFTI_GZ):
+        method = publish_file(src, dst)
+    else:
+        gzip_file(src, dst, threads)
+        method = f"gzip with {threads} thread(s)"
+    log.info("Published %s to %s (%s) in %.1f s", src, dst, method, time.time() - start)
+
+
+class Publisher:
+    """Publishes work files in the background as the steps producing them complete.
+
+    Args:
+        threads (int, optional): Threads used to compress NIfTI images.
+    """
+
+    def __init__(self, threads=1):
+        self.threads = threads
+        self._expected = {}
+        self._published = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="publish")
+
+    def expect(self, src, dst):
+        """Publish a work file once the step writing it completes.
+
+        Args:
+            src (str): Work file.
+            dst (str or callable): Published path, or a function returning it,
+                called when the file is published.
+        """
+        self._expected[src] = dst
+
+    def step_complete(self, step):
+        """Publish the expected outputs of a completed step, for ``run_graph``."""
+        for output in step.outputs:
+            if output in self._expected:
+                self.publish(output, self._expected[output])
+
+    def publish(self, src, dst):
+        """Publish a work file in the background, once.
+
+        Args:
+            src (str): Work file.
+            dst (str or callable): Published path, or a function returning it.
+
+        Returns:
+            concurrent.futures.Future: Completes with the published path.
+        """
+        with self._lock:
+            if src not in self._published:
+                self._published[src] = self._executor.submit(self._publish, src, dst)
+            return self._published[src]
+
+    def _publish(self, src, dst):
+        if callable(dst):
+            dst = dst()
+        if src.endswith((".nii", NIFTI_GZ)) and dst.endswith(NIFTI_GZ):
+            publish_nifti(src, dst, self.threads)
+        else:
+            publish_file(src, dst)
+        return dst
+
+    def wait(self):
+        """Wait for the files published so far.
+
+        Returns:
+            list: The published paths.
+
+        Raises:
+            Exception: The first error raised while publishing.
+        """
+        with self._lock:
+            futures = list(self._published.values())
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Wait for the files being published, then stop the background thread."""
+        self._executor.shutdown(wait=True)
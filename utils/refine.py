@@ -0,0 +1,216 @@
+"""In-memory refinement of the Atropos posteriors into the final segmentation atlas.
+
+Replaces Steps 4 and 5 of the original shell pipeline, which chained ~25
+``fslmaths``/``fslmerge`` calls through gzipped NIfTI files in the work directory.
+The three Atropos posteriors and the five warped template masks are each loaded
+once, the chain is evaluated as NumPy array operations with the same semantics as
+the fslmaths operators it replaces, and only the two final atlases are written.
+
+Labels of the final atlas:
+    1 supratentorial tissue, 2 supratentorial csf, 3 ventricles, 4 skull,
+    8-12 callosal segments, 17-20 and 27-30 subcortical GM,
+    31/32 cerebellum and cerebellum csf, 41/42 brainstem and brainstem csf.
+
+Example:
+    >>> from utils.refine import refine_segmentation
+    >>> refine_segmentation("/flywheel/v0/work")
+"""
+
+import argparse
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils.roi import load_rois, region
+from utils.storage import NIFTI_GZ, nifti
+
+log = logging.getLogger(__name__)
+
+WORK_DIR = "/flywheel/v0/work"
+POSTERIORS = tuple(f"ants_atropos_SegmentationPosteriors{i}.nii.gz" for i in (1, 2, 3))
+FINAL_ATLAS = "Final_segmentation_atlas.nii.gz"
+FINAL_ATLAS_CALLOSUM = "Final_segmentation_atlas_with_callosum.nii.gz"
+# Boxes of the warped masks (see utils.roi)
+WARPED_MASKS = "warped_masks.npz"
+
+VENTRICLES_MASK = "ventricles_mask_0p55mm"
+CALLOSUM_MASK = "callosum_mask_relabelled_padded_0p55mm"
+
+# Threshold of the summed posteriors (plus ventricle-masked csf) marking ventricles.
+VENTRICLE_THRESHOLD = 1.1
+
+# Label insertions applied in order to the tissue/csf/ventricle atlas. Each entry is
+# (mask, (lower, upper) atlas window, {product value: label increment}). The window
+# of the current atlas is multiplied by the mask; with no increment table the
+# product itself is added, otherwise each listed product value adds its increment.
+INSERTIONS = (
+    ("BCP_mask_padded_0p55mm", (1, 1), None),
+    ("cerebellum_mask_dilate_clean_padded_0p55mm", (1, 2), {30: 30, 60: 30}),
+    ("brainstem_mask_dilate_clean_padded_0p55mm", (1, 2), {40: 40, 80: 40}),
+)
+
+# Applied to the final atlas to add the callosal segments.
+CALLOSUM_INSERTION = (CALLOSUM_MASK, (1, 1), None)
+
+MASKS = (VENTRICLES_MASK,) + tuple(m for m, _, _ in INSERTIONS) + (CALLOSUM_MASK,)
+
+
+def _window(data, lower, upper):
+    """Zero values outside ``[lower, upper]``, as ``fslmaths -thr lower -uthr upper``."""
+    return np.where((data >= lower) & (data <= upper), data, 0).astype(np.float32)
+
+
+def _tmaxn(volumes):
+    """Index of the maximum volume at each voxel, as ``fslmaths -Tmaxn``.
+
+    Ties resolve to the first volume. The volumes are scanned one at a time so the
+    4D merge is never materialised.
+    """
+    volumes = iter(volumes)
+    best = np.array(next(volumes), dtype=np.float32)
+    index = np.zeros(best.shape, dtype=np.float32)
+    for n, volume in enumerate(volumes, start=1):
+        greater = volume > best
+        best[greater] = volume[greater]
+        index[greater] = n
+    return index
+
+
+def _tsum(volumes):
+    """Sum across volumes, as ``fslmaths -Tmean -mul <dim4>``."""
+    total = np.zeros(volumes[0].shape, dtype=np.float64)
+    for volume in volumes:
+        total += volume
+    n = np.float32(len(volumes))
+    return (total / len(volumes)).astype(np.float32) * n
+
+
+def insert_labels(atlas, mask, window, increments=None):
+    """Insert the labels of a mask into a window of the atlas.
+
+    Args:
+        atlas (numpy.ndarray): Current atlas, updated in place.
+        mask (numpy.ndarray): Warped template mask.
+        window (tuple): ``(lower, upper)`` atlas values the mask applies to.
+        increments (dict, optional): Mapping of ``window * mask`` product value to
+            the value added to the atlas. Defaults to adding the product itself.
+
+    Returns:
+        numpy.ndarray: The updated atlas.
+    """
+    product = _window(atlas, *window) * mask
+    if increments is None:
+        atlas += product
+    else:
+        for value, increment in increments.items():
+            atlas += _window(product, value, value) / value * increment
+    return atlas
+
+
+def build_atlas(posteriors, load_mask):
+    """Refine the Atropos posteriors into the final segmentation atlases.
+
+    Args:
+        posteriors (sequence of numpy.ndarray): Tissue, csf and skull posteriors.
+        load_mask (callable): Returns the region of the atlas a warped mask covers,
+            as a tuple of slices, and the mask values in it, for a mask name. Each
+            mask is requested once.
+
+    Returns:
+        tuple: ``(final_atlas, final_atlas_with_callosum)`` float32 arrays.
+    """
+    tissue, csf, skull = posteriors
+
+    # Ventricles: csf inside the ventricle mask where the summed posteriors exceed
+    # the threshold, the remaining csf stays supratentorial csf
+    box, mask = load_mask(VENTRICLES_MASK)
+    ventricles_mask = np.zeros(csf.shape, dtype=np.float32)
+    ventricles_mask[box] = csf[box] * mask
+    subtract_mask = _tsum([tissue, csf, ventricles_mask, skull]) >= np.float32(
+        VENTRICLE_THRESHOLD
+    )
+    del ventricles_mask
+    ventricles = csf * subtract_mask
+    csf = csf - ventricles
+    del subtract_mask
+
+    # Total tissue, csf, ventricles and skull labels
+    zero = np.zeros(tissue.shape, dtype=np.float32)
+    atlas = _tmaxn([zero, tissue, csf, ventricles, skull])
+    del zero, ventricles, csf
+
+    # Subcortical GM, cerebellum and brainstem, within the box of each mask
+    for mask_name, window, increments in INSERTIONS:
+        box, mask = load_mask(mask_name)
+        insert_labels(atlas[box], mask, window, increments)
+
+    # Callosal segments
+    mask_name, window, increments = CALLOSUM_INSERTION
+    atlas_callosum = atlas.copy()
+    box, mask = load_mask(mask_name)
+    insert_labels(atlas_callosum[box], mask, window, increments)
+    return atlas, atlas_callosum
+
+
+def _mask_loader(work_dir, ext=NIFTI_GZ):
+    """Get a loader for the warped masks, from their boxes when present."""
+    rois_path = os.path.join(work_dir, WARPED_MASKS)
+    if os.path.exists(rois_path):
+        rois = load_rois(rois_path)
+
+        def load_mask(name):
+            start, values, _ = rois[name]
+            return region(start, values), values.astype(np.float32)
+
+    else:
+
+        def load_mask(name):
+            path = os.path.join(work_dir, name + ext)
+            return (Ellipsis,), nib.load(path).get_fdata(dtype=np.float32)
+
+    return load_mask
+
+
+def refine_segmentation(work_dir=WORK_DIR, output_dir=None, ext=NIFTI_GZ):
+    """Build the final segmentation atlases from the Atropos output in ``work_dir``.
+
+    Args:
+        work_dir (str, optional): Directory holding the Atropos posteriors and the
+            warped masks, either as boxes or one file per mask. Defaults to
+            ``/flywheel/v0/work``.
+        output_dir (str, optional): Where to write the atlases. Defaults to
+            ``work_dir``.
+        ext (str, optional): Extension of the NIfTI files read and written, see
+            ``utils.storage``. Defaults to ``.nii.gz``.
+
+    Returns:
+        tuple: Paths to the final atlas and the final atlas with callosum.
+    """
+    output_dir = output_dir or work_dir
+    log.info("Refining segmentation posteriors in %s", work_dir)
+
+    posterior_imgs = [nib.load(os.path.join(work_dir, nifti(p, ext))) for p in POSTERIORS]
+    posteriors = [img.get_fdata(dtype=np.float32) for img in posterior_imgs]
+
+    atlas, atlas_callosum = build_atlas(posteriors, _mask_loader(work_dir, ext))
+
+    reference = posterior_imgs[0]
+    paths = []
+    for data, name in ((atlas, FINAL_ATLAS), (atlas_callosum, FINAL_ATLAS_CALLOSUM)):
+        img = nib.Nifti1Image(data, reference.affine, reference.header)
+        img.set_data_dtype(np.float32)
+        path = os.path.join(output_dir, nifti(name, ext))
+        nib.save(img, path)
+        log.info("Saved %s", path)
+        paths.append(path)
+    return tuple(paths)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("work_dir", nargs="?", default=WORK_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    refine_segmentation(args.work_dir)
@@ -0,0 +1,223 @@
+"""Sparse regions of interest for the template label masks.
+
+The label masks of a template (ventricles, subcortical GM, cerebellum, brainstem
+and callosum) each cover a small part of the 0.55 mm template grid. Rather than
+warping and multiplying them as full grids, each mask is stored as its bounding
+box: the voxel index of the box origin, the grid affine and the voxel values in
+the box. The template side is computed once per template (``build_template_rois``)
+and shared by the subjects like the prior stack.
+
+The masks are warped in process through the composed displacement field of
+``utils.transforms.compose_transforms`` with nearest neighbour interpolation, as
+``antsApplyTransforms -n NearestNeighbor`` does, but only inside the native box
+each template box warps to, found on a coarse subgrid of the field first. The
+warped masks are written to a single ``.npz`` of native boxes, which
+``utils.refine`` applies to the matching part of the atlas.
+
+Example:
+    >>> rois = build_template_rois("/flywheel/v0/app/templates/12M", "work/rois.npz")
+    >>> warp_rois(load_rois("work/rois.npz"), "work/native_warp.nii.gz",
+    ...           "work/warped_masks.npz")
+"""
+
+import argparse
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils.crop import bounding_box
+
+log = logging.getLogger(__name__)
+
+# Template mask boxes, shared between subjects
+TEMPLATE_ROIS = "template_masks_roi.npz"
+# Stride of the subgrid the warped boxes are located on, in native voxels
+SEARCH_STRIDE = 4
+# ITK fields and transforms are in LPS coordinates, NIfTI affines in RAS
+_LPS = np.array([-1.0, -1.0, 1.0])
+
+
+def mask_roi(data):
+    """Get the bounding box of the non-zero voxels of a mask.
+
+    Args:
+        data (numpy.ndarray): 3D mask.
+
+    Returns:
+        tuple: The ``start`` voxel index of the box and the voxel values in it,
+            an empty array for an empty mask.
+    """
+    if not np.any(data):
+        return np.zeros(3, dtype=np.int64), np.zeros((0, 0, 0), dtype=np.uint8)
+    box = bounding_box(data)
+    values = data[tuple(slice(a, b) for a, b in box)]
+    if np.array_equal(values, np.round(values)) and values.min() >= 0 and values.max() < 256:
+        values = values.astype(np.uint8)
+    return np.array([a for a, _ in box], dtype=np.int64), values
+
+
+def region(start, values):
+    """Get the slices of the grid a box covers."""
+    return tuple(slice(int(a), int(a) + n) for a, n in zip(start, values.shape))
+
+
+def save_rois(rois, output, shape=None, affine=None):
+    """Write boxes to a ``.npz``.
+
+    Args:
+        rois (dict): ``(start, values, affine)`` of each mask, by name.
+        output (str): Path of the ``.npz``.
+        shape (tuple, optional): Grid the boxes are on, when it is shared.
+        affine (numpy.ndarray, optional): Affine of that grid.
+
+    Returns:
+        str: The ``output`` path.
+    """
+    arrays = {}
+    for name, (start, values, roi_affine) in rois.items():
+        arrays[f"{name}.start"] = start
+        arrays[f"{name}.values"] = values
+        arrays[f"{name}.affine"] = roi_affine
+    if shape is not None:
+        arrays["shape"] = np.asarray(shape, dtype=np.int64)
+        arrays["affine"] = affine
+    np.savez(output, **arrays)
+    return output
+
+
+def load_rois(path):
+    """Read the boxes written by ``save_rois``.
+
+    Returns:
+        dict: ``(start, values, affine)`` of each mask, by name, in the order they
+            were written.
+    """
+    with np.load(path) as npz:
+        names = [key[: -len(".start")] for key in npz.files if key.endswith(".start")]
+        return {name: (npz[f"{name}.start"], npz[f"{name}.values"], npz[f"{name}.affine"])
+                for name in names}
+
+
+def build_template_rois(template_dir, output, names):
+    """Compute the boxes of the label masks of a template.
+
+    Args:
+        template_dir (str): Age specific template directory.
+        output (str): Path of the ``.npz`` to write.
+        names (sequence): Mask names, the files being ``<template_dir>/<name>.nii.gz``.
+
+    Returns:
+        str: The ``output`` path.
+    """
+    rois = {}
+    for name in names:
+        img = nib.load(os.path.join(template_dir, f"{name}.nii.gz"))
+        start, values = mask_roi(np.asanyarray(img.dataobj))
+        rois[name] = (start, values, img.affine)
+        log.info("%s: box of %s voxels, %.1f%% of the grid", name, values.shape,
+                 100 * values.size / np.prod(img.shape[:3]))
+    return save_rois(rois, output)
+
+
+def _template_voxels(field, native_affine, index):
+    """Map native voxel indices through the field to template world coordinates.
+
+    Args:
+        field (numpy.ndarray): Displacement field, (x, y, z, 3) in LPS mm.
+        native_affine (numpy.ndarray): Affine of the native grid.
+        index (tuple): Index arrays into the native grid, broadcast together.
+
+    Returns:
+        numpy.ndarray: RAS world coordinates, (..., 3).
+    """
+    grids = np.broadcast_arrays(*index)
+    voxels = np.stack(grids, axis=-1).astype(np.float64)
+    world = voxels @ native_affine[:3, :3].T + native_affine[:3, 3]
+    return world + field[index] * _LPS
+
+
+def _to_voxels(world, affine):
+    """Get the nearest voxel index of world coordinates on a grid."""
+    inverse = np.linalg.inv(affine)
+    voxels = world @ inverse[:3, :3].T + inverse[:3, 3]
+    return np.floor(voxels + 0.5).astype(np.int64)
+
+
+def warp_rois(rois, field_path, output, stride=SEARCH_STRIDE):
+    """Warp template mask boxes to native space with nearest neighbour interpolation.
+
+    Args:
+        rois (dict): Template boxes from ``load_rois``.
+        field_path (str): Composed displacement field on the native grid.
+        output (str): Path of the ``.npz`` of native boxes.
+        stride (int, optional): Stride of the subgrid the native boxes are
+            located on. The field is assumed smooth at that scale.
+
+    Returns:
+        str: The ``output`` path.
+    """
+    field_img = nib.load(field_path)
+    shape = field_img.shape[:3]
+    field = np.asanyarray(field_img.dataobj, dtype=np.float32).reshape(shape + (3,))
+    native_affine = field_img.affine
+
+    # Template coordinates of a coarse subgrid of the native grid
+    coarse_index = np.ix_(*(np.arange(0, n, stride) for n in shape))
+    coarse = _template_voxels(field, native_affine, coarse_index)
+
+    warped = {}
+    for name, (start, values, affine) in rois.items():
+        empty = (np.zeros(3, dtype=np.int64), np.zeros((0, 0, 0), dtype=values.dtype),
+                 native_affine)
+        if values.size == 0:
+            warped[name] = empty
+            continue
+        # Native voxels landing in the template box, grown by the subgrid stride
+        # converted to template voxels
+        scale = np.linalg.norm(native_affine[:3, :3], axis=0).max() / np.linalg.norm(
+            affine[:3, :3], axis=0).min()
+        grow = int(np.ceil(stride * scale)) + 1
+        coarse_voxels = _to_voxels(coarse, affine)
+        hits = np.all((coarse_voxels >= start - grow)
+                      & (coarse_voxels < start + values.shape + grow), axis=-1)
+        if not hits.any():
+            warped[name] = empty
+            continue
+        box = [[max(0, a * stride - stride), min(n, (b - 1) * stride + stride + 1)]
+               for (a, b), n in zip(bounding_box(hits), shape)]
+
+        # Nearest neighbour lookup of every native voxel of the box
+        index = np.ix_(*(np.arange(a, b) for a, b in box))
+        voxels = _to_voxels(_template_voxels(field, native_affine, index), affine) - start
+        inside = np.all((voxels >= 0) & (voxels < values.shape), axis=-1)
+        native = np.zeros(inside.shape, dtype=values.dtype)
+        native[inside] = values[tuple(voxels[inside].T)]
+
+        native_start, native_values = mask_roi(native)
+        if native_values.size == 0:
+            warped[name] = empty
+            continue
+        warped[name] = (native_start + [a for a, _ in box], native_values, native_affine)
+        log.info("Warped %s into a native box of %s voxels", name, native_values.shape)
+    return save_rois(warped, output, shape, native_affine)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    build_parser = subparsers.add_parser("build", help="compute the template mask boxes")
+    build_parser.add_argument("template_dir", help="age specific template directory")
+    build_parser.add_argument("output", help=".npz to write")
+    build_parser.add_argument("names", nargs="+", help="mask names")
+    warp_parser = subparsers.add_parser("warp", help="warp the boxes to native space")
+    warp_parser.add_argument("rois", help=".npz of the template boxes")
+    warp_parser.add_argument("field", help="composed displacement field")
+    warp_parser.add_argument("output", help=".npz of the native boxes")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.action == "build":
+        build_template_rois(args.template_dir, args.output, args.names)
+    else:
+        warp_rois(load_rois(args.rois), args.field, args.output)
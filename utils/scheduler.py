@@ -0,0 +1,120 @@
+"""Dependency-graph scheduler for pipeline steps.
+
+The dependencies between steps are derived from the files they declare: a step
+depends on every step producing one of its inputs. Steps whose dependencies have
+completed are started concurrently within a CPU thread budget. A step is complete
+when its process or function has returned and all of its declared outputs exist,
+so no fixed sleeps or file system syncs are needed between steps.
+
+Example:
+    >>> run_graph(build_steps(input_path, age), lambda step, threads: run_step(step))
+"""
+
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils.threads import available_cpus
+
+log = logging.getLogger(__name__)
+
+
+def dependencies(steps):
+    """Find the steps each step depends on.
+
+    Args:
+        steps (list): Objects with ``name``, ``inputs`` and ``outputs`` attributes.
+
+    Returns:
+        dict: Mapping of step name to the set of names of the steps it depends on.
+
+    Raises:
+        ValueError: If two steps write the same file.
+    """
+    producers = {}
+    for step in steps:
+        for output in step.outputs:
+            if output in producers:
+                raise ValueError(
+                    f"{output} is written by both {producers[output]} and {step.name}"
+                )
+            producers[output] = step.name
+    return {
+        step.name: {producers[i] for i in step.inputs if i in producers} - {step.name}
+        for step in steps
+    }
+
+
+def run_graph(steps, run, threads=None, on_complete=None):
+    """Run steps in dependency order, concurrently within a thread budget.
+
+    Ready steps are started in order of their requested threads (fewest first),
+    each granted its request or whatever remains of the budget. A step requesting
+    ``None`` threads asks for the whole budget. At least one thread is always
+    granted, so a step is never starved.
+
+    Args:
+        steps (list): Objects with ``name``, ``inputs``, ``outputs`` and ``threads``
+            attributes.
+        run (callable): Called as ``run(step, threads)`` to execute a step.
+        threads (int, optional): Thread budget. Defaults to the CPUs available to
+            the container.
+        on_complete (callable, optional): Called as ``on_complete(step)`` when a
+            step is complete, e.g. to publish its outputs. It should not block.
+
+    Raises:
+        RuntimeError: If the steps have a dependency cycle, or a step did not write
+            its declared outputs. Exceptions raised by ``run`` are re-raised once
+            the running steps have finished.
+    """
+    budget = threads or available_cpus()
+    depends_on = dependencies(steps)
+    pending = {step.name: step for step in steps}
+    done = set()
+    running = {}
+    error = None
+
+    def request(step):
+        return budget if step.threads is None else min(step.threads, budget)
+
+    with ThreadPoolExecutor(max_workers=len(steps) or 1) as pool:
+        while pending or running:
+            ready = [s for s in pending.values() if depends_on[s.name] <= done]
+            if error is None:
+                for step in sorted(ready, key=request):
+                    free = budget - sum(granted for _, granted in running.values())
+                    if running and free < 1:
+                        break
+                    granted = max(1, min(request(step), free))
+                    log.info("Starting step %s with %d thread(s)", step.name, granted)
+                    running[pool.submit(run, step, granted)] = (step, granted)
+                    del pending[step.name]
+
+            if not running:
+                if error is not None:
+                    break
+                raise RuntimeError(
+                    "Dependency cycle between steps: " + ", ".join(sorted(pending))
+                )
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                step, _ = running.pop(future)
+                try:
+                    future.result()
+                    missing = [o for o in step.outputs if not os.path.exists(o)]
+                    if missing:
+                        raise RuntimeError(
+                            f"Step {step.name} did not write " + ", ".join(missing)
+                        )
+                except Exception as exc:  # pylint: disable=broad-except
+                    log.error("Step %s failed: %s", step.name, exc)
+                    error = error or exc
+                else:
+                    log.info("Step %s complete", step.name)
+                    done.add(step.name)
+                    if on_complete is not None:
+                        on_complete(step)
+
+    if error is not None:
+        raise error
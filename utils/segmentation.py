@@ -0,0 +1,195 @@
+"""Atropos tissue segmentation of the bias corrected image, with early stopping.
+
+Replaces the ``antsAtroposN4.sh`` call of Step 3, which started from the raw input
+and so redid the denoising and bias correction of Step 1 in its N4 <-> Atropos
+loop. Here the loop starts from ``DN_BC``, the denoised and bias corrected image of
+Step 1:
+
+1. Atropos segments the image into tissue, csf and skull, initialised from the
+   warped priors, with the prior weight and MRF of ``antsAtroposN4.sh``.
+2. N4 then re-estimates the residual bias field of ``DN_BC``, weighted by the
+   tissue and csf posteriors, and Atropos segments the corrected image again.
+
+The loop stops after ``iterations`` rounds, or as soon as the posteriors change
+by less than ``convergence`` (mean absolute change within the mask) between two
+rounds. With ``iterations=1`` no N4 is run at all.
+
+Example:
+    >>> from utils.segmentation import segment_tissues
+    >>> segment_tissues("work/DN_BC.nii.gz", "work/native_brain_mask_dil.nii.gz",
+    ...                 "work/prior%d_scale.nii.gz", "work")
+"""
+
+import argparse
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils.command_line import exec_command
+from utils.refine import POSTERIORS
+from utils.storage import NIFTI_GZ, nifti
+
+log = logging.getLogger(__name__)
+
+WORK_DIR = "/flywheel/v0/work"
+ATROPOS_PREFIX = "ants_atropos_"
+# Image Atropos segmented last, as written by antsAtroposN4.sh
+CORRECTED = "ants_atropos_Segmentation0N4.nii.gz"
+N4_WEIGHT = "ants_atropos_N4Weight.nii.gz"
+
+# Outer N4 <-> Atropos rounds, those of antsAtroposN4.sh (-m 15), and the posterior
+# change they stop at
+DEFAULT_ITERATIONS = 15
+DEFAULT_CONVERGENCE = 0.001
+
+# Settings of antsAtroposN4.sh (-c 3 -w 0.3 -r [0.4,1x1x1] -y 1 -y 2)
+CLASSES = 3
+PRIOR_WEIGHT = 0.3
+MRF = "[0.4,1x1x1]"
+ATROPOS_CONVERGENCE = "[5,0.0]"
+N4_POSTERIORS = (1, 2)
+N4_CONVERGENCE = "[50x50x50x50,0.0000001]"
+N4_SHRINK_FACTOR = 4
+N4_BSPLINE = "[200]"
+
+
+def atropos_command(image, mask, priors, work_dir=WORK_DIR, ext=NIFTI_GZ):
+    """Build the Atropos command segmenting an image with the warped priors.
+
+    Args:
+        image (str): Image to segment.
+        mask (str): Mask the segmentation is restricted to.
+        priors (str): Pattern of the prior paths, e.g. ``work/prior%d_scale.nii.gz``.
+        work_dir (str, optional): Directory of the posteriors and segmentation.
+        ext (str, optional): Extension of the NIfTI files written.
+
+    Returns:
+        list: The command.
+    """
+    segmentation = os.path.join(work_dir, nifti(ATROPOS_PREFIX + "Segmentation.nii.gz", ext))
+    posteriors = os.path.join(work_dir, nifti(ATROPOS_PREFIX + "SegmentationPosteriors%d.nii.gz",
+                                              ext))
+    return [
+        "Atropos", "-d", "3",
+        "-a", image,
+        "-x", mask,
+        "-i", f"PriorProbabilityImages[{CLASSES},{priors},{PRIOR_WEIGHT}]",
+        "-k", "Gaussian",
+        "-c", ATROPOS_CONVERGENCE,
+        "-m", MRF,
+        "-p", "Socrates[1]",
+        "-e", "1",
+        "-o", f"[{segmentation},{posteriors}]",
+    ]
+
+
+def n4_command(image, mask, weight, output):
+    """Build the N4 command correcting the residual bias of an image.
+
+    Args:
+        image (str): Bias corrected image of Step 1.
+        mask (str): Mask the bias field is fitted in.
+        weight (str): Weight image, the sum of the tissue and csf posteriors.
+        output (str): Corrected image.
+
+    Returns:
+        list: The command.
+    """
+    return [
+        "N4BiasFieldCorrection", "-d", "3",
+        "-i", image,
+        "-x", mask,
+        "-w", weight,
+        "-s", str(N4_SHRINK_FACTOR),
+        "-c", N4_CONVERGENCE,
+        "-b", N4_BSPLINE,
+        "-o", output,
+    ]
+
+
+def _load_posteriors(paths, mask):
+    """Load the posteriors within the mask, stacked as one float32 array."""
+    return np.stack([np.asanyarray(nib.load(p).dataobj, dtype=np.float32)[mask]
+                     for p in paths])
+
+
+def segment_tissues(image, mask, priors, work_dir=WORK_DIR, ext=NIFTI_GZ,
+                    iterations=DEFAULT_ITERATIONS, convergence=DEFAULT_CONVERGENCE,
+                    environ=None):
+    """Segment the bias corrected image, alternating Atropos and N4 until converged.
+
+    Args:
+        image (str): Denoised and bias corrected image (``DN_BC``).
+        mask (str): Mask the segmentation is restricted to.
+        priors (str): Pattern of the warped prior paths, e.g.
+            ``work/prior%d_scale.nii.gz``.
+        work_dir (str, optional): Directory of the posteriors. Defaults to
+            ``/flywheel/v0/work``.
+        ext (str, optional): Extension of the NIfTI files written, see
+            ``utils.storage``. Defaults to ``.nii.gz``.
+        iterations (int, optional): Maximum number of Atropos rounds.
+        convergence (float, optional): Mean absolute change of the posteriors
+            within the mask below which the rounds stop. 0 runs all of them.
+        environ (dict, optional): Environment of Atropos and N4, e.g. limiting
+            their threads (see ``utils.threads``).
+
+    Returns:
+        list: Paths of the posteriors, in ``utils.refine.POSTERIORS`` order.
+    """
+    posteriors = [os.path.join(work_dir, nifti(p, ext)) for p in POSTERIORS]
+    corrected = os.path.join(work_dir, nifti(CORRECTED, ext))
+    weight = os.path.join(work_dir, nifti(N4_WEIGHT, ext))
+    inside = np.asanyarray(nib.load(mask).dataobj) > 0
+
+    previous = None
+    segmented = image
+    for i in range(max(1, iterations)):
+        if i:
+            # Posterior weighted correction of the bias left in DN_BC
+            first = nib.load(posteriors[N4_POSTERIORS[0] - 1])
+            data = sum(np.asanyarray(nib.load(posteriors[p - 1]).dataobj, dtype=np.float32)
+                       for p in N4_POSTERIORS)
+            nib.save(nib.Nifti1Image(data, first.affine, first.header), weight)
+            exec_command(n4_command(image, mask, weight, corrected), environ=environ)
+            segmented = corrected
+
+        exec_command(atropos_command(segmented, mask, priors, work_dir, ext),
+                     environ=environ)
+        current = _load_posteriors(posteriors, inside)
+        if previous is None:
+            log.info("Atropos round 1/%d done", iterations)
+        else:
+            change = float(np.mean(np.abs(current - previous))) if current.size else 0.0
+            log.info("Atropos round %d/%d: mean posterior change %.5f", i + 1, iterations,
+                     change)
+            if change < convergence:
+                log.info("Posteriors converged after %d rounds (change %.5f < %g)",
+                         i + 1, change, convergence)
+                break
+        previous = current
+    else:
+        if iterations > 1:
+            log.info("Posteriors did not converge within %d rounds", iterations)
+
+    for path in (weight, corrected):
+        if os.path.exists(path):
+            os.remove(path)
+    return posteriors
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image", help="denoised and bias corrected image (DN_BC)")
+    parser.add_argument("mask", help="mask the segmentation is restricted to")
+    parser.add_argument("priors", help="pattern of the warped priors, e.g. prior%%d_scale.nii.gz")
+    parser.add_argument("work_dir", nargs="?", default=WORK_DIR)
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="maximum number of Atropos rounds")
+    parser.add_argument("--convergence", type=float, default=DEFAULT_CONVERGENCE,
+                        help="mean posterior change the rounds stop at")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    segment_tissues(args.image, args.mask, args.priors, args.work_dir,
+                    iterations=args.iterations, convergence=args.convergence)
@@ -0,0 +1,264 @@
+"""Storage policy of the pipeline work directory.
+
+Every intermediate used to be written as ``.nii.gz``, so each hop between steps
+paid for a gzip compression and decompression. The ``storage`` gear config option
+selects how the intermediates are kept:
+
+* ``compressed``: ``.nii.gz`` intermediates in the work directory (the default).
+* ``uncompressed``: ``.nii`` intermediates in the work directory.
+* ``tmpfs``: ``.nii`` intermediates on the RAM backed ``/dev/shm``, falling back to
+  the work directory when it does not have room for them. The space is reserved
+  under a lock, so that the runs sharing a node do not all claim the same free
+  space, and is given back by ``release_work_dir`` once the outputs are published.
+
+Only the published outputs are compressed, with a multithreaded gzip (see
+``utils.publish``).
+
+Example:
+    >>> work_dir = resolve_work_dir("tmpfs", "/flywheel/v0/work", input_path)
+    >>> ext = intermediate_ext("tmpfs")
+    >>> gzip_file(os.path.join(work_dir, "atlas" + ext), "sub_atlas.nii.gz", 8)
+    >>> release_work_dir(work_dir)
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+STORAGE_POLICIES = ("compressed", "uncompressed", "tmpfs")
+NIFTI = ".nii"
+NIFTI_GZ = ".nii.gz"
+
+TMPFS_ROOT = "/dev/shm"
+# Space reserved on the tmpfs by each work directory, and the lock guarding it
+TMPFS_RESERVATIONS = "reservations.json"
+TMPFS_LOCK = ".lock"
+# Work files of a subject, in float32 copies of the input volume (the
+# intermediates, posteriors, warp fields and 4D prior and mask stacks)
+WORK_VOLUMES = 48
+
+# Size of the blocks compressed in parallel, and of the dictionary carried over
+# from the previous block so that the ratio matches a single stream
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_WINDOW = 32 * 1024
+
+
+def intermediate_ext(policy):
+    """Get the extension of the NIfTI intermediates under a storage policy."""
+    if policy not in STORAGE_POLICIES:
+        raise ValueError(f"Unknown storage policy {policy!r}, expected one of "
+                         + ", ".join(STORAGE_POLICIES))
+    return NIFTI_GZ if policy == "compressed" else NIFTI
+
+
+def nifti(name, ext):
+    """Give a NIfTI file name the extension ``ext``."""
+    for known in (NIFTI_GZ, NIFTI):
+        if name.endswith(known):
+            return name[: -len(known)] + ext
+    return name + ext
+
+
+def work_bytes(input_path):
+    """Estimate the space the work files of an input take up uncompressed."""
+    import nibabel as nib
+    import numpy as np
+
+    shape = nib.load(input_path).shape[:3]
+    return int(np.prod(shape)) * np.dtype(np.float32).itemsize * WORK_VOLUMES
+
+
+def _tmpfs_dir():
+    return os.path.join(TMPFS_ROOT, "minimorph")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _dir_bytes(path):
+    """Get the size of the files under a directory."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class _Reservations:
+    """Space reserved on the tmpfs by the work directories of the node.
+
+    The reservations are kept in a json file, read and written under an exclusive
+    lock, mapping each tmpfs work directory to the process using it and the
+    bytes it needs. Those of exited processes, or of removed directories, are
+    dropped when the file is read.
+    """
+
+    def __enter__(self):
+        root = _tmpfs_dir()
+        os.makedirs(root, exist_ok=True)
+        self._path = os.path.join(root, TMPFS_RESERVATIONS)
+        self._lock = open(os.path.join(root, TMPFS_LOCK), "a")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            with open(self._path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        self.entries = {path: entry for path, entry in entries.items()
+                        if _pid_alive(entry["pid"]) and os.path.isdir(path)}
+        return self
+
+    def outstanding(self):
+        """Get the reserved bytes not yet written to the tmpfs."""
+        return sum(max(0, entry["bytes"] - _dir_bytes(path))
+                   for path, entry in self.entries.items())
+
+    def __exit__(self, *exc):
+        try:
+            tmp_path = f"{self._path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self._path)
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+
+
+def resolve_work_dir(policy, work_dir, input_path):
+    """Get the work directory under a storage policy.
+
+    With the ``tmpfs`` policy the work directory is mirrored under ``/dev/shm``
+    when that has room for the estimated work files, after the space reserved by
+    the other runs of the node that they have not written yet, and the space is
+    reserved. Otherwise ``work_dir`` on disk is used.
+
+    Args:
+        policy (str): Storage policy, one of ``STORAGE_POLICIES``.
+        work_dir (str): Work directory on disk.
+        input_path (str): Input image, used to estimate the space needed.
+
+    Returns:
+        str: The work directory to use.
+    """
+    intermediate_ext(policy)
+    if policy != "tmpfs":
+        return work_dir
+
+    needed = work_bytes(input_path)
+    tmpfs_dir = os.path.join(_tmpfs_dir(), work_dir.lstrip(os.sep))
+    try:
+        with _Reservations() as reservations:
+            reservations.entries.pop(tmpfs_dir, None)
+            stat = os.statvfs(TMPFS_ROOT)
+            free = stat.f_bavail * stat.f_frsize - reservations.outstanding()
+            if free >= needed:
+                os.makedirs(tmpfs_dir, exist_ok=True)
+                # Files left by an earlier run of the directory are reused
+                reservations.entries[tmpfs_dir] = {"pid": os.getpid(), "bytes": needed}
+    except OSError:
+        free = 0
+    if free < needed:
+        log.warning("%s has %.0f MB free, %.0f MB needed; keeping the work files in %s",
+                    TMPFS_ROOT, max(free, 0) / 1e6, needed / 1e6, work_dir)
+        return work_dir
+
+    log.info("Keeping the work files in %s", tmpfs_dir)
+    return tmpfs_dir
+
+
+def release_work_dir(work_dir):
+    """Remove a tmpfs work directory and give back the space it reserved.
+
+    Work directories on disk are kept, for the checkpoints of later runs.
+
+    Args:
+        work_dir (str): Work directory from ``resolve_work_dir``.
+    """
+    tmpfs_dir = _tmpfs_dir()
+    if os.path.commonpath([os.path.abspath(work_dir), tmpfs_dir]) != tmpfs_dir:
+        return
+    log.info("Removing the work files in %s", work_dir)
+    with _Reservations() as reservations:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        reservations.entries.pop(work_dir, None)
+        # Remove the parents mirroring the disk path, unless other runs use them
+        parent = os.path.dirname(os.path.abspath(work_dir))
+        while parent != tmpfs_dir:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+
+def _deflate(block, dictionary, last, level):
+    """Deflate a block to a raw stream, ending it so that streams can be joined."""
+    options = {"zdict": dictionary} if dictionary else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, **options)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_file(src, dst, threads=1, level=6):
+    """Compress a file to gzip, deflating blocks of it in parallel.
+
+    Each block is deflated with the end of the previous block as its dictionary
+    and the raw streams are concatenated, as pigz does, so the result is a
+    standard single member gzip file. zlib releases the GIL, so the blocks are
+    compressed in a thread pool.
+
+    Args:
+        src (str): File to compress.
+        dst (str): Gzip file to write.
+        threads (int, optional): Number of blocks compressed at once.
+        level (int, optional): zlib compression level. Defaults to 6.
+    """
+    threads = max(1, int(threads or 1))
+    size = os.path.getsize(src)
+    crc = 0
+    header = b"\x1f\x8b\x08\x00" + struct.pack("<I", int(os.path.getmtime(src))) + b"\x00\xff"
+
+    tmp_path = dst + ".tmp"
+    with open(src, "rb") as fin, open(tmp_path, "wb") as fout, \
+            ThreadPoolExecutor(max_workers=threads) as pool:
+        fout.write(header)
+        if not size:
+            fout.write(_deflate(b"", b"", True, level))
+        offset = 0
+        dictionary = b""
+        while offset < size:
+            # Read a batch of blocks, two per thread, to bound memory
+            futures = []
+            for _ in range(2 * threads):
+                block = fin.read(GZIP_BLOCK_SIZE)
+                if not block:
+                    break
+                offset += len(block)
+                crc = zlib.crc32(block, crc)
+                futures.append(pool.submit(_deflate, block, dictionary, offset >= size,
+                                           level))
+                dictionary = block[-GZIP_WINDOW:]
+            if not futures:
+                raise OSError(f"{src} was truncated while being compressed")
+            for future in futures:
+                fout.write(future.result())
+        fout.write(struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF))
+    os.replace(tmp_path, dst)
+
@@ -0,0 +1,384 @@
+"""Registry of the age-specific template bundles.
+
+Each age directory of ``app/templates`` (a bundle) holds the template image, its
+brain mask, the three segmentation priors and the five label masks. The registry
+is built ahead of time, when the container image is built with the templates in
+its build context, and writes to every bundle:
+
+* ``index.json``: the role, path, sha256, size, modification time, grid shape,
+  affine and data type of every template file and derived product.
+* ``derived/``: products the pipeline otherwise recomputes or decompresses on
+  every run: uncompressed copies of the template image and brain mask, read by
+  the registration, and the prior stack and mask boxes of
+  ``utils.transforms.stack_templates``.
+
+At startup the bundle of the selected age is loaded and validated once: a missing
+age, file or index entry, a size that differs from the index, or a checksum that
+does not match, fails the run before the first step instead of partway through it.
+The files are hashed when they are indexed; at startup they are only stat'ed, and
+hashed again only when their modification time changed since (``python3 -m
+utils.templates verify`` hashes all of them). A bundle without an index is still
+usable, with its files checked for existence only.
+
+Subjects running concurrently on one node share a template store: a directory,
+e.g. on a mount every container sees, where the derived products of bundles
+without them (templates mounted rather than built into the image) are written
+once, read-only, and indexed by whichever run needs them first. Every run then
+reads the same uncompressed files, so the node keeps one page cache copy of each,
+and only the subject data grows with the number of runs.
+
+Example:
+    python3 -m utils.templates build /flywheel/v0/app/templates
+    python3 -m utils.templates verify /flywheel/v0/app/templates
+    python3 -m utils.templates store /flywheel/v0/app/templates --store /scratch/templates
+"""
+
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import nibabel as nib
+
+from utils.checkpoint import file_hash, record_hash
+from utils.publish import atomic_write
+from utils.refine import MASKS
+from utils.roi import TEMPLATE_ROIS
+from utils.transforms import PRIORS, PRIORS_STACK, stack_templates
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = "index.json"
+INDEX_VERSION = 1
+DERIVED_DIR = "derived"
+# Files read by the registration, kept uncompressed in the derived directory
+UNCOMPRESSED_ROLES = ("template", "brain_mask")
+
+
+def template_files(age):
+    """Get the file name of each role of a bundle.
+
+    Args:
+        age (str): Template age, e.g. "12M".
+
+    Returns:
+        dict: File names, relative to the bundle, by role.
+    """
+    files = {"template": f"template_{age}_degibbs_padded.nii.gz",
+             "brain_mask": "brainMask.nii.gz"}
+    files.update({name: f"{name}.nii.gz" for name in PRIORS + MASKS})
+    return files
+
+
+def _file_entry(path, root):
+    """Get the relative path, sha256, size and modification time of a file."""
+    stat = os.stat(path)
+    return {
+        "path": os.path.relpath(path, root),
+        "sha256": file_hash(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def describe(path, root):
+    """Describe a NIfTI file of a bundle for the index.
+
+    Args:
+        path (str): The file.
+        root (str): Bundle directory the path is recorded relative to.
+
+    Returns:
+        dict: The relative path, sha256, size, modification time, grid shape,
+            affine and data type.
+    """
+    img = nib.load(path)
+    return {
+        **_file_entry(path, root),
+        "shape": list(img.shape),
+        "affine": [[round(float(v), 6) for v in row] for row in img.affine],
+        "dtype": str(img.get_data_dtype()),
+    }
+
+
+def build_derived(template_dir, derived_dir, files):
+    """Write the derived products of a bundle.
+
+    Args:
+        template_dir (str): Bundle directory.
+        derived_dir (str): Directory to write the products to.
+        files (dict): Index entries of the bundle files, by role.
+
+    Returns:
+        dict: Index entries of the products, with their paths relative to the
+            parent of ``derived_dir``.
+    """
+    root = os.path.dirname(os.path.normpath(derived_dir))
+    os.makedirs(derived_dir, exist_ok=True)
+    derived = {}
+    for role in UNCOMPRESSED_ROLES:
+        src = os.path.join(template_dir, files[role]["path"])
+        dst = os.path.join(derived_dir, os.path.basename(src)[: -len(".gz")])
+        with gzip.open(src, "rb") as fin, atomic_write(dst) as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+        derived[role] = describe(dst, root)
+    stack_templates(template_dir, derived_dir)
+    priors_stack = os.path.join(derived_dir, PRIORS_STACK)
+    if os.path.exists(priors_stack):
+        derived["priors_stack"] = describe(priors_stack, root)
+    rois = os.path.join(derived_dir, TEMPLATE_ROIS)
+    derived["mask_rois"] = _file_entry(rois, root)
+    return derived
+
+
+def _bundle_paths(template_dir, age):
+    """Get the path of each role of a bundle, failing on the first one missing."""
+    paths = {}
+    for role, name in template_files(age).items():
+        paths[role] = os.path.join(template_dir, name)
+        if not os.path.exists(paths[role]):
+            raise FileNotFoundError(f"Template {age} lacks its {role} file {paths[role]}")
+    return paths
+
+
+def _describe_files(template_dir, age):
+    """Describe the files of a bundle, failing on the first one missing."""
+    return {role: describe(path, template_dir)
+            for role, path in _bundle_paths(template_dir, age).items()}
+
+
+def _store_key(template_dir, age):
+    """Key the store entry of a bundle on the path, size and mtime of its files."""
+    versions = {}
+    for role, path in _bundle_paths(template_dir, age).items():
+        stat = os.stat(path)
+        versions[role] = [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256(json.dumps(versions, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def build_index(template_dir, age=None):
+    """Write the derived products and the index of a bundle.
+
+    Args:
+        template_dir (str): Bundle directory.
+        age (str, optional): Template age. Defaults to the directory name.
+
+    Returns:
+        str: Path of the index.
+    """
+    age = age or os.path.basename(os.path.normpath(template_dir))
+    files = _describe_files(template_dir, age)
+    derived = build_derived(template_dir, os.path.join(template_dir, DERIVED_DIR), files)
+
+    index = {"version": INDEX_VERSION, "age": age, "files": files, "derived": derived}
+    index_path = os.path.join(template_dir, INDEX_NAME)
+    with atomic_write(index_path, "w") as f:
+        json.dump(index, f, indent=2)
+    log.info("Indexed template %s: %d files, %d derived", age, len(files), len(derived))
+    return index_path
+
+
+def shared_store(template_dir, age, store_root, files=None):
+    """Get the derived products of a bundle from a template store, writing them once.
+
+    The products are written to ``<store_root>/<age>-<key>`` by the first run to
+    need them, under a lock, and made read-only. The key covers the path, size
+    and modification time of the bundle files, so the files are hashed once, by
+    that run, and a bundle changed in place is written again. Concurrent runs wait
+    for it and then read the same files.
+
+    Args:
+        template_dir (str): Bundle directory.
+        age (str): Template age.
+        store_root (str): Template store, created if needed.
+        files (dict, optional): Index entries of the bundle files. Defaults to
+            those of the files as they are, described when the products are
+            written.
+
+    Returns:
+        str: Directory of the products, with an ``index.json`` of them.
+    """
+    key = _store_key(template_dir, age)
+    store_dir = os.path.join(store_root, f"{age}-{key}")
+    index_path = os.path.join(store_dir, INDEX_NAME)
+    if os.path.exists(index_path):
+        return store_dir
+
+    os.makedirs(store_root, exist_ok=True)
+    with open(os.path.join(store_root, f".{age}-{key}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(index_path):
+            log.info("Writing template %s to the template store %s", age, store_dir)
+            tmp_dir = f"{store_dir}.{os.getpid()}.tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            files = files or _describe_files(template_dir, age)
+            derived = build_derived(template_dir, os.path.join(tmp_dir, DERIVED_DIR), files)
+            with open(os.path.join(tmp_dir, INDEX_NAME), "w") as f:
+                json.dump({"version": INDEX_VERSION, "age": age, "files": files,
+                           "derived": derived}, f, indent=2)
+            for directory, _, names in os.walk(tmp_dir):
+                for name in names:
+                    os.chmod(os.path.join(directory, name), 0o444)
+            os.rename(tmp_dir, store_dir)
+    return store_dir
+
+
+class TemplateBundle:
+    """The validated files of an age-specific template.
+
+    Args:
+        template_dir (str): Bundle directory.
+        age (str): Template age.
+        index (dict, optional): Content of the bundle index, None without one.
+        derived_root (str, optional): Template store directory the derived
+            products are indexed relative to, when not in the bundle.
+    """
+
+    def __init__(self, template_dir, age, index=None, derived_root=None):
+        self.template_dir = template_dir
+        self.age = age
+        self.index = index
+        self.derived_root = derived_root
+
+    def path(self, role):
+        """Get the path the pipeline reads a role from, its derived copy if any."""
+        if self.index is not None and role in self.index["derived"]:
+            return os.path.join(self.derived_root or self.template_dir,
+                                self.index["derived"][role]["path"])
+        return os.path.join(self.template_dir, template_files(self.age)[role])
+
+    @property
+    def derived_dir(self):
+        """Get the directory of the derived products, None without an index."""
+        if self.index is None:
+            return None
+        return os.path.join(self.derived_root or self.template_dir, DERIVED_DIR)
+
+
+def _check_entries(entries, root, verify, checksums=False):
+    """List the indexed files that are missing or do not match their entry.
+
+    A file is hashed only when its modification time is not the indexed one, or
+    with ``checksums``. Otherwise the indexed sha256 is recorded as its hash, so
+    that the checkpoints do not hash it either.
+    """
+    errors = []
+    for role, entry in entries:
+        path = os.path.join(root, entry["path"])
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            errors.append(f"{role}: {path} is missing")
+            continue
+        if not verify:
+            continue
+        if "size" in entry and stat.st_size != entry["size"]:
+            errors.append(f"{role}: {path} is {stat.st_size} bytes, "
+                          f"indexed as {entry['size']}")
+        elif checksums or stat.st_mtime_ns != entry.get("mtime_ns"):
+            if file_hash(path, refresh=checksums) != entry["sha256"]:
+                errors.append(f"{role}: {path} does not match its checksum")
+        else:
+            record_hash(path, entry["sha256"], stat)
+    return errors
+
+
+def load_bundle(template_dir, age, verify=True, store=None, checksums=False):
+    """Load and validate the bundle of a template age.
+
+    Args:
+        template_dir (str): Bundle directory.
+        age (str): Template age the bundle must be for.
+        verify (bool, optional): Check the size of every indexed file, and its
+            sha256 when it was modified since it was indexed. Without it the
+            files are checked for existence only, e.g. for a bundle already
+            validated by the caller. Defaults to True.
+        store (str, optional): Template store the derived products of a bundle
+            without an index are read from, written there first if needed (see
+            ``shared_store``). Without one such a bundle is used as it is.
+        checksums (bool, optional): Check the sha256 of every indexed file.
+            Defaults to False.
+
+    Returns:
+        TemplateBundle: The bundle.
+
+    Raises:
+        FileNotFoundError: If the bundle or one of its files is missing.
+        ValueError: If the index is for another age, lacks a file, or a size or
+            checksum does not match.
+    """
+    if not os.path.isdir(template_dir):
+        root = os.path.dirname(os.path.normpath(template_dir))
+        ages = sorted(os.listdir(root)) if os.path.isdir(root) else []
+        raise FileNotFoundError(f"No template for age {age!r} in {template_dir}, "
+                                f"available: {', '.join(ages) or 'none'}")
+
+    index_path = os.path.join(template_dir, INDEX_NAME)
+    if not os.path.exists(index_path) and store:
+        store_dir = shared_store(template_dir, age, store)
+        with open(os.path.join(store_dir, INDEX_NAME)) as f:
+            index = json.load(f)
+        errors = _check_entries(index["derived"].items(), store_dir, verify, checksums)
+        if errors:
+            raise ValueError(f"Template {age} in the store {store_dir} is not as indexed "
+                             "(remove it to have it written again): " + "; ".join(errors))
+        log.info("Template %s read from the template store %s", age, store_dir)
+        return TemplateBundle(template_dir, age, index, store_dir)
+    if not os.path.exists(index_path):
+        log.warning("Template %s has no %s, checking its files exist only", age, INDEX_NAME)
+        missing = [os.path.join(template_dir, name) for name in template_files(age).values()
+                   if not os.path.exists(os.path.join(template_dir, name))]
+        if missing:
+            raise FileNotFoundError(f"Template {age} lacks " + ", ".join(missing))
+        return TemplateBundle(template_dir, age)
+
+    with open(index_path) as f:
+        index = json.load(f)
+    if index.get("age") != age:
+        raise ValueError(f"{index_path} indexes template {index.get('age')!r}, not {age!r}")
+    unindexed = set(template_files(age)) - set(index["files"])
+    if unindexed:
+        raise ValueError(f"{index_path} lacks " + ", ".join(sorted(unindexed)))
+
+    errors = _check_entries(list(index["files"].items()) + list(index["derived"].items()),
+                            template_dir, verify, checksums)
+    if errors:
+        raise ValueError(f"Template {age} in {template_dir} is not as indexed "
+                         f"(rebuild with python3 -m utils.templates build): "
+                         + "; ".join(errors))
+    log.info("Template %s validated from %s", age, index_path)
+    return TemplateBundle(template_dir, age, index)
+
+
+def bundle_dirs(templates_root):
+    """Get the bundle directories of a templates directory, by age."""
+    return {name: os.path.join(templates_root, name)
+            for name in sorted(os.listdir(templates_root))
+            if os.path.isdir(os.path.join(templates_root, name))}
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("action", choices=["build", "verify", "store"])
+    parser.add_argument("templates_root", help="directory of the age bundles")
+    parser.add_argument("--ages", nargs="+", help="ages to process (default: all)")
+    parser.add_argument("--store", help="template store of the node, for the store action")
+    args = parser.parse_args()
+    if args.action == "store" and not args.store:
+        parser.error("the store action needs --store")
+    logging.basicConfig(level=logging.INFO)
+    for bundle_age, bundle_dir in bundle_dirs(args.templates_root).items():
+        if args.ages and bundle_age not in args.ages:
+            continue
+        if args.action == "build":
+            print(build_index(bundle_dir, bundle_age))
+        elif args.action == "store":
+            # Directory of the derived products the pipeline reads
+            print(load_bundle(bundle_dir, bundle_age, store=args.store).derived_dir)
+        else:
+            load_bundle(bundle_dir, bundle_age, checksums=True)
+            print(f"{bundle_age}: ok")
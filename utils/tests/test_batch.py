@@ -0,0 +1,49 @@
+"""Reading the subjects of a batch."""
+
+import pytest
+
+from utils.batch import read_jobs
+from utils.parser import age_to_template
+
+
+def _csv(tmp_path, rows):
+    path = tmp_path / "cohort.csv"
+    path.write_text("\n".join(["input,age,subject,session,acquisition"] + rows) + "\n")
+    return str(path)
+
+
+def test_jobs_are_named_after_their_labels(tmp_path):
+    jobs = read_jobs(_csv(tmp_path, ["a/T2w.nii.gz,12,s1,v1,T2w",
+                                     "b/T2w.nii.gz,3M,s2,v1,T2w"]))
+    assert [job["job"] for job in jobs] == ["sub-s1_ses-v1_acq-T2w",
+                                            "sub-s2_ses-v1_acq-T2w"]
+    assert [job["age"] for job in jobs] == ["12M", "3M"]
+
+
+def test_duplicate_labels_are_rejected(tmp_path):
+    # Both acquisitions default to the input basename
+    with pytest.raises(ValueError, match="sub-s1_ses-v1_acq-T2w"):
+        read_jobs(_csv(tmp_path, ["a/T2w.nii.gz,12,s1,v1,", "b/T2w.nii.gz,12,s1,v1,"]))
+
+
+def test_directory_inputs_use_the_basename(tmp_path):
+    for name in ("one.nii.gz", "two.nii"):
+        (tmp_path / name).write_bytes(b"")
+    jobs = read_jobs(str(tmp_path), age="6M")
+    assert [job["job"] for job in jobs] == ["sub-one_ses-one_acq-one",
+                                            "sub-two_ses-two_acq-two"]
+    with pytest.raises(ValueError):
+        read_jobs(str(tmp_path))
+
+
+@pytest.mark.parametrize("age, template", [(0, "3M"), ("4.9", "3M"), (9, "6M"),
+                                           (15.5, "12M"), (21, "18M"), (22, "24M"),
+                                           (64, "24M"), ("18M", "18M")])
+def test_age_to_template(age, template):
+    assert age_to_template(age) == template
+
+
+@pytest.mark.parametrize("age", [float("nan"), "nan", "inf", "unknown"])
+def test_age_to_template_rejects_non_ages(age):
+    with pytest.raises(ValueError):
+        age_to_template(age)
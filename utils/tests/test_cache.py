@@ -0,0 +1,95 @@
+"""Transform cache: misses, hits and least recently used eviction."""
+
+import os
+import shutil
+
+from utils import cache
+from utils.cache import ENTRY_NAME, TransformCache, cache_key
+
+NAMES = ("DN_BC.nii.gz", "bet0GenericAffine.mat", "bet1InverseWarp.nii.gz")
+SIZE = 1000
+
+
+def _files(directory, content=b"x"):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name in NAMES:
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(content * SIZE)
+        paths.append(path)
+    return paths
+
+
+def _age(transform_cache, key, seconds):
+    """Set the last use of an entry ``seconds`` back."""
+    manifest = os.path.join(transform_cache.directory, key, ENTRY_NAME)
+    last_use = os.path.getmtime(manifest) - seconds
+    os.utime(manifest, (last_use, last_use))
+
+
+def test_miss_restores_nothing(tmp_path):
+    transform_cache = TransformCache(str(tmp_path / "cache"))
+    files = [str(tmp_path / "work" / name) for name in NAMES]
+    assert not transform_cache.restore(cache_key({"input": "a"}), files)
+    assert not (tmp_path / "work").exists()
+
+
+def test_hit_restores_the_stored_files(tmp_path):
+    transform_cache = TransformCache(str(tmp_path / "cache"))
+    key = cache_key({"input": "a"})
+    transform_cache.store(key, _files(str(tmp_path / "first"), b"a"), {"input": "a"})
+    _age(transform_cache, key, 100)
+    before = transform_cache.entries()[0][0]
+
+    files = [str(tmp_path / "second" / name) for name in NAMES]
+    assert transform_cache.restore(key, files)
+    for path in files:
+        with open(path, "rb") as f:
+            assert f.read() == b"a" * SIZE
+    # The hit counts as a use
+    assert transform_cache.entries()[0][0] > before
+
+
+def test_the_least_recently_used_entries_are_evicted(tmp_path):
+    # Room for two entries and the manifests
+    transform_cache = TransformCache(str(tmp_path / "cache"),
+                                     max_bytes=2 * len(NAMES) * SIZE + 1000)
+    keys = [cache_key({"input": name}) for name in "abc"]
+    transform_cache.store(keys[0], _files(str(tmp_path / "a")))
+    _age(transform_cache, keys[0], 300)
+    transform_cache.store(keys[1], _files(str(tmp_path / "b")))
+    _age(transform_cache, keys[1], 200)
+    # The oldest entry is used again, so the second one is now the least recent
+    assert transform_cache.restore(keys[0], [str(tmp_path / "work" / n) for n in NAMES])
+    transform_cache.store(keys[2], _files(str(tmp_path / "c")))
+
+    assert sorted(key for _, _, key in transform_cache.entries()) == sorted(
+        [keys[0], keys[2]])
+    assert not os.path.exists(os.path.join(transform_cache.directory, keys[1]))
+
+
+def test_the_entry_just_stored_is_never_evicted(tmp_path):
+    transform_cache = TransformCache(str(tmp_path / "cache"), max_bytes=0)
+    first, second = cache_key({"input": "a"}), cache_key({"input": "b"})
+    transform_cache.store(first, _files(str(tmp_path / "a")))
+    assert [key for _, _, key in transform_cache.entries()] == [first]
+    _age(transform_cache, first, 100)
+
+    transform_cache.store(second, _files(str(tmp_path / "b")))
+    assert [key for _, _, key in transform_cache.entries()] == [second]
+
+
+def test_an_entry_evicted_while_restoring_is_a_miss(tmp_path, monkeypatch):
+    transform_cache = TransformCache(str(tmp_path / "cache"))
+    key = cache_key({"input": "a"})
+    transform_cache.store(key, _files(str(tmp_path / "a")))
+    copy2 = shutil.copy2
+
+    def evicting_copy(source, destination):
+        # A concurrent run evicts the entry after the first file is copied
+        copy2(source, destination)
+        shutil.rmtree(os.path.join(transform_cache.directory, key))
+
+    monkeypatch.setattr(cache.shutil, "copy2", evicting_copy)
+    assert not transform_cache.restore(key, [str(tmp_path / "work" / n) for n in NAMES])
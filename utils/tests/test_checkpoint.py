@@ -0,0 +1,57 @@
+"""Checkpoint freshness: a stage is skipped only while nothing it depends on changed."""
+
+import os
+
+from utils.checkpoint import Checkpoint
+
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _stage(tmp_path, params=None):
+    return Checkpoint("stage", [str(tmp_path / "in.txt")], [str(tmp_path / "out.txt")],
+                      params or {"command": ["tool", "-x", "1"]}, directory=str(tmp_path))
+
+
+def _run(tmp_path, params=None):
+    _write(tmp_path / "in.txt", "input")
+    _write(tmp_path / "out.txt", "output")
+    checkpoint = _stage(tmp_path, params)
+    checkpoint.save()
+    return checkpoint
+
+
+def test_fresh_once_saved(tmp_path):
+    _write(tmp_path / "in.txt", "input")
+    _write(tmp_path / "out.txt", "output")
+    assert not _stage(tmp_path).is_fresh()
+    _stage(tmp_path).save()
+    assert _stage(tmp_path).is_fresh()
+
+
+def test_stale_when_the_input_changes(tmp_path):
+    _run(tmp_path)
+    _write(tmp_path / "in.txt", "another input")
+    assert not _stage(tmp_path).is_fresh()
+
+
+def test_stale_when_the_params_change(tmp_path):
+    _run(tmp_path)
+    assert not _stage(tmp_path, {"command": ["tool", "-x", "2"]}).is_fresh()
+
+
+def test_stale_when_an_output_is_modified_or_missing(tmp_path):
+    _run(tmp_path)
+    _write(tmp_path / "out.txt", "edited output")
+    assert not _stage(tmp_path).is_fresh()
+    _run(tmp_path)
+    os.remove(tmp_path / "out.txt")
+    assert not _stage(tmp_path).is_fresh()
+
+
+def test_invalidate(tmp_path):
+    checkpoint = _run(tmp_path)
+    checkpoint.invalidate()
+    assert not _stage(tmp_path).is_fresh()
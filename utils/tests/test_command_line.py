@@ -0,0 +1,35 @@
+"""stderr capture of exec_command."""
+
+import sys
+
+import pytest
+
+from utils.command_line import STDERR_TAIL_LINES, exec_command
+
+LINES = STDERR_TAIL_LINES + 50
+
+
+def _command(code=0):
+    script = (f"import sys\nfor i in range({LINES}): print(i, file=sys.stderr)\n"
+              f"print('done')\nsys.exit({code})")
+    return [sys.executable, "-c", script]
+
+
+def test_stderr_is_kept_whole_without_continuous_output():
+    stdout, stderr, returncode = exec_command(_command())
+    assert stdout == "done\n"
+    assert stderr.splitlines() == [str(i) for i in range(LINES)]
+    assert returncode == 0
+
+
+def test_continuous_output_keeps_the_stderr_tail():
+    stdout, stderr, _ = exec_command(_command(), cont_output=True)
+    assert stdout == ""
+    assert stderr.splitlines() == [str(i) for i in range(50, LINES)]
+
+
+def test_the_error_holds_the_whole_stderr():
+    with pytest.raises(RuntimeError) as error:
+        exec_command(_command(3))
+    assert "\n0\n1\n" in str(error.value)
+    assert f"\n{LINES - 1}\n" in str(error.value)
@@ -0,0 +1,67 @@
+"""Cropping to the brain box and pasting back to the native grid."""
+
+import nibabel as nib
+import numpy as np
+
+from utils.crop import bounding_box, crop_images, uncrop_image
+
+
+def _native(tmp_path):
+    affine = np.array([[-0.5, 0, 0, 30], [0, 0.5, 0, -20], [0, 0, 0.6, -10], [0, 0, 0, 1]])
+    shape = (40, 44, 36)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[12:25, 10:30, 8:20] = 1
+    image = np.random.default_rng(0).random(shape).astype(np.float32)
+    paths = {}
+    for name, data in (("mask", mask), ("image", image)):
+        paths[name] = str(tmp_path / f"{name}.nii.gz")
+        nib.save(nib.Nifti1Image(data, affine), paths[name])
+    return paths, mask, image, affine
+
+
+def test_bounding_box():
+    mask = np.zeros((10, 10, 10), dtype=bool)
+    mask[2:5, 3, 7:9] = True
+    assert bounding_box(mask) == [[2, 5], [3, 4], [7, 9]]
+    assert bounding_box(mask, (3, 3, 3)) == [[0, 8], [0, 7], [4, 10]]
+    assert bounding_box(np.zeros((4, 5, 6))) == [[0, 4], [0, 5], [0, 6]]
+
+
+def test_crop_keeps_world_coordinates(tmp_path):
+    paths, _, image, affine = _native(tmp_path)
+    cropped = str(tmp_path / "cropped.nii.gz")
+    box = crop_images(paths["mask"], {paths["image"]: cropped}, str(tmp_path / "box.json"),
+                      margin_mm=2)
+    img = nib.load(cropped)
+    start = np.array([a for a, _ in box])
+    assert np.allclose(img.affine[:3, 3], affine[:3, :3] @ start + affine[:3, 3])
+    assert np.array_equal(img.get_fdata(dtype=np.float32),
+                          image[tuple(slice(a, b) for a, b in box)])
+
+
+def test_uncrop_inverts_crop(tmp_path):
+    paths, _, image, affine = _native(tmp_path)
+    cropped = str(tmp_path / "cropped.nii.gz")
+    box_path = str(tmp_path / "box.json")
+    box = crop_images(paths["mask"], {paths["image"]: cropped}, box_path, margin_mm=2)
+    output = str(tmp_path / "uncropped.nii.gz")
+    uncrop_image(cropped, paths["image"], output, box_path)
+
+    img = nib.load(output)
+    inside = np.zeros(image.shape, dtype=bool)
+    inside[tuple(slice(a, b) for a, b in box)] = True
+    data = img.get_fdata(dtype=np.float32)
+    assert img.shape == image.shape
+    assert np.allclose(img.affine, affine)
+    assert np.array_equal(data[inside], image[inside])
+    assert not data[~inside].any()
+
+
+def test_whole_grid_box_is_identity(tmp_path):
+    paths, _, image, _ = _native(tmp_path)
+    cropped = str(tmp_path / "cropped.nii.gz")
+    box_path = str(tmp_path / "box.json")
+    crop_images(paths["mask"], {paths["image"]: cropped}, box_path, margin_mm=100)
+    output = str(tmp_path / "uncropped.nii.gz")
+    uncrop_image(cropped, paths["image"], output, box_path)
+    assert np.array_equal(nib.load(output).get_fdata(dtype=np.float32), image)
@@ -0,0 +1,85 @@
+"""Demographics lookup in the background of the pipeline."""
+
+import os
+import threading
+from concurrent.futures import Future
+
+import pandas as pd
+import pytest
+
+from utils import parser, pipeline
+from utils.context import OfflineContext, write_gear_dir
+from utils.templates import template_files
+
+AGE = "12M"
+PREPROCESSING = ["denoise", "n4", "synthstrip", "brain_mask_dilation"]
+
+
+@pytest.fixture
+def slow_lookup(monkeypatch):
+    """Hold the demographics lookup until the returned event is set."""
+    release = threading.Event()
+
+    def pull_demographics(gear_context):
+        assert release.wait(10)
+        return pd.DataFrame([{"subject": "s1", "session": "v1", "acquisition": "T2w",
+                              "age": 14}])
+
+    monkeypatch.setattr(parser, "pull_demographics", pull_demographics)
+    monkeypatch.setattr(parser, "limit_process_threads", lambda threads: None)
+    yield release
+    release.set()
+
+
+def _context(tmp_path, age):
+    image = tmp_path / "T2w.nii.gz"
+    image.write_bytes(b"")
+    return OfflineContext(write_gear_dir(str(tmp_path / "gear"), str(image),
+                                         config={"age": age}))
+
+
+def test_the_age_is_a_future_of_the_lookup(tmp_path, slow_lookup):
+    _, age, demographics, _ = parser.parse_config(_context(tmp_path, "None"))
+    assert isinstance(age, Future) and not age.done()
+    assert not demographics.done()
+
+    slow_lookup.set()
+    assert age.result(10) == AGE
+    assert demographics.result()["subject"].values[0] == "s1"
+
+
+def test_a_configured_age_does_not_wait_for_the_lookup(tmp_path, slow_lookup):
+    _, age, demographics, _ = parser.parse_config(_context(tmp_path, "6M"))
+    assert age == "6M"
+    assert not demographics.done()
+
+
+def test_preprocessing_runs_while_the_age_is_pending(tmp_path, monkeypatch):
+    templates = tmp_path / "templates"
+    (templates / AGE).mkdir(parents=True)
+    for name in template_files(AGE).values():
+        (templates / AGE / name).write_bytes(b"")
+    input_path = tmp_path / "T2w.nii.gz"
+    input_path.write_bytes(b"")
+    monkeypatch.setattr(pipeline, "TEMPLATES_DIR", str(templates))
+
+    age = Future()
+    ran = []
+
+    def run_step(step, work_dir, threads=1):
+        ran.append((step.name, age.done()))
+        for output in step.outputs:
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            open(output, "a").close()
+        if step.name == "brain_mask_dilation" and not age.done():
+            age.set_result(AGE)
+
+    monkeypatch.setattr(pipeline, "run_step", run_step)
+    pipeline.run_pipeline(str(input_path), age, work_dir=str(tmp_path / "work"),
+                          threads=1)
+
+    pending = [name for name, done in ran if not done]
+    assert sorted(pending) == sorted(PREPROCESSING)
+    # Every step using the template waited for the age
+    assert ("registration", True) in ran and ("registration", False) not in ran
+    assert ran[:len(PREPROCESSING)] == [(name, False) for name in pending]
@@ -0,0 +1,61 @@
+"""Running steps: thread environment and checkpoints."""
+
+import json
+
+from utils.pipeline import Step, run_step
+
+_calls = []
+
+
+def _write(output, value, environ=None):
+    _calls.append(environ)
+    with open(output, "w") as f:
+        json.dump(value, f)
+
+
+def _write_only(output, value):
+    _calls.append(None)
+    with open(output, "w") as f:
+        json.dump(value, f)
+
+
+def _step(tmp_path, func=_write, value=1):
+    output = str(tmp_path / "out.json")
+    return Step("write", [], [output], func=func, kwargs={"output": output, "value": value})
+
+
+def test_func_steps_get_the_thread_environment(tmp_path):
+    _calls.clear()
+    run_step(_step(tmp_path), str(tmp_path), threads=3)
+    assert _calls[0]["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] == "3"
+    assert _calls[0]["OMP_NUM_THREADS"] == "3"
+
+
+def test_the_environment_is_not_checkpointed(tmp_path):
+    _calls.clear()
+    run_step(_step(tmp_path), str(tmp_path), threads=2)
+    run_step(_step(tmp_path), str(tmp_path), threads=4)
+    assert len(_calls) == 1
+    run_step(_step(tmp_path, value=2), str(tmp_path), threads=4)
+    assert len(_calls) == 2
+
+
+def test_funcs_without_environ_are_called_as_declared(tmp_path):
+    _calls.clear()
+    run_step(_step(tmp_path, _write_only), str(tmp_path), threads=2)
+    assert _calls == [None]
+
+
+def _count(output, value, threads=1):
+    _calls.append(threads)
+    with open(output, "w") as f:
+        json.dump(value, f)
+
+
+def test_funcs_are_granted_the_step_threads(tmp_path):
+    _calls.clear()
+    run_step(_step(tmp_path, _count), str(tmp_path), threads=2)
+    run_step(_step(tmp_path, _count), str(tmp_path), threads=6)
+    assert _calls == [2]
+    run_step(_step(tmp_path, _count, value=2), str(tmp_path), threads=6)
+    assert _calls == [2, 6]
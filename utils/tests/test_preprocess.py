@@ -0,0 +1,93 @@
+"""Reduced preprocessing: downsampled SynthStrip and the head mask."""
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils import preprocess
+from utils.pipeline import build_steps
+
+SHAPE = (8, 10, 12)
+
+
+def _image(tmp_path):
+    data = np.zeros(SHAPE, np.float32)
+    data[2:6, 2:8, 2:10] = np.arange(1, 4 * 6 * 8 + 1).reshape(4, 6, 8)
+    path = str(tmp_path / "DN_BC.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.diag([0.5, 0.5, 0.5, 1])), path)
+    return path, data
+
+
+def test_synthstrip_runs_downsampled_and_its_mask_is_upsampled(tmp_path, monkeypatch):
+    image, data = _image(tmp_path)
+    calls = []
+
+    def fake_exec(command, environ=None, **kwargs):
+        calls.append(command)
+        if command[0] == "mri_synthstrip":
+            coarse = nib.load(command[command.index("-i") + 1])
+            assert coarse.shape == (4, 5, 6)
+            assert np.allclose(coarse.header.get_zooms(), 1.0)
+            mask = (np.asanyarray(coarse.dataobj) > 0).astype(np.uint8)
+            nib.save(nib.Nifti1Image(mask, coarse.affine),
+                     command[command.index("-m") + 1])
+        else:
+            # Nearest neighbour upsampling of the coarse mask onto the reference grid
+            coarse = np.asanyarray(nib.load(command[command.index("-i") + 1]).dataobj)
+            reference = nib.load(command[command.index("-r") + 1])
+            mask = coarse.repeat(2, 0).repeat(2, 1).repeat(2, 2)
+            nib.save(nib.Nifti1Image(mask, reference.affine),
+                     command[command.index("-o") + 1])
+
+    monkeypatch.setattr(preprocess, "exec_command", fake_exec)
+    bet_image = str(tmp_path / "native_bet_image.nii.gz")
+    mask = str(tmp_path / "native_brain_mask.nii.gz")
+    preprocess.strip_brain(image, bet_image, mask, factor=2)
+
+    assert [command[0] for command in calls] == ["mri_synthstrip", "antsApplyTransforms"]
+    resample = calls[1]
+    assert resample[resample.index("-n") + 1] == "NearestNeighbor"
+    assert resample[resample.index("-r") + 1] == image
+    assert resample[resample.index("-t") + 1] == "identity"
+    # The mask is back on the native grid and the brain is extracted there
+    brain = np.asanyarray(nib.load(mask).dataobj) > 0
+    assert brain.shape == SHAPE
+    assert np.array_equal(nib.load(bet_image).get_fdata(), data * brain)
+    # The downsampled files are removed
+    assert sorted(os.listdir(tmp_path)) == ["DN_BC.nii.gz", "native_bet_image.nii.gz",
+                                            "native_brain_mask.nii.gz"]
+
+
+def test_synthstrip_runs_natively_with_factor_one(tmp_path, monkeypatch):
+    image, _ = _image(tmp_path)
+    calls = []
+    monkeypatch.setattr(preprocess, "exec_command",
+                        lambda command, environ=None, **kwargs: calls.append(command))
+    preprocess.strip_brain(image, "bet.nii.gz", "mask.nii.gz", factor=1)
+    assert len(calls) == 1
+    assert calls[0][calls[0].index("-i") + 1] == image
+
+
+def test_head_mask_covers_the_head_on_the_native_grid(tmp_path):
+    image, data = _image(tmp_path)
+    output = str(tmp_path / "head_mask.nii.gz")
+    preprocess.make_head_mask(image, output, factor=2, dilations=0)
+    mask = np.asanyarray(nib.load(output).dataobj) > 0
+    assert mask.shape == SHAPE
+    assert mask[data > 0].all()
+    assert not mask[0].any()
+
+
+def test_reduced_mode_restricts_step_1_to_the_head(tmp_path):
+    steps = {s.name: s for s in build_steps(str(tmp_path / "T2w.nii.gz"), "12M",
+                                            str(tmp_path), str(tmp_path / "12M"),
+                                            preprocessing="reduced")}
+    head_mask = steps["head_mask"].outputs[0]
+    for name in ("denoise", "n4"):
+        command = steps[name].command
+        assert command[command.index("-x") + 1] == head_mask
+    n4 = steps["n4"].command
+    assert n4[n4.index("-s") + 1] == "4"
+    assert steps["synthstrip"].func is preprocess.strip_brain
+    assert steps["synthstrip"].kwargs["factor"] == 2
@@ -0,0 +1,66 @@
+"""Resource trace of the commands run by exec_command."""
+
+import json
+import os
+import sys
+
+import pytest
+
+from utils import profiler
+from utils.command_line import exec_command
+
+# Burns CPU for about 0.3 s while holding 64 MB
+_WORK = ("import time\nblock = bytearray(64 * 1024 * 1024)\nblock[::4096] = b'x' * 16384\n"
+         "end = time.process_time() + 0.3\nwhile time.process_time() < end: pass")
+
+
+@pytest.fixture
+def trace(tmp_path):
+    path = str(tmp_path / profiler.TRACE_NAME)
+    profiler.enable(path)
+    yield path
+    profiler.disable()
+
+
+def _events(path):
+    profiler.write()
+    with open(path) as f:
+        return json.load(f)["traceEvents"]
+
+
+def test_commands_are_recorded_with_their_rusage(trace):
+    with profiler.span("segmentation"):
+        exec_command([sys.executable, "-c", _WORK])
+    command, span = _events(trace)
+
+    assert command["name"] == os.path.basename(sys.executable)
+    assert command["cat"] == "segmentation"
+    assert command["ph"] == "X"
+    assert command["args"]["returncode"] == 0
+    # CPU time and peak RSS are those of the child, from wait4
+    assert command["args"]["user_cpu_s"] + command["args"]["sys_cpu_s"] >= 0.25
+    assert command["args"]["max_rss_mb"] >= 64
+    assert command["dur"] >= 0.25e6
+    # The span encloses the command
+    assert span["name"] == "segmentation"
+    assert span["ts"] <= command["ts"]
+    assert span["ts"] + span["dur"] >= command["ts"] + command["dur"]
+
+
+def test_the_stage_argument_overrides_the_span(trace):
+    with profiler.span("housekeeping"):
+        exec_command([sys.executable, "-c", "pass"], stage="qc")
+    assert _events(trace)[0]["cat"] == "qc"
+
+
+def test_failed_commands_are_recorded(trace):
+    with pytest.raises(RuntimeError):
+        exec_command([sys.executable, "-c", "import sys; sys.exit(3)"])
+    assert _events(trace)[0]["args"]["returncode"] == 3
+
+
+def test_nothing_is_recorded_when_disabled(tmp_path):
+    profiler.disable()
+    exec_command([sys.executable, "-c", "pass"])
+    profiler.write()
+    assert not os.listdir(tmp_path)
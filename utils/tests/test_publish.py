@@ -0,0 +1,158 @@
+"""Publishing work files to the output directory."""
+
+import gzip
+import os
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import publish
+from utils.join_data import housekeeping
+from utils.pipeline import Step
+from utils.publish import Publisher, atomic_write, publish_file
+
+
+def _step(*outputs):
+    return Step("step", [], [str(output) for output in outputs])
+
+
+def _leftovers(directory):
+    return [p.name for p in directory.iterdir() if p.name.endswith(".tmp")]
+
+
+def test_published_file_is_independent_of_the_work_file(tmp_path):
+    src = tmp_path / "All_volumes.csv"
+    dst = tmp_path / "output.csv"
+    src.write_text("first run\n")
+    assert publish_file(str(src), str(dst)) in ("reflink", "copy")
+    assert os.stat(src).st_ino != os.stat(dst).st_ino
+
+    # A rerun rewriting the work file in place leaves the output alone
+    with open(src, "r+") as f:
+        f.write("rerun    \n")
+    assert dst.read_text() == "first run\n"
+    assert _leftovers(tmp_path) == []
+
+
+def test_expected_output_is_published_when_its_step_completes(tmp_path):
+    src = tmp_path / "atlas.csv"
+    src.write_text("labels\n")
+    dst = str(tmp_path / "output" / "T2w_atlas.csv")
+    named = []
+
+    def destination():
+        named.append(dst)
+        return dst
+
+    (tmp_path / "output").mkdir()
+    publisher = Publisher()
+    publisher.expect(str(src), destination)
+    # Other steps, and other outputs of the step, publish nothing
+    publisher.step_complete(_step(tmp_path / "other.csv"))
+    assert publisher.wait() == [] and named == []
+
+    publisher.step_complete(_step(tmp_path / "other.csv", src))
+    assert publisher.wait() == [dst]
+    # The destination is named when the file is published
+    assert named == [dst]
+    assert (tmp_path / "output" / "T2w_atlas.csv").read_text() == "labels\n"
+    publisher.close()
+
+
+def test_an_output_is_published_once(tmp_path, monkeypatch):
+    src = tmp_path / "atlas.csv"
+    src.write_text("labels\n")
+    published = []
+
+    def counting_publish(source, destination):
+        published.append(source)
+        return publish_file(source, destination)
+
+    monkeypatch.setattr(publish, "publish_file", counting_publish)
+    publisher = Publisher()
+    publisher.expect(str(src), str(tmp_path / "output.csv"))
+    step = _step(src)
+    publisher.step_complete(step)
+    publisher.step_complete(step)
+    assert publisher.publish(str(src), str(tmp_path / "output.csv")) is \
+        publisher.publish(str(src), str(tmp_path / "other.csv"))
+    publisher.close()
+
+    assert published == [str(src)]
+    assert publisher.wait() == [str(tmp_path / "output.csv")]
+    assert not (tmp_path / "other.csv").exists()
+
+
+def test_a_failed_publish_raises_in_the_run(tmp_path, monkeypatch):
+    def no_reflink(src, dst):
+        raise OSError("reflinks not supported")
+
+    def full_disk(src, dst):
+        with open(dst, "wb") as f:
+            f.write(b"partial")
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(publish, "_reflink", no_reflink)
+    monkeypatch.setattr(publish.shutil, "copyfile", full_disk)
+    work_dir, output_dir = tmp_path / "work", tmp_path / "output"
+    work_dir.mkdir()
+    output_dir.mkdir()
+    seg = work_dir / "Final_segmentation_atlas_with_callosum.nii.gz"
+    seg.write_bytes(b"atlas")
+    (work_dir / "All_volumes.csv").write_text("tissue csf\n1.0 2.0\n")
+
+    publisher = Publisher()
+    publisher.expect(str(seg), str(output_dir / "T2w_segmentation.nii.gz"))
+    publisher.step_complete(_step(seg))
+    future = publisher.publish(str(seg), str(output_dir / "T2w_segmentation.nii.gz"))
+    with pytest.raises(OSError, match="No space left"):
+        future.result()
+    with pytest.raises(OSError, match="No space left"):
+        publisher.wait()
+
+    # The housekeeping of run.py waits for the segmentation, and fails with it
+    demographics = pd.DataFrame([{"subject": "s1", "session": "v1",
+                                  "acquisition": "T2w", "age": 12}])
+    with pytest.raises(OSError, match="No space left"):
+        housekeeping(demographics, str(work_dir), str(output_dir), publisher=publisher)
+    publisher.close()
+    assert sorted(p.name for p in output_dir.iterdir()) == ["T2w_volumes.csv"]
+
+
+def test_uncompressed_images_are_gzipped_on_publish(tmp_path):
+    data = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    src = str(tmp_path / "atlas.nii")
+    dst = str(tmp_path / "T2w_segmentation.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), src)
+
+    publisher = Publisher(threads=2)
+    publisher.expect(src, dst)
+    publisher.step_complete(_step(src))
+    assert publisher.wait() == [dst]
+    publisher.close()
+
+    with open(dst, "rb") as f:
+        assert f.read(2) == b"\x1f\x8b"
+    with gzip.open(dst) as f, open(src, "rb") as original:
+        assert f.read() == original.read()
+    assert np.array_equal(nib.load(dst).get_fdata(), data)
+    assert os.path.exists(src)
+
+
+@pytest.mark.parametrize("existing", [False, True])
+def test_atomic_write_leaves_no_partial_file(tmp_path, existing):
+    path = tmp_path / "T2w_volumes.csv"
+    if existing:
+        path.write_text("previous run\n")
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(path), "w") as f:
+            f.write("half of the ")
+            raise RuntimeError("table failed")
+
+    if existing:
+        assert path.read_text() == "previous run\n"
+    else:
+        assert not path.exists()
+    assert _leftovers(tmp_path) == []
@@ -0,0 +1,171 @@
+"""QC rendering: slice reads, the label colours and the rendered images."""
+
+import io
+
+import matplotlib
+import nibabel as nib
+import numpy as np
+import pytest
+from nibabel.arrayproxy import ArrayProxy
+from PIL import Image
+
+from utils.Inspect_segmentations import PLANE_AXES, QCMontage, SegQC, colour_labels
+from utils.Inspect_segmentations import load_slice, montage_row, render_slice
+
+SHAPE = (10, 12, 14)
+
+
+@pytest.fixture
+def volume(tmp_path):
+    data = np.arange(np.prod(SHAPE), dtype=np.int16).reshape(SHAPE)
+    path = str(tmp_path / "image.nii")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path, data
+
+
+@pytest.mark.parametrize("plane", list(PLANE_AXES))
+def test_slices_are_read_in_their_native_dtype(volume, plane):
+    path, data = volume
+    index = SHAPE[PLANE_AXES[plane]] // 2
+    data_slice = load_slice(nib.load(path), plane, index)
+    assert data_slice.dtype == np.int16
+    assert np.array_equal(data_slice, np.take(data, index, axis=PLANE_AXES[plane]))
+    # Loaded arrays are sliced the same way
+    assert np.array_equal(load_slice(data, plane, index), data_slice)
+
+
+def test_labels_get_the_colours_of_the_31_colour_jet_colormap():
+    labels = np.array([[0, 1, 2, 7], [15, 16, 29, 30]], dtype=np.uint8)
+    colormap = matplotlib.colormaps["jet"].resampled(31)
+    expected = (colormap(labels / 30.0)[..., :3] * 255).astype(np.uint8)
+    assert np.array_equal(colour_labels(labels), expected)
+
+
+def test_labels_outside_the_atlas_range_are_clipped():
+    colours = colour_labels(np.array([[-3, 0], [30, 45]]))
+    assert np.array_equal(colours[0, 0], colours[0, 1])
+    assert np.array_equal(colours[1, 0], colours[1, 1])
+
+
+def test_a_slice_renders_as_a_two_frame_gif():
+    image = np.linspace(0, 1, 12 * 14).reshape(12, 14)
+    labels = np.zeros((12, 14), np.uint8)
+    labels[:, 7:] = 30
+    gif = Image.open(io.BytesIO(render_slice(image, labels, "axial", "Axial")))
+
+    assert gif.n_frames == 2
+    # 256 x 256 slice above a 30 pixel caption
+    assert gif.size == (256, 286)
+    atlas = np.asarray(gif.convert("RGB"))
+    assert np.array_equal(atlas[128, 10], colour_labels(np.array([0]))[0])
+    assert np.array_equal(atlas[128, 245], colour_labels(np.array([30]))[0])
+
+
+RED = (255, 0, 0)
+
+
+def _red(panel):
+    return np.all(panel == RED, axis=2)
+
+
+def test_montage_rows_outline_the_mid_slices():
+    data = np.zeros(SHAPE, np.float32)
+    data[3:7, 4:8, 5:9] = 2.0
+    row = montage_row(data)
+
+    # Sagittal (14 x 12), coronal (14 x 10) and axial (12 x 10) side by side
+    assert row.shape == (14, 32, 3)
+    # Rotated, the box of the sagittal slice covers rows 5-8 and columns 4-7. The
+    # voxels where the mask changes from the previous row or column are red
+    sagittal = row[:, :12]
+    outline = np.zeros((14, 12), bool)
+    outline[[5, 9], 4:8] = True
+    outline[5:9, [4, 8]] = True
+    assert np.array_equal(_red(sagittal), outline)
+    inside = np.zeros((14, 12), bool)
+    inside[5:9, 4:8] = True
+    assert np.all(sagittal[inside & ~outline] > 250)
+    assert np.all(sagittal[~inside & ~outline] == 0)
+    # The axial panel is padded to the row height, centred
+    assert np.all(row[[0, 13], 22:] == 0)
+
+
+def test_atlas_rows_outline_the_label_boundaries():
+    labels = np.zeros(SHAPE, np.uint8)
+    labels[:, :, 7:] = 1
+    labels[:, 6:, 7:] = 2
+    row = montage_row(labels, labels=True)
+
+    # Sagittal: labels 1 and 2 meet at column 6 above row 7, label 0 is below
+    outline = np.zeros((14, 12), bool)
+    outline[7, :] = True
+    outline[:7, 6] = True
+    assert np.array_equal(_red(row[:, :12]), outline)
+    # Axial (rows 1-12 of the row): labels 2 and 1 meet at its row 6
+    outline = np.zeros((14, 10), bool)
+    outline[7, :] = True
+    assert np.array_equal(_red(row[:, 22:]), outline)
+
+
+def test_the_montage_stacks_the_brain_above_the_atlas(tmp_path):
+    bet = np.zeros(SHAPE, np.float32)
+    bet[2:8, 2:10, 2:12] = 1.0
+    atlas = (bet * 3).astype(np.uint8)
+    bet_path = str(tmp_path / "bet.nii.gz")
+    nib.save(nib.Nifti1Image(bet, np.eye(4)), bet_path)
+    montage_path = str(tmp_path / "QC-montage.png")
+    QCMontage(bet_path, atlas, montage_path)
+
+    montage = np.asarray(Image.open(montage_path).convert("RGB"))
+    assert montage.shape == (28, 32, 3)
+    assert np.array_equal(montage[:14], montage_row(nib.load(bet_path)))
+    assert np.array_equal(montage[14:], montage_row(atlas, labels=True))
+
+
+@pytest.fixture
+def full_reads(monkeypatch):
+    """Count the reads of whole volumes, through the proxy or ``get_fdata``."""
+    reads = []
+    array = ArrayProxy.__array__
+
+    def counting_array(self, *args, **kwargs):
+        reads.append(self.file_like)
+        return array(self, *args, **kwargs)
+
+    def no_get_fdata(self, *args, **kwargs):
+        raise AssertionError("QC loaded a whole volume with get_fdata")
+
+    monkeypatch.setattr(ArrayProxy, "__array__", counting_array)
+    monkeypatch.setattr(nib.Nifti1Image, "get_fdata", no_get_fdata)
+    return reads
+
+
+def _qc_images(tmp_path, ext):
+    image = np.random.default_rng(0).random(SHAPE).astype(np.float32)
+    atlas = np.zeros(SHAPE, np.uint8)
+    atlas[2:8, 3:9, 4:10] = 5
+    paths = []
+    for name, data in (("T2w", image), ("atlas", atlas)):
+        paths.append(str(tmp_path / f"{name}{ext}"))
+        nib.save(nib.Nifti1Image(data, np.eye(4)), paths[-1])
+    return paths
+
+
+def test_qc_reads_only_slices_through_the_proxies(tmp_path, full_reads):
+    image, atlas = _qc_images(tmp_path, ".nii")
+    output = tmp_path / "qc"
+    SegQC(image, atlas, "s1", str(output), slices=3, bet_image_path=image,
+          montage_path=str(output / "montage.png"))
+
+    assert full_reads == []
+    assert len(list(output.glob("*.gif"))) == 9
+
+
+def test_gzipped_images_are_decompressed_once_for_several_slices(tmp_path, full_reads):
+    image, atlas = _qc_images(tmp_path, ".nii.gz")
+    SegQC(image, atlas, "s1", str(tmp_path / "qc"), slices=3)
+    assert sorted(full_reads) == sorted([image, atlas])
+
+    full_reads.clear()
+    SegQC(image, atlas, "s1", str(tmp_path / "qc"), slices=1)
+    assert full_reads == []
@@ -0,0 +1,201 @@
+"""Atlas refinement against a NumPy emulation of the fslmaths chain it replaces."""
+
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils.refine import CALLOSUM_MASK, FINAL_ATLAS, FINAL_ATLAS_CALLOSUM, MASKS
+from utils.refine import POSTERIORS, VENTRICLES_MASK, WARPED_MASKS, build_atlas
+from utils.refine import refine_segmentation
+from utils.roi import mask_roi, save_rois
+
+SHAPE = (16, 14, 12)
+SUBCORTICAL, CEREBELLUM, BRAINSTEM = MASKS[1:4]
+
+
+def _thr(data, lower, upper):
+    """``fslmaths -thr lower -uthr upper``."""
+    return np.where((data >= lower) & (data <= upper), data, 0).astype(np.float32)
+
+
+def fslmaths_chain(tissue, csf, skull, masks):
+    """Steps 4 and 5 of the original main.sh, one fslmaths call per line.
+
+    Every intermediate is a float32 image, as fslmaths writes them.
+    """
+    f32 = np.float32
+    ventricles_mask_mul = (csf * masks[VENTRICLES_MASK]).astype(f32)
+    merged = np.stack([tissue, csf, ventricles_mask_mul, skull], axis=-1)
+    tsum = merged.astype(np.float64).mean(axis=-1).astype(f32) * f32(merged.shape[-1])
+    subtractmask = (_thr(tsum, 1.1, np.inf) != 0).astype(f32)
+    ventricles = csf * subtractmask
+    csf = csf - ventricles
+    merged = np.stack([np.zeros_like(tissue), tissue, csf, ventricles, skull], axis=-1)
+    # -Tmaxn: the first volume holding the maximum
+    atlas = np.argmax(merged, axis=-1).astype(f32)
+
+    atlas = atlas + _thr(atlas, 1, 1) * masks[SUBCORTICAL]
+
+    cerebellum_mask_mul = _thr(atlas, 1, 2) * masks[CEREBELLUM]
+    atlas = atlas + _thr(cerebellum_mask_mul, 30, 30)
+    atlas = atlas + _thr(cerebellum_mask_mul, 60, 60) / 60 * 30
+
+    brainstem_mask_mul = _thr(atlas, 1, 2) * masks[BRAINSTEM]
+    atlas = atlas + _thr(brainstem_mask_mul, 40, 40)
+    final = atlas + _thr(brainstem_mask_mul, 80, 80) / 80 * 40
+
+    with_callosum = final + _thr(final, 1, 1) * masks[CALLOSUM_MASK]
+    return final, with_callosum
+
+
+def _posteriors():
+    rng = np.random.default_rng(0)
+    tissue, csf, skull = (rng.random(SHAPE).astype(np.float32) for _ in range(3))
+    # Tmaxn ties, outside the masks and below the ventricle threshold: all zero
+    # (background), tissue = csf, csf = skull, all equal
+    tissue[12, 0, :4] = csf[12, 0, :4] = skull[12, 0, :4] = 0
+    tissue[13, 0, :4] = csf[13, 0, :4] = 0.5
+    skull[13, 0, :4] = 0
+    csf[14, 0, :4] = skull[14, 0, :4] = 0.5
+    tissue[14, 0, :4] = 0
+    tissue[15, 0, :4] = csf[15, 0, :4] = skull[15, 0, :4] = 0.3
+    # Summed posteriors right at, just below and just above the 1.1 threshold,
+    # inside the ventricle mask (which doubles the csf)
+    for x, total in zip((4, 5, 6), (1.1, 1.0999, 1.1001)):
+        tissue[x, 1:5, 1:5] = 0.3
+        csf[x, 1:5, 1:5] = (total - 0.3) / 2
+        skull[x, 1:5, 1:5] = 0
+    return [tissue, csf, skull]
+
+
+def _masks():
+    masks = {name: np.zeros(SHAPE, np.float32) for name in MASKS}
+    masks[VENTRICLES_MASK][2:9, 0:6, 0:6] = 1
+    # Subcortical labels overlap the cerebellum box: they are inserted first, so
+    # the cerebellum skips the voxels they relabel
+    masks[SUBCORTICAL][8:12, 2:10, 2:6] = np.resize([17, 18, 19, 20, 27, 28, 29, 30],
+                                                    (4, 8, 4))
+    # Cerebellum (30) and cerebellum csf windows, a value outside both tables (15),
+    # and a brainstem box overlapping the cerebellum
+    masks[CEREBELLUM][10:15, 6:13, 3:10] = 30
+    masks[CEREBELLUM][10:12, 6:8, 3:5] = 15
+    masks[BRAINSTEM][13:16, 10:14, 5:12] = 40
+    masks[BRAINSTEM][15, 13, 11] = 7
+    masks[CALLOSUM_MASK][4:10, 6:12, 6:11] = np.resize([7, 8, 9, 10, 11], (6, 6, 5))
+    return masks
+
+
+def _loader(masks, requested):
+    def load_mask(name):
+        requested.append(name)
+        return (Ellipsis,), masks[name]
+    return load_mask
+
+
+def test_atlas_matches_the_fslmaths_chain():
+    posteriors, masks = _posteriors(), _masks()
+    requested = []
+    atlas, atlas_callosum = build_atlas([p.copy() for p in posteriors],
+                                        _loader(masks, requested))
+    expected, expected_callosum = fslmaths_chain(*posteriors, masks)
+
+    assert atlas.dtype == np.float32
+    assert np.array_equal(atlas, expected)
+    assert np.array_equal(atlas_callosum, expected_callosum)
+    # Each mask is loaded once, in the order the chain applies them
+    assert requested == list(MASKS)
+    # Every label of the chain occurs
+    assert {1, 2, 3, 4, 18, 31, 32, 41, 42} <= set(np.unique(atlas).astype(int))
+    assert {8, 12} <= set(np.unique(atlas_callosum).astype(int))
+
+
+def test_labels_are_inserted_in_the_order_of_the_chain():
+    posteriors, masks = _posteriors(), _masks()
+    atlas, atlas_callosum = build_atlas([p.copy() for p in posteriors],
+                                        _loader(masks, []))
+    # Subcortical labels win over the cerebellum where both masks apply
+    both = (masks[SUBCORTICAL] > 0) & (masks[CEREBELLUM] == 30)
+    subcortical = both & (atlas >= 17) & (atlas <= 30)
+    assert subcortical.any()
+    assert not np.isin(atlas[both], [31, 32]).all()
+    # The brainstem skips the cerebellum labels
+    overlap = (masks[CEREBELLUM] == 30) & (masks[BRAINSTEM] == 40)
+    assert np.isin(atlas[overlap], [31, 32]).any()
+    assert not np.isin(atlas[overlap], [41, 42]).any()
+    # The callosum only relabels the supratentorial tissue of the final atlas
+    changed = atlas_callosum != atlas
+    assert changed.any()
+    assert np.all(atlas[changed] == 1)
+
+
+def test_ventricles_need_the_summed_posteriors_at_the_threshold():
+    posteriors, masks = _posteriors(), _masks()
+    atlas, _ = build_atlas([p.copy() for p in posteriors], _loader(masks, []))
+    _, csf, _ = posteriors
+    # Just above 1.1 the csf becomes ventricles (3), just below it stays csf (2);
+    # the voxels at 1.1 are compared with the chain in the test above
+    totals = {x: posteriors[0][x, 2, 2] + 2 * csf[x, 2, 2] for x in (4, 5, 6)}
+    assert totals[5] < np.float32(1.1) <= totals[6]
+    assert atlas[5, 2, 2] == 2
+    assert atlas[6, 2, 2] == 3
+
+
+def test_tmaxn_ties_resolve_to_the_first_class():
+    atlas, _ = build_atlas(_posteriors(), _loader(_masks(), []))
+    assert list(atlas[12:16, 0, 0]) == [0, 1, 2, 1]
+
+
+def _single_mask(name, value):
+    """Atlas of the posteriors with one mask set to ``value`` everywhere."""
+    posteriors, masks = _posteriors(), _masks()
+    masks = {mask: np.zeros(SHAPE, np.float32) for mask in masks}
+    masks[VENTRICLES_MASK] = _masks()[VENTRICLES_MASK]
+    base, _ = fslmaths_chain(*posteriors, masks)
+    masks[name][:] = value
+    atlas, _ = build_atlas([p.copy() for p in posteriors], _loader(masks, []))
+    assert np.array_equal(atlas, fslmaths_chain(*posteriors, masks)[0])
+    return base, atlas
+
+
+# Tissue (1) times the mask is inserted when it hits the 30 or 40 window, csf
+# (2) times the mask when it hits the 60 or 80 one, each adding 30 or 40
+@pytest.mark.parametrize("name, value, tissue, csf", [
+    (CEREBELLUM, 30, 31, 32), (CEREBELLUM, 15, 1, 32), (CEREBELLUM, 60, 31, 2),
+    (BRAINSTEM, 40, 41, 42), (BRAINSTEM, 20, 1, 42), (BRAINSTEM, 80, 41, 2),
+    (BRAINSTEM, 30, 1, 2),
+])
+def test_cerebellum_and_brainstem_windows(name, value, tissue, csf):
+    base, atlas = _single_mask(name, value)
+    assert (base == 1).any() and (base == 2).any()
+    assert np.all(atlas[base == 1] == tissue)
+    assert np.all(atlas[base == 2] == csf)
+    assert np.array_equal(atlas[base > 2], base[base > 2])
+
+
+def _write_work_dir(work_dir, posteriors, masks, boxes):
+    for path, data in zip(POSTERIORS, posteriors):
+        nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(work_dir, path))
+    if boxes:
+        rois = {name: (*mask_roi(mask), np.eye(4)) for name, mask in masks.items()}
+        save_rois(rois, os.path.join(work_dir, WARPED_MASKS), SHAPE, np.eye(4))
+    else:
+        for name, mask in masks.items():
+            nib.save(nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)),
+                     os.path.join(work_dir, name + ".nii.gz"))
+
+
+@pytest.mark.parametrize("boxes", [False, True])
+def test_refine_segmentation_reads_mask_files_or_boxes(tmp_path, boxes):
+    posteriors, masks = _posteriors(), _masks()
+    # An empty mask is stored as an empty box
+    masks[CALLOSUM_MASK][:] = 0
+    _write_work_dir(str(tmp_path), posteriors, masks, boxes)
+    refine_segmentation(str(tmp_path))
+
+    expected = fslmaths_chain(*posteriors, masks)
+    for name, data in zip((FINAL_ATLAS, FINAL_ATLAS_CALLOSUM), expected):
+        written = nib.load(str(tmp_path / name))
+        assert written.get_data_dtype() == np.float32
+        assert np.array_equal(written.get_fdata(dtype=np.float32), data)
@@ -0,0 +1,83 @@
+"""Registration presets: the antsRegistration command of each."""
+
+import pytest
+
+from utils.pipeline import build_steps
+from utils.registration import REGISTRATION_PRESETS, registration_command
+
+ARGS = ("template.nii", "template_mask.nii", "bet.nii.gz", "mask.nii.gz", "work/bet_",
+        "work/bet_Warped.nii.gz")
+
+
+def _option(command, name, stage):
+    """Get the value of an option of a stage (0: rigid, 1: affine, 2: SyN)."""
+    start = [i for i, arg in enumerate(command) if arg == "--transform"][stage]
+    return command[command.index(name, start) + 1]
+
+
+def _levels(schedule):
+    return schedule.strip("[]").split(",")[0].split("x")
+
+
+def test_standard_is_the_registration_of_main_sh():
+    # app/main.sh before the presets, with its variables filled in
+    original = (
+        "antsRegistration -d 3 --float 1 --output [work/bet_,work/bet_Warped.nii.gz] "
+        "--use-histogram-matching 1 --initial-moving-transform [template.nii,bet.nii.gz,1] "
+        "--transform Rigid[0.1] --metric MI[template.nii,bet.nii.gz,1,64,Regular,0.25] "
+        "--convergence [1000x1000x500x250,1e-6,10] --shrink-factors 8x6x4x2 "
+        "--smoothing-sigmas 4x3x2x1mm "
+        "--transform Affine[0.1] --metric MI[template.nii,bet.nii.gz,1,64,Regular,0.25] "
+        "--convergence [1000x1000x500x250,1e-6,10] --shrink-factors 8x6x4x2 "
+        "--smoothing-sigmas 4x3x2x1mm "
+        "--transform SyN[0.1,3,0] --metric CC[template.nii,bet.nii.gz,1,4] "
+        "--convergence [100x100x70x50,1e-6,10] --shrink-factors 6x4x2x1 "
+        "--smoothing-sigmas 3x2x1x0mm --masks [template_mask.nii,mask.nii.gz] "
+        "--interpolation BSpline"
+    )
+    assert registration_command(*ARGS, "standard") == original.split()
+    assert registration_command(*ARGS) == original.split()
+
+
+@pytest.mark.parametrize("preset", list(REGISTRATION_PRESETS))
+def test_every_stage_has_as_many_shrink_factors_as_levels(preset):
+    command = registration_command(*ARGS, preset)
+    for stage in range(3):
+        levels = len(_levels(_option(command, "--convergence", stage)))
+        assert len(_option(command, "--shrink-factors", stage).split("x")) == levels
+        assert len(_option(command, "--smoothing-sigmas", stage).split("x")) == levels
+
+
+def test_fast_stops_syn_at_half_resolution():
+    fast = registration_command(*ARGS, "fast")
+    standard = registration_command(*ARGS, "standard")
+    assert _option(fast, "--shrink-factors", 2).split("x")[-1] == "2"
+    assert _option(fast, "--metric", 2).endswith(",1,2]")
+    for stage in range(3):
+        iterations = [sum(map(int, _levels(_option(c, "--convergence", stage))))
+                      for c in (fast, standard)]
+        assert iterations[0] < iterations[1]
+
+
+def test_precise_adds_a_coarse_syn_level():
+    precise = registration_command(*ARGS, "precise")
+    assert _option(precise, "--shrink-factors", 2) == "8x6x4x2x1"
+    assert _option(precise, "--convergence", 2).endswith(",1e-7,15]")
+
+
+def test_unknown_presets_are_rejected():
+    with pytest.raises(ValueError, match="fast, standard, precise"):
+        registration_command(*ARGS, "quick")
+
+
+def test_the_preset_is_part_of_the_registration_checkpoint(tmp_path):
+    def registration(preset):
+        steps = build_steps(str(tmp_path / "T2w.nii.gz"), "12M", str(tmp_path),
+                            str(tmp_path / "12M"), preset=preset)
+        return next(s for s in steps if s.name == "registration")
+
+    fast, standard = registration("fast"), registration("standard")
+    assert _option(fast.command, "--shrink-factors", 2) == "6x4x2"
+    assert _option(standard.command, "--shrink-factors", 2) == "6x4x2x1"
+    assert (fast.checkpoint(str(tmp_path)).params
+            != standard.checkpoint(str(tmp_path)).params)
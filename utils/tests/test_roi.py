@@ -0,0 +1,65 @@
+"""Sparse mask warps against a nearest neighbour warp of the full template grid."""
+
+import nibabel as nib
+import numpy as np
+
+from utils.roi import load_rois, mask_roi, region, warp_rois
+
+_LPS = np.array([-1.0, -1.0, 1.0])
+
+
+def _grids():
+    template_affine = np.array([[-0.55, 0, 0, 14], [0, 0.55, 0, -14],
+                                [0, 0, 0.55, -12], [0, 0, 0, 1]])
+    native_affine = np.array([[-0.8, 0, 0, 15], [0, 0.8, 0, -15],
+                              [0, 0, 0.8, -13], [0, 0, 0, 1]])
+    return template_affine, (52, 52, 46), native_affine, (38, 38, 34)
+
+
+def _masks(shape):
+    index = np.indices(shape)
+    ball = sum((i - c) ** 2 for i, c in zip(index, (30, 22, 20))) < 8 ** 2
+    cerebellum = np.where(ball, np.where(index[2] > 20, 30, 60), 0).astype(np.uint8)
+    slab = np.zeros(shape, dtype=np.uint8)
+    slab[10:18, 30:34, 5:40] = 1
+    return {"cerebellum": cerebellum, "slab": slab, "empty": np.zeros(shape, np.uint8)}
+
+
+def _field(shape, affine, tmp_path):
+    """Smooth displacement field on the native grid, in LPS mm as ITK writes it."""
+    world = np.indices(shape).transpose(1, 2, 3, 0) @ affine[:3, :3].T + affine[:3, 3]
+    field = np.stack([1.5 * np.sin(world[..., 1] / 9), 1.2 * np.cos(world[..., 2] / 7),
+                      np.sin(world[..., 0] / 11)], axis=-1).astype(np.float32)
+    path = str(tmp_path / "native_warp.nii.gz")
+    nib.save(nib.Nifti1Image(field[:, :, :, None, :], affine), path)
+    return path, field
+
+
+def test_warp_matches_full_grid_warp(tmp_path):
+    template_affine, template_shape, native_affine, native_shape = _grids()
+    masks = _masks(template_shape)
+    field_path, field = _field(native_shape, native_affine, tmp_path)
+
+    rois = {name: mask_roi(data) + (template_affine,) for name, data in masks.items()}
+    output = warp_rois(rois, field_path, str(tmp_path / "warped.npz"))
+    warped = load_rois(output)
+
+    # Every native voxel mapped through the field into the whole template grid
+    voxels = np.indices(native_shape).transpose(1, 2, 3, 0).astype(np.float64)
+    world = voxels @ native_affine[:3, :3].T + native_affine[:3, 3] + field * _LPS
+    inverse = np.linalg.inv(template_affine)
+    template_voxels = np.floor(world @ inverse[:3, :3].T + inverse[:3, 3] + 0.5).astype(int)
+    inside = np.all((template_voxels >= 0) & (template_voxels < template_shape), axis=-1)
+
+    assert list(warped) == list(masks)
+    for name, data in masks.items():
+        expected = np.zeros(native_shape, dtype=data.dtype)
+        expected[inside] = data[tuple(template_voxels[inside].T)]
+        start, values, affine = warped[name]
+        result = np.zeros(native_shape, dtype=data.dtype)
+        result[region(start, values)] = values
+        assert np.array_equal(result, expected), name
+        assert values.size or not expected.any()
+        assert np.allclose(affine, native_affine)
+    assert warped["empty"][1].size == 0
+    assert warped["cerebellum"][1].size and warped["slab"][1].size
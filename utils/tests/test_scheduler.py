@@ -0,0 +1,93 @@
+"""Scheduler ordering, thread budget and failure handling."""
+
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils.scheduler import dependencies, run_graph
+
+
+def _step(tmp_path, name, inputs=(), outputs=None, threads=1):
+    outputs = [str(tmp_path / f"{name}.out")] if outputs is None else outputs
+    return SimpleNamespace(name=name, inputs=[str(tmp_path / f"{i}.out") for i in inputs],
+                           outputs=outputs, threads=threads)
+
+
+class Recorder:
+    """Run steps by writing their outputs, recording the order and concurrency."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.started = []
+        self.finished = []
+        self.granted = {}
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, step, threads):
+        with self.lock:
+            self.started.append(step.name)
+            self.granted[step.name] = threads
+            self.running += threads
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= threads
+        if step.name in self.fail:
+            raise RuntimeError(f"{step.name} failed")
+        for output in step.outputs:
+            with open(output, "w") as f:
+                f.write(step.name)
+        with self.lock:
+            self.finished.append(step.name)
+
+
+def test_steps_start_after_their_dependencies(tmp_path):
+    steps = [_step(tmp_path, "c", ["a", "b"]), _step(tmp_path, "b", ["a"]),
+             _step(tmp_path, "a"), _step(tmp_path, "d")]
+    assert dependencies(steps) == {"c": {"a", "b"}, "b": {"a"}, "a": set(), "d": set()}
+    run = Recorder()
+    completed = []
+    run_graph(steps, run, threads=4, on_complete=lambda s: completed.append(s.name))
+    for before, after in (("a", "b"), ("a", "c"), ("b", "c")):
+        assert run.finished.index(before) < run.started.index(after)
+    assert sorted(completed) == ["a", "b", "c", "d"]
+
+
+def test_thread_budget_is_shared(tmp_path):
+    steps = [_step(tmp_path, name, threads=threads)
+             for name, threads in (("one", 1), ("two", 2), ("all", None))]
+    run = Recorder()
+    run_graph(steps, run, threads=3)
+    assert run.peak <= 3
+    assert run.granted["all"] >= 1
+
+
+def test_failure_stops_the_dependent_steps(tmp_path):
+    steps = [_step(tmp_path, "a"), _step(tmp_path, "b", ["a"]), _step(tmp_path, "c")]
+    run = Recorder(fail={"a"})
+    with pytest.raises(RuntimeError, match="a failed"):
+        run_graph(steps, run, threads=2)
+    assert "b" not in run.started
+    assert "c" in run.finished
+
+
+def test_missing_output_fails_the_step(tmp_path):
+    step = _step(tmp_path, "a", outputs=[str(tmp_path / "never_written")])
+    with pytest.raises(RuntimeError, match="did not write"):
+        run_graph([step], lambda s, t: None, threads=1)
+
+
+def test_cycles_and_shared_outputs_are_rejected(tmp_path):
+    with pytest.raises(RuntimeError, match="cycle"):
+        run_graph([_step(tmp_path, "a", ["b"]), _step(tmp_path, "b", ["a"])],
+                  Recorder(), threads=1)
+    shared = [str(tmp_path / "x.out")]
+    with pytest.raises(ValueError, match="written by both"):
+        dependencies([_step(tmp_path, "a", outputs=shared),
+                      _step(tmp_path, "b", outputs=shared)])
+    assert not os.path.exists(shared[0])
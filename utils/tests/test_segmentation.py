@@ -0,0 +1,128 @@
+"""Atropos and N4 rounds: thread environment, early stop and N4 weight."""
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils import segmentation
+from utils.pipeline import Step, run_step
+from utils.refine import POSTERIORS
+
+SHAPE = (6, 6, 6)
+
+
+def _inputs(tmp_path):
+    affine = np.eye(4)
+    mask = str(tmp_path / "mask.nii.gz")
+    image = str(tmp_path / "DN_BC.nii.gz")
+    nib.save(nib.Nifti1Image(np.ones(SHAPE, np.uint8), affine), mask)
+    nib.save(nib.Nifti1Image(np.ones(SHAPE, np.float32), affine), image)
+    return image, mask
+
+
+def _fake_exec(tmp_path, rounds, calls, weights=None):
+    """Stand in for Atropos and N4, writing the posteriors of ``rounds`` in turn.
+
+    Each element of ``rounds`` holds the three posteriors of an Atropos round. The
+    weight image of each N4 call is appended to ``weights``.
+    """
+    rounds = iter(rounds)
+
+    def fake_exec(command, environ=None, **kwargs):
+        calls.append((command, environ))
+        if command[0] == "Atropos":
+            for path, data in zip(POSTERIORS, next(rounds)):
+                nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(tmp_path, path))
+        else:
+            if weights is not None:
+                weights.append(nib.load(command[command.index("-w") + 1]).get_fdata())
+            nib.save(nib.Nifti1Image(np.ones(SHAPE, np.float32), np.eye(4)),
+                     command[command.index("-o") + 1])
+
+    return fake_exec
+
+
+def _tools(calls):
+    return [command[0] for command, _ in calls]
+
+
+def _posteriors(*values):
+    return [np.full(SHAPE, v, np.float32) for v in values]
+
+
+def test_atropos_and_n4_get_the_step_environment(tmp_path, monkeypatch):
+    image, mask = _inputs(tmp_path)
+    rng = np.random.default_rng(0)
+    rounds = [[rng.random(SHAPE).astype(np.float32) for _ in POSTERIORS] for _ in range(2)]
+    calls = []
+    monkeypatch.setattr(segmentation, "exec_command", _fake_exec(tmp_path, rounds, calls))
+    step = Step("segment", [image, mask], [os.path.join(tmp_path, POSTERIORS[0])],
+                func=segmentation.segment_tissues,
+                kwargs={"image": image, "mask": mask, "priors": "prior%d.nii.gz",
+                        "work_dir": str(tmp_path), "iterations": 2, "convergence": 0})
+    run_step(step, str(tmp_path), threads=3)
+
+    assert _tools(calls) == ["Atropos", "N4BiasFieldCorrection", "Atropos"]
+    assert all(environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] == "3" for _, environ in calls)
+
+
+def test_rounds_stop_once_the_posteriors_converge(tmp_path, monkeypatch):
+    image, mask = _inputs(tmp_path)
+    # The second round changes the posteriors by 0.1 on average, the third by 0.0033
+    rounds = [_posteriors(0.2, 0.3, 0.5), _posteriors(0.3, 0.4, 0.4),
+              _posteriors(0.305, 0.395, 0.4), _posteriors(0.9, 0.1, 0.0)]
+    calls = []
+    monkeypatch.setattr(segmentation, "exec_command", _fake_exec(tmp_path, rounds, calls))
+    segmentation.segment_tissues(image, mask, "prior%d.nii.gz", str(tmp_path),
+                                 iterations=4, convergence=0.01)
+
+    assert _tools(calls) == ["Atropos", "N4BiasFieldCorrection", "Atropos",
+                             "N4BiasFieldCorrection", "Atropos"]
+    # The posteriors of the round that converged are kept
+    kept = nib.load(os.path.join(tmp_path, POSTERIORS[0])).get_fdata()
+    assert np.allclose(kept, 0.305)
+
+
+def test_rounds_run_to_the_limit_without_convergence(tmp_path, monkeypatch):
+    image, mask = _inputs(tmp_path)
+    rounds = [_posteriors(0.1 * i, 0.2, 0.3) for i in range(3)]
+    calls = []
+    monkeypatch.setattr(segmentation, "exec_command", _fake_exec(tmp_path, rounds, calls))
+    segmentation.segment_tissues(image, mask, "prior%d.nii.gz", str(tmp_path),
+                                 iterations=3, convergence=0.01)
+
+    assert _tools(calls).count("Atropos") == 3
+
+
+def test_a_single_round_runs_no_n4(tmp_path, monkeypatch):
+    image, mask = _inputs(tmp_path)
+    calls = []
+    monkeypatch.setattr(segmentation, "exec_command",
+                        _fake_exec(tmp_path, [_posteriors(0.2, 0.3, 0.5)], calls))
+    segmentation.segment_tissues(image, mask, "prior%d.nii.gz", str(tmp_path),
+                                 iterations=1)
+
+    assert _tools(calls) == ["Atropos"]
+    # Atropos segments DN_BC itself
+    command = calls[0][0]
+    assert command[command.index("-a") + 1] == image
+
+
+def test_n4_is_weighted_by_the_first_two_posteriors(tmp_path, monkeypatch):
+    image, mask = _inputs(tmp_path)
+    rng = np.random.default_rng(1)
+    first = [rng.random(SHAPE).astype(np.float32) for _ in POSTERIORS]
+    calls = []
+    weights = []
+    monkeypatch.setattr(segmentation, "exec_command",
+                        _fake_exec(tmp_path, [first, _posteriors(0.1, 0.2, 0.7)], calls,
+                                   weights))
+    segmentation.segment_tissues(image, mask, "prior%d.nii.gz", str(tmp_path),
+                                 iterations=2, convergence=0)
+
+    assert len(weights) == 1
+    assert np.allclose(weights[0], first[0] + first[1])
+    # The weight and corrected images are removed once the rounds are done
+    assert not os.path.exists(os.path.join(tmp_path, segmentation.N4_WEIGHT))
+    assert not os.path.exists(os.path.join(tmp_path, segmentation.CORRECTED))
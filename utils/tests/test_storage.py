@@ -0,0 +1,33 @@
+"""Parallel gzip round trip and intermediate naming."""
+
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from utils.storage import GZIP_BLOCK_SIZE, NIFTI, NIFTI_GZ, gzip_file, intermediate_ext, nifti
+
+
+@pytest.mark.parametrize("size", [0, 1000, 3 * GZIP_BLOCK_SIZE + 17])
+@pytest.mark.parametrize("threads", [1, 3])
+def test_gzip_round_trip(tmp_path, size, threads):
+    rng = np.random.default_rng(size)
+    # Compressible, like a NIfTI volume: a smooth ramp with noise in the low bits
+    data = ((np.arange(size) // 64) % 251 + rng.integers(0, 4, size)).astype(np.uint8)
+    src = tmp_path / "image.nii"
+    src.write_bytes(data.tobytes())
+    dst = tmp_path / "image.nii.gz"
+    gzip_file(str(src), str(dst), threads)
+    with gzip.open(dst, "rb") as f:
+        assert f.read() == data.tobytes()
+    assert not os.path.exists(str(dst) + ".tmp")
+
+
+def test_intermediate_names():
+    assert intermediate_ext("compressed") == NIFTI_GZ
+    assert intermediate_ext("tmpfs") == NIFTI
+    assert nifti("DN_BC.nii.gz", NIFTI) == "DN_BC.nii"
+    assert nifti("prior%d_scale", NIFTI_GZ) == "prior%d_scale.nii.gz"
+    with pytest.raises(ValueError):
+        intermediate_ext("zip")
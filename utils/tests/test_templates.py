@@ -0,0 +1,161 @@
+"""Template registry: files are hashed when indexed, only stat'ed at startup, and shared
+through the template store."""
+
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils import templates
+from utils.refine import MASKS
+from utils.roi import load_rois, region
+from utils.templates import INDEX_NAME, build_index, load_bundle, shared_store
+from utils.templates import template_files
+
+AGE = "12M"
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    template_dir = tmp_path / AGE
+    template_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for role, name in template_files(AGE).items():
+        if role in ("template",) or role.startswith("prior"):
+            data = rng.random((8, 8, 8)).astype(np.float32)
+        else:
+            data = np.zeros((8, 8, 8), np.uint8)
+            data[2:5, 3:6, 1:4] = 1
+        nib.save(nib.Nifti1Image(data, np.eye(4)), str(template_dir / name))
+    return str(template_dir)
+
+
+@pytest.fixture
+def hashes(monkeypatch):
+    """Paths hashed by the registry."""
+    hashed = []
+
+    def counting_hash(path, refresh=False):
+        hashed.append(path)
+        return file_hash(path, refresh)
+
+    file_hash = templates.file_hash
+    monkeypatch.setattr(templates, "file_hash", counting_hash)
+    return hashed
+
+
+def _rewrite(path, keep_mtime=False):
+    stat = os.stat(path)
+    with open(path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+    if keep_mtime:
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    else:
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_unchanged_files_are_not_hashed(bundle, hashes):
+    build_index(bundle, AGE)
+    hashes.clear()
+    loaded = load_bundle(bundle, AGE)
+    assert hashes == []
+    assert loaded.path("template").endswith(os.path.join("derived",
+                                                         "template_12M_degibbs_padded.nii"))
+
+
+def test_modified_files_are_hashed(bundle, hashes):
+    build_index(bundle, AGE)
+    path = os.path.join(bundle, "prior1_scale.nii.gz")
+    _rewrite(path)
+    hashes.clear()
+    with pytest.raises(ValueError, match="prior1_scale: .* checksum"):
+        load_bundle(bundle, AGE)
+    assert hashes == [path]
+
+
+def test_size_changes_fail_without_hashing(bundle, hashes):
+    build_index(bundle, AGE)
+    with open(os.path.join(bundle, "brainMask.nii.gz"), "ab") as f:
+        f.write(b"\0")
+    hashes.clear()
+    with pytest.raises(ValueError, match="brain_mask: .* bytes"):
+        load_bundle(bundle, AGE)
+    assert hashes == []
+
+
+def test_checksums_hash_every_file(bundle):
+    build_index(bundle, AGE)
+    _rewrite(os.path.join(bundle, "prior2_scale.nii.gz"), keep_mtime=True)
+    load_bundle(bundle, AGE)
+    load_bundle(bundle, AGE, verify=False)
+    with pytest.raises(ValueError, match="prior2_scale"):
+        load_bundle(bundle, AGE, checksums=True)
+
+
+def test_store_hashes_once_per_bundle_version(bundle, hashes, tmp_path):
+    store = str(tmp_path / "store")
+    first = load_bundle(bundle, AGE, store=store)
+    assert hashes
+    assert not os.path.exists(os.path.join(bundle, INDEX_NAME))
+
+    hashes.clear()
+    assert load_bundle(bundle, AGE, store=store).derived_dir == first.derived_dir
+    assert hashes == []
+
+    # A bundle changed in place gets a store entry of its own
+    _rewrite(os.path.join(bundle, "prior3_scale.nii.gz"))
+    assert load_bundle(bundle, AGE, store=store).derived_dir != first.derived_dir
+
+
+def test_concurrent_runs_write_the_store_once(bundle, tmp_path, monkeypatch):
+    store = str(tmp_path / "store")
+    builds = []
+    build_derived = templates.build_derived
+
+    def counting_build(*args):
+        builds.append(args)
+        return build_derived(*args)
+
+    monkeypatch.setattr(templates, "build_derived", counting_build)
+    with ThreadPoolExecutor(4) as pool:
+        store_dirs = set(pool.map(lambda _: shared_store(bundle, AGE, store), range(4)))
+
+    assert len(builds) == 1
+    assert len(store_dirs) == 1
+    store_dir = store_dirs.pop()
+    assert [name for name in os.listdir(store) if not name.startswith(".")] == [
+        os.path.basename(store_dir)]
+    # The products are read-only
+    for directory, _, names in os.walk(store_dir):
+        for name in names:
+            mode = os.stat(os.path.join(directory, name)).st_mode
+            assert not mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+
+def test_runs_read_the_template_and_mask_boxes_from_the_store(bundle, tmp_path):
+    loaded = load_bundle(bundle, AGE, store=str(tmp_path / "store"))
+    files = template_files(AGE)
+
+    # The registration reads an uncompressed copy of the template
+    template = loaded.path("template")
+    assert template.startswith(str(tmp_path / "store")) and template.endswith(".nii")
+    assert np.array_equal(nib.load(template).get_fdata(),
+                          nib.load(os.path.join(bundle, files["template"])).get_fdata())
+
+    # The mask boxes hold the template masks
+    rois = load_rois(loaded.path("mask_rois"))
+    assert list(rois) == list(MASKS)
+    for name, (start, values, affine) in rois.items():
+        mask = nib.load(os.path.join(bundle, f"{name}.nii.gz"))
+        data = np.asanyarray(mask.dataobj)
+        assert np.array_equal(affine, mask.affine)
+        assert np.array_equal(values, data[region(start, values)])
+        outside = data.copy()
+        outside[region(start, values)] = 0
+        assert not outside.any()
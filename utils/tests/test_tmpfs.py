@@ -0,0 +1,71 @@
+"""Reserving and releasing space for work directories on the tmpfs."""
+
+import os
+from collections import namedtuple
+
+import pytest
+
+from utils import storage
+
+_Stat = namedtuple("_Stat", "f_bavail f_frsize")
+
+
+@pytest.fixture
+def tmpfs(tmp_path, monkeypatch):
+    root = tmp_path / "shm"
+    root.mkdir()
+    free = {"bytes": 1000}
+    monkeypatch.setattr(storage, "TMPFS_ROOT", str(root))
+    monkeypatch.setattr(storage, "work_bytes", lambda input_path: 400)
+    monkeypatch.setattr(storage.os, "statvfs", lambda path: _Stat(free["bytes"], 1))
+    return root, free
+
+
+def test_reservations_are_shared(tmpfs, tmp_path):
+    root, _ = tmpfs
+    first = storage.resolve_work_dir("tmpfs", str(tmp_path / "a" / "work"), "in.nii")
+    second = storage.resolve_work_dir("tmpfs", str(tmp_path / "b" / "work"), "in.nii")
+    assert first.startswith(str(root)) and second.startswith(str(root))
+    # 800 of the 1000 free bytes are reserved, though nothing is written yet
+    third = storage.resolve_work_dir("tmpfs", str(tmp_path / "c" / "work"), "in.nii")
+    assert third == str(tmp_path / "c" / "work")
+
+    # A rerun of a directory replaces its own reservation
+    assert storage.resolve_work_dir("tmpfs", str(tmp_path / "a" / "work"), "in.nii") == first
+
+
+def test_written_files_count_as_used(tmpfs, tmp_path):
+    _, free = tmpfs
+    first = storage.resolve_work_dir("tmpfs", str(tmp_path / "a" / "work"), "in.nii")
+    with open(os.path.join(first, "image.nii"), "wb") as f:
+        f.write(b"\0" * 300)
+    free["bytes"] -= 300
+    # 700 free, of which 100 are still reserved for the first directory
+    assert storage.resolve_work_dir(
+        "tmpfs", str(tmp_path / "b" / "work"), "in.nii").startswith(str(tmpfs[0]))
+
+
+def test_release_removes_the_directory_and_reservation(tmpfs, tmp_path):
+    first = storage.resolve_work_dir("tmpfs", str(tmp_path / "a" / "work"), "in.nii")
+    storage.resolve_work_dir("tmpfs", str(tmp_path / "b" / "work"), "in.nii")
+    storage.release_work_dir(first)
+    assert not os.path.exists(first)
+    assert sorted(os.listdir(tmpfs[0] / "minimorph")) == [".lock", "reservations.json", "tmp"]
+    assert storage.resolve_work_dir(
+        "tmpfs", str(tmp_path / "c" / "work"), "in.nii").startswith(str(tmpfs[0]))
+
+
+def test_disk_work_dirs_are_kept(tmpfs, tmp_path):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    assert storage.resolve_work_dir("compressed", str(work_dir), "in.nii") == str(work_dir)
+    storage.release_work_dir(str(work_dir))
+    assert work_dir.is_dir()
+
+
+def test_reservations_of_exited_processes_are_dropped(tmpfs, tmp_path, monkeypatch):
+    storage.resolve_work_dir("tmpfs", str(tmp_path / "a" / "work"), "in.nii")
+    storage.resolve_work_dir("tmpfs", str(tmp_path / "b" / "work"), "in.nii")
+    monkeypatch.setattr(storage, "_pid_alive", lambda pid: False)
+    assert storage.resolve_work_dir(
+        "tmpfs", str(tmp_path / "c" / "work"), "in.nii").startswith(str(tmpfs[0]))
@@ -0,0 +1,141 @@
+"""Composed registration field and the batched prior warp, with stub ANTs tools."""
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils import transforms
+from utils.transforms import PRIORS, PRIORS_STACK
+
+SHAPE = (5, 6, 7)
+NATIVE = np.diag([0.8, 0.8, 0.8, 1])
+TEMPLATE = np.diag([1.0, 1.0, 1.0, 1])
+
+
+def _option(command, flag):
+    return command[command.index(flag) + 1]
+
+
+def _fake_ants(calls):
+    """Stand in for antsApplyTransforms, resampling by flipping the first axis.
+
+    Each volume of a time series (``-e 3``) is flipped on its own; the output is
+    written on the grid of the reference.
+    """
+    def fake_exec(command, environ=None, **kwargs):
+        calls.append((command, environ))
+        data = np.asanyarray(nib.load(_option(command, "-i")).dataobj)
+        if "-e" in command:
+            assert _option(command, "-e") == "3" and data.ndim == 4
+        warped = data[::-1].astype(np.float32)
+        reference = nib.load(_option(command, "-r"))
+        nib.save(nib.Nifti1Image(warped, reference.affine), _option(command, "-o"))
+
+    return fake_exec
+
+
+def _template(tmp_path):
+    template_dir = tmp_path / "template"
+    template_dir.mkdir()
+    rng = np.random.default_rng(0)
+    priors = []
+    for name in PRIORS:
+        data = rng.random(SHAPE).astype(np.float32)
+        nib.save(nib.Nifti1Image(data, TEMPLATE), str(template_dir / f"{name}.nii.gz"))
+        priors.append(data)
+    reference = str(tmp_path / "native_bet_image.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros(SHAPE, np.float32), NATIVE), reference)
+    return str(template_dir), reference, priors
+
+
+def test_compose_transforms_inverts_the_affine_before_the_inverse_warp(monkeypatch):
+    calls = []
+
+    def fake_exec(command, environ=None, **kwargs):
+        calls.append((command, environ))
+
+    monkeypatch.setattr(transforms, "exec_command", fake_exec)
+    environ = {"ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS": "2"}
+    field = transforms.compose_transforms("bet.nii.gz", "bet0GenericAffine.mat",
+                                          "bet1InverseWarp.nii.gz", "native_warp.nii.gz",
+                                          environ)
+
+    assert field == "native_warp.nii.gz"
+    assert calls == [([
+        "antsApplyTransforms", "-d", "3",
+        "-r", "bet.nii.gz",
+        "-o", "[native_warp.nii.gz,1]",
+        "-t", "[bet0GenericAffine.mat,1]",
+        "-t", "bet1InverseWarp.nii.gz",
+    ], environ)]
+
+
+def test_stacked_warp_matches_the_per_image_warp(tmp_path, monkeypatch):
+    template_dir, reference, priors = _template(tmp_path)
+    stacked_dir, single_dir = tmp_path / "stacked", tmp_path / "single"
+    stacked_dir.mkdir()
+    single_dir.mkdir()
+
+    stacked_calls = []
+    monkeypatch.setattr(transforms, "exec_command", _fake_ants(stacked_calls))
+    stacked = transforms.warp_priors(template_dir, reference, "native_warp.nii.gz",
+                                     str(stacked_dir))
+
+    single_calls = []
+    monkeypatch.setattr(transforms, "exec_command", _fake_ants(single_calls))
+    monkeypatch.setattr(transforms, "stack_images", lambda *args, **kwargs: False)
+    single = transforms.warp_priors(template_dir, reference, "native_warp.nii.gz",
+                                    str(single_dir))
+
+    # One resampling of the whole stack against one per prior
+    assert len(stacked_calls) == 1
+    assert _option(stacked_calls[0][0], "-e") == "3"
+    assert len(single_calls) == len(PRIORS)
+    assert all("-e" not in command for command, _ in single_calls)
+    for command, _ in stacked_calls + single_calls:
+        assert _option(command, "-t") == "native_warp.nii.gz"
+        assert _option(command, "-n") == "Linear"
+
+    for path_stacked, path_single, prior in zip(stacked, single, priors):
+        img_stacked, img_single = nib.load(path_stacked), nib.load(path_single)
+        assert np.allclose(img_stacked.affine, NATIVE)
+        assert np.allclose(img_single.affine, NATIVE)
+        assert np.array_equal(img_stacked.get_fdata(), img_single.get_fdata())
+        assert np.array_equal(img_stacked.get_fdata(dtype=np.float32), prior[::-1])
+    # The temporary stack and its warped copy are removed
+    assert sorted(os.listdir(stacked_dir)) == sorted(os.path.basename(p) for p in stacked)
+
+
+def test_prepared_stack_is_reused_and_kept(tmp_path, monkeypatch):
+    template_dir, reference, _ = _template(tmp_path)
+    stack_dir = str(tmp_path / "stacks")
+    os.mkdir(stack_dir)
+    paths = [os.path.join(template_dir, f"{name}.nii.gz") for name in PRIORS]
+    assert transforms.stack_images(paths, os.path.join(stack_dir, PRIORS_STACK))
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    calls = []
+    monkeypatch.setattr(transforms, "exec_command", _fake_ants(calls))
+    transforms.warp_priors(template_dir, reference, "native_warp.nii.gz", str(work_dir),
+                           stack_dir)
+
+    assert _option(calls[0][0], "-i") == os.path.join(stack_dir, PRIORS_STACK)
+    assert os.path.exists(os.path.join(stack_dir, PRIORS_STACK))
+
+
+def test_split_stack_writes_each_prior_with_its_name_and_affine(tmp_path):
+    affine = np.array([[-0.8, 0, 0, 40], [0, 0.8, 0, -30], [0, 0, 0.8, -20],
+                       [0, 0, 0, 1]])
+    data = np.random.default_rng(1).random(SHAPE + (len(PRIORS),)).astype(np.float32)
+    stack = str(tmp_path / "priors_warped.nii")
+    nib.save(nib.Nifti1Image(data, affine), stack)
+    outputs = [str(tmp_path / f"{name}.nii") for name in PRIORS]
+    transforms._split_stack(stack, outputs)
+
+    for i, output in enumerate(outputs):
+        img = nib.load(output)
+        assert img.shape == SHAPE
+        assert np.allclose(img.affine, affine)
+        assert img.get_data_dtype() == np.float32
+        assert np.array_equal(img.get_fdata(dtype=np.float32), data[..., i])
@@ -0,0 +1,45 @@
+"""Label volumes against a per-label count, as the fslstats windows give them."""
+
+import nibabel as nib
+import numpy as np
+
+from utils.volumes import COLUMNS, LABELS, extract_volumes, label_volumes
+
+
+def _atlas(tmp_path, dtype=np.uint8):
+    rng = np.random.default_rng(0)
+    values = [0] + sorted(LABELS.values())
+    data = rng.choice(values, size=(40, 36, 70)).astype(dtype)
+    path = tmp_path / "atlas.nii.gz"
+    nib.save(nib.Nifti1Image(data, np.diag([0.55, 0.55, 0.6, 1])), path)
+    return str(path), data
+
+
+def test_label_volumes_match_per_label_windows(tmp_path):
+    atlas, data = _atlas(tmp_path)
+    voxel = 0.55 * 0.55 * 0.6
+    for name, (voxels, mm3) in label_volumes(atlas).items():
+        value = LABELS[name]
+        expected = int(np.sum((data > value - 0.5) & (data < value + 0.5)))
+        assert voxels == expected
+        assert np.isclose(mm3, expected * voxel)
+
+
+def test_float_atlas_is_rounded(tmp_path):
+    atlas, data = _atlas(tmp_path, np.float32)
+    img = nib.load(atlas)
+    jittered = nib.Nifti1Image(data + np.float32(0.2), img.affine)
+    assert label_volumes(jittered) == label_volumes(atlas)
+
+
+def test_csv_layout_and_derived_measures(tmp_path):
+    atlas, _ = _atlas(tmp_path)
+    output = extract_volumes("12M", atlas=atlas, output_csv=str(tmp_path / "volumes.csv"))
+    with open(output) as f:
+        header, row = (line.split() for line in f.read().splitlines())
+    assert tuple(header) == COLUMNS
+    volumes = dict(zip(header[1:], map(float, row[1:])))
+    assert row[0] == "12M"
+    assert np.isclose(volumes["icv"], sum(volumes[c] for c in (
+        "supratentorial_tissue", "supratentorial_csf", "cerebellum", "cerebellum_csf",
+        "brainstem", "brainstem_csf")), atol=1e-5)
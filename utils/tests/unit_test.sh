@@ -1,17 +1,17 @@
-
 OUTPUT_DIR=/flywheel/v0/output/
 WORK_DIR=/flywheel/v0/work/
 age=30
 
 # Extract volumes of segmentations
 output_csv=${WORK_DIR}/All_volumes.csv
+reference_csv=${WORK_DIR}/All_volumes_fslstats.csv
 
-# Initialize the master CSV file with headers
-echo "template_age, supratentorial_tissue, supratentorial_csf, ventricles, cerebellum, cerebellum_csf, brainstem, brainstem_csf, left_thalamus, left_caudate, left_putamen, left_globus_pallidus, right_thalamus, right_caudate, right_putamen, right_globus_pallidus, posterior_callosum, mid_posterior_callosum, central_callosum, mid_anterior_callosum, anterior_callosum, icv" > "$output_csv"
+# Initialize the reference CSV file with headers
+echo "template_age supratentorial_tissue supratentorial_csf ventricles cerebellum cerebellum_csf brainstem brainstem_csf left_thalamus left_caudate left_putamen left_globus_pallidus right_thalamus right_caudate right_putamen right_globus_pallidus posterior_callosum mid_posterior_callosum central_callosum mid_anterior_callosum anterior_callosum icv" > "$reference_csv"
 
 atlas=`ls ${OUTPUT_DIR}/*segmentation.nii.gz`
 
-# Extract volumes for each label
+# Reference volumes, one fslstats call per label
             supratentorial_general=$(fslstats ${atlas} -l 0.5 -u 1.5 -V | awk '{print $2}')
             supratentorial_csf=$(fslstats ${atlas} -l 1.5 -u 2.5 -V | awk '{print $2}')
             ventricles=$(fslstats ${atlas} -l 2.5 -u 3.5 -V | awk '{print $2}')
@@ -40,6 +40,31 @@ atlas=`ls ${OUTPUT_DIR}/*segmentation.nii.gz`
             icv=$(echo "$supratentorial_tissue + $supratentorial_csf + $cerebellum + $cerebellum_csf + $brainstem + $brainstem_csf" | bc)
 
 
-echo "$age, $supratentorial_tissue, $supratentorial_csf, $ventricles, $cerebellum, $cerebellum_csf, $brainstem, $brainstem_csf, $left_thalamus, $left_caudate, $left_putamen, $left_globus_pallidus, $right_thalamus, $right_caudate, $right_putamen, $right_globus_pallidus, $posterior_callosum, $mid_posterior_callosum, $central_callosum, $mid_anterior_callosum, $anterior_callosum, $icv" >> "$output_csv"
+echo "$age $supratentorial_tissue $supratentorial_csf $ventricles $cerebellum $cerebellum_csf $brainstem $brainstem_csf $left_thalamus $left_caudate $left_putamen $left_globus_pallidus $right_thalamus $right_caudate $right_putamen $right_globus_pallidus $posterior_callosum $mid_posterior_callosum $central_callosum $mid_anterior_callosum $anterior_callosum $icv" >> "$reference_csv"
+
+# Extract volumes for each label in a single pass over the atlas
+python3 -m utils.volumes ${atlas} ${age} ${output_csv}
 
-echo "Volumes extracted and saved to $output_csv"
\ No newline at end of file
+# Compare the two, allowing for the 6 significant digits fslstats prints
+if ! diff <(head -n 1 "$reference_csv") <(head -n 1 "$output_csv"); then
+  echo "FAIL: the columns of $output_csv differ from the reference"
+  exit 1
+fi
+if awk 'FNR == 1 {next}
+        NR == FNR {split($0, reference, " "); next}
+        {
+          for (i = 2; i <= NF; i++) {
+            tolerance = 1e-4 * (reference[i] < 0 ? -reference[i] : reference[i]) + 1e-3
+            difference = reference[i] - $i
+            if (difference > tolerance || -difference > tolerance) {
+              print "column " i ": fslstats " reference[i] ", utils.volumes " $i
+              failed = 1
+            }
+          }
+        }
+        END {exit failed}' "$reference_csv" "$output_csv"; then
+  echo "PASS: utils.volumes matches fslstats"
+else
+  echo "FAIL: utils.volumes differs from fslstats"
+  exit 1
+fi
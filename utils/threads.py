@@ -0,0 +1,118 @@
+"""CPU thread budget for the pipeline tools.
+
+None of the tools set a thread count by default, so ANTs (ITK), SynthStrip
+(torch) and FSL take whatever their runtime picks, which oversubscribes shared
+nodes or leaves cores idle in a CPU limited container. The budget is taken from the
+``threads`` gear config option or, when that is not set, from the container CPU
+quota, and is passed to each tool through its environment.
+
+Example:
+    >>> budget = thread_budget(config.get("threads"))
+    >>> exec_command(command, environ=thread_environ(budget))
+"""
+
+import logging
+import math
+import os
+
+log = logging.getLogger(__name__)
+
+# Environment variables read by the threaded runtimes of the pipeline tools
+THREAD_VARIABLES = (
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",  # ANTs
+    "OMP_NUM_THREADS",  # torch (SynthStrip), OpenMP
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """Get the CPU limit set by the container's cgroup CPU quota.
+
+    Returns:
+        float: Number of CPUs allowed by the quota, or None without a quota.
+    """
+    cpu_max = _read(CGROUP_V2_CPU_MAX)
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max":
+            return int(quota) / int(period or 100000)
+        return None
+
+    quota, period = _read(CGROUP_V1_QUOTA), _read(CGROUP_V1_PERIOD)
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def available_cpus():
+    """Get the number of CPUs this process can use, honouring cgroup quotas."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.floor(limit)))
+    return cpus
+
+
+def thread_budget(threads=None):
+    """Get the thread budget for the pipeline.
+
+    Args:
+        threads (int, optional): Configured number of threads. Values below 1, or
+            None, detect the budget from the CPUs available to the container.
+
+    Returns:
+        int: The thread budget.
+    """
+    if threads is not None and int(threads) > 0:
+        budget = int(threads)
+        log.info("Using the configured thread budget of %d", budget)
+    else:
+        budget = available_cpus()
+        log.info("Detected a thread budget of %d", budget)
+    return budget
+
+
+def thread_environ(threads, environ=None):
+    """Get an environment limiting the tools to a number of threads.
+
+    Args:
+        threads (int): Number of threads.
+        environ (dict, optional): Environment to extend. Defaults to
+            ``os.environ``.
+
+    Returns:
+        dict: Copy of ``environ`` with the thread variables set.
+    """
+    environ = dict(os.environ if environ is None else environ)
+    environ.update({name: str(threads) for name in THREAD_VARIABLES})
+    return environ
+
+
+def limit_process_threads(threads):
+    """Limit the threaded runtimes of this process to a number of threads.
+
+    The thread variables are read when a runtime is loaded, e.g. the BLAS and
+    OpenMP libraries of NumPy, so this is called before the stage modules are
+    imported. Tools started without their own environment inherit the limit.
+
+    Args:
+        threads (int): Number of threads.
+    """
+    os.environ.update({name: str(threads) for name in THREAD_VARIABLES})
@@ -0,0 +1,254 @@
+"""Batched application of the registration transforms to the template priors and masks.
+
+The inverse registration chain (``[GenericAffine,1]`` + ``InverseWarp``) is composed
+once into a single displacement field on the native grid. The priors are then
+resampled together as one time-series image with linear interpolation, so the warp
+fields are parsed once per subject rather than once per image. The label masks are
+warped in process through the same field, each only within its bounding box (see
+``utils.roi``).
+
+Example:
+    >>> from utils.transforms import warp_template_images
+    >>> warp_template_images("/flywheel/v0/app/templates/12M", native_bet_image)
+"""
+
+import argparse
+import glob
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+
+from utils.command_line import exec_command
+from utils.refine import MASKS, WARPED_MASKS
+from utils.roi import TEMPLATE_ROIS, build_template_rois, load_rois, warp_rois
+from utils.storage import NIFTI_GZ, nifti
+
+log = logging.getLogger(__name__)
+
+WORK_DIR = "/flywheel/v0/work"
+PRIORS = ("prior1_scale", "prior2_scale", "prior3_scale")
+NATIVE_WARP = "native_warp.nii.gz"
+PRIORS_STACK = "template_priors.nii"
+
+
+def _same_grid(imgs):
+    """Check whether images share one 3D voxel grid."""
+    first = imgs[0]
+    return all(
+        img.shape[:3] == first.shape[:3] and np.allclose(img.affine, first.affine)
+        for img in imgs[1:]
+    )
+
+
+def stack_images(paths, output, dtype=np.float32):
+    """Stack 3D images on one grid into a single 4D image.
+
+    Args:
+        paths (list): Paths of the 3D images.
+        output (str): Path of the 4D image.
+        dtype (numpy.dtype, optional): Data type of the stack. Defaults to float32.
+
+    Returns:
+        bool: False, without writing anything, if the images are not on one grid.
+    """
+    imgs = [nib.load(p) for p in paths]
+    if not _same_grid(imgs):
+        return False
+    data = np.empty(imgs[0].shape[:3] + (len(imgs),), dtype=dtype)
+    for i, img in enumerate(imgs):
+        data[..., i] = np.asanyarray(img.dataobj)
+    stack = nib.Nifti1Image(data, imgs[0].affine, imgs[0].header)
+    stack.set_data_dtype(dtype)
+    nib.save(stack, output)
+    return True
+
+
+def compose_transforms(reference, affine, inverse_warp, output, environ=None):
+    """Compose the inverse registration chain into one native space displacement field.
+
+    Args:
+        reference (str): Native space reference image.
+        affine (str): ``*GenericAffine.mat`` from the registration, applied inverted.
+        inverse_warp (str): ``*InverseWarp.nii.gz`` from the registration.
+        output (str): Path of the composed displacement field.
+        environ (dict, optional): Environment of antsApplyTransforms, e.g. limiting
+            its threads (see ``utils.threads``).
+
+    Returns:
+        str: The ``output`` path.
+    """
+    command = [
+        "antsApplyTransforms", "-d", "3",
+        "-r", reference,
+        "-o", f"[{output},1]",
+        "-t", f"[{affine},1]",
+        "-t", inverse_warp,
+    ]
+    exec_command(command, environ=environ)
+    return output
+
+
+def apply_field(image, reference, field, output, interpolation="Linear", time_series=False,
+                output_type=None, environ=None):
+    """Resample an image, or a stack of images, into native space through a field.
+
+    Args:
+        image (str): Template space image.
+        reference (str): Native space reference image.
+        field (str): Composed displacement field from ``compose_transforms``.
+        output (str): Path of the resampled image.
+        interpolation (str, optional): ANTs interpolator. Defaults to "Linear".
+        time_series (bool, optional): Resample each volume of a 4D image. Defaults
+            to False.
+        output_type (str, optional): ANTs output data type, e.g. "uchar".
+        environ (dict, optional): Environment of antsApplyTransforms.
+
+    Returns:
+        str: The ``output`` path.
+    """
+    command = ["antsApplyTransforms", "-d", "3"]
+    if time_series:
+        command += ["-e", "3"]
+    command += ["-i", image, "-r", reference, "-o", output, "-n", interpolation, "-t", field]
+    if output_type:
+        command += ["-u", output_type]
+    exec_command(command, environ=environ)
+    return output
+
+
+def _split_stack(stack, outputs):
+    """Write each volume of a 4D image to its own 3D image."""
+    img = nib.load(stack)
+    data = np.asanyarray(img.dataobj)
+    for i, output in enumerate(outputs):
+        volume = nib.Nifti1Image(data[..., i], img.affine)
+        volume.set_data_dtype(img.get_data_dtype())
+        nib.save(volume, output)
+
+
+def _template_stack(paths, name, dtype, work_dir, stack_dir=None):
+    """Get a 4D stack of template images, reusing a prepared one when available.
+
+    Returns:
+        tuple: Path of the stack, or None if the images are not on one grid, and
+            whether the stack is temporary to this subject.
+    """
+    if stack_dir is not None:
+        stack = os.path.join(stack_dir, name)
+        if os.path.exists(stack):
+            return stack, False
+    stack = os.path.join(work_dir, name)
+    if stack_images(paths, stack, dtype):
+        return stack, True
+    return None, False
+
+
+def stack_templates(template_dir, stack_dir):
+    """Prepare the prior stack and mask boxes of a template once, for sharing.
+
+    Args:
+        template_dir (str): Age specific template directory.
+        stack_dir (str): Directory to write the stacks to.
+
+    Returns:
+        str: The ``stack_dir`` path.
+    """
+    os.makedirs(stack_dir, exist_ok=True)
+    paths = [os.path.join(template_dir, f"{p}.nii.gz") for p in PRIORS]
+    stack = os.path.join(stack_dir, PRIORS_STACK)
+    if not os.path.exists(stack) and not stack_images(paths, stack, np.float32):
+        log.warning("The priors are not on one grid, they will be warped one at a time")
+    rois = os.path.join(stack_dir, TEMPLATE_ROIS)
+    if not os.path.exists(rois):
+        build_template_rois(template_dir, rois, MASKS)
+    return stack_dir
+
+
+def warp_priors(template_dir, reference, field, work_dir=WORK_DIR, stack_dir=None,
+                ext=NIFTI_GZ, environ=None):
+    """Warp the segmentation priors to native space in one pass.
+
+    The warped priors are written as ``<work_dir>/prior%d_scale<ext>`` for Atropos.
+    A prior stack prepared by ``stack_templates`` in ``stack_dir`` is reused.
+    """
+    paths = [os.path.join(template_dir, f"{p}.nii.gz") for p in PRIORS]
+    outputs = [os.path.join(work_dir, p + ext) for p in PRIORS]
+
+    stack, temporary = _template_stack(paths, PRIORS_STACK, np.float32, work_dir, stack_dir)
+    if stack is not None:
+        warped = os.path.join(work_dir, "priors_warped.nii")
+        apply_field(stack, reference, field, warped, "Linear", time_series=True,
+                    environ=environ)
+        _split_stack(warped, outputs)
+        os.remove(warped)
+        if temporary:
+            os.remove(stack)
+    else:
+        log.warning("Priors are not on one grid, warping them one at a time")
+        for path, output in zip(paths, outputs):
+            apply_field(path, reference, field, output, "Linear", environ=environ)
+    return outputs
+
+
+def warp_masks(template_dir, field, work_dir=WORK_DIR, stack_dir=None):
+    """Warp the label masks to native space, as sparse boxes.
+
+    The masks are warped in process through the composed field, each only inside
+    its native box (see ``utils.roi``), and written as a single
+    ``<work_dir>/warped_masks.npz``. The template boxes prepared by
+    ``stack_templates`` in ``stack_dir`` are reused.
+    """
+    output = os.path.join(work_dir, WARPED_MASKS)
+    if stack_dir is not None and os.path.exists(os.path.join(stack_dir, TEMPLATE_ROIS)):
+        return warp_rois(load_rois(os.path.join(stack_dir, TEMPLATE_ROIS)), field, output)
+    rois = build_template_rois(template_dir, os.path.join(work_dir, TEMPLATE_ROIS), MASKS)
+    warp_rois(load_rois(rois), field, output)
+    os.remove(rois)
+    return output
+
+
+def warp_template_images(template_dir, reference, work_dir=WORK_DIR, stack_dir=None,
+                         ext=NIFTI_GZ, environ=None):
+    """Bring the template priors and masks into native space.
+
+    Args:
+        template_dir (str): Age specific template directory.
+        reference (str): Native space reference (the brain extracted input).
+        work_dir (str, optional): Directory holding the registration output, where
+            the warped images are written. Defaults to ``/flywheel/v0/work``.
+        stack_dir (str, optional): Directory of template stacks prepared by
+            ``stack_templates``, shared between subjects.
+        ext (str, optional): Extension of the NIfTI files written, see
+            ``utils.storage``. Defaults to ``.nii.gz``.
+        environ (dict, optional): Environment of the ANTs commands, limiting
+            their threads (see ``utils.threads``).
+
+    Returns:
+        tuple: Paths of the warped priors and of the warped mask boxes.
+    """
+    affine = glob.glob(os.path.join(work_dir, "bet*GenericAffine.mat"))[0]
+    inverse_warp = glob.glob(os.path.join(work_dir, "bet*InverseWarp.nii.gz"))[0]
+
+    log.info("Composing registration transforms into a native space field")
+    field = compose_transforms(reference, affine, inverse_warp,
+                               os.path.join(work_dir, nifti(NATIVE_WARP, ext)), environ)
+
+    log.info("Transforming priors to native space for segmentation")
+    priors = warp_priors(template_dir, reference, field, work_dir, stack_dir, ext, environ)
+
+    log.info("Transforming masks to native space")
+    masks = warp_masks(template_dir, field, work_dir, stack_dir)
+    return priors, masks
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("template_dir", help="age specific template directory")
+    parser.add_argument("reference", help="native space reference image")
+    parser.add_argument("work_dir", nargs="?", default=WORK_DIR)
+    parser.add_argument("--stack-dir", help="shared template stacks, see stack_templates")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    warp_template_images(args.template_dir, args.reference, args.work_dir, args.stack_dir)
@@ -0,0 +1,222 @@
+"""Label volume extraction for the final segmentation atlas.
+
+Replaces the per-label ``fslstats -l/-u -V`` calls of the original shell pipeline:
+the atlas is loaded once and every label is counted in a single histogram pass.
+The voxel counts are then scaled by the voxel volume to give mm³ volumes, and the
+summary measures (supratentorial tissue, ICV) are derived from the label volumes.
+
+Example:
+    >>> from utils.volumes import extract_volumes
+    >>> extract_volumes("12M")
+    '/flywheel/v0/work/All_volumes.csv'
+"""
+
+import argparse
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+WORK_DIR = "/flywheel/v0/work"
+ATLAS_NAME = "Final_segmentation_atlas_with_callosum.nii.gz"
+VOLUMES_NAME = "All_volumes.csv"
+
+# Label value of each structure in Final_segmentation_atlas_with_callosum.
+LABELS = {
+    "supratentorial_general": 1,
+    "supratentorial_csf": 2,
+    "ventricles": 3,
+    "posterior_callosum": 8,
+    "mid_posterior_callosum": 9,
+    "central_callosum": 10,
+    "mid_anterior_callosum": 11,
+    "anterior_callosum": 12,
+    "left_thalamus": 17,
+    "left_caudate": 18,
+    "left_putamen": 19,
+    "left_globus_pallidus": 20,
+    "right_thalamus": 27,
+    "right_caudate": 28,
+    "right_putamen": 29,
+    "right_globus_pallidus": 30,
+    "cerebellum": 31,
+    "cerebellum_csf": 32,
+    "brainstem": 41,
+    "brainstem_csf": 42,
+}
+
+# Summary measures, evaluated in order, as sums of labels or earlier measures.
+DERIVED = {
+    "supratentorial_tissue": (
+        "supratentorial_general",
+        "left_thalamus",
+        "left_caudate",
+        "left_putamen",
+        "left_globus_pallidus",
+        "right_thalamus",
+        "right_caudate",
+        "right_putamen",
+        "right_globus_pallidus",
+        "posterior_callosum",
+        "mid_posterior_callosum",
+        "central_callosum",
+        "mid_anterior_callosum",
+        "anterior_callosum",
+    ),
+    "icv": (
+        "supratentorial_tissue",
+        "supratentorial_csf",
+        "cerebellum",
+        "cerebellum_csf",
+        "brainstem",
+        "brainstem_csf",
+    ),
+}
+
+# Column order of All_volumes.csv
+COLUMNS = (
+    "template_age",
+    "supratentorial_tissue",
+    "supratentorial_csf",
+    "ventricles",
+    "cerebellum",
+    "cerebellum_csf",
+    "brainstem",
+    "brainstem_csf",
+    "left_thalamus",
+    "left_caudate",
+    "left_putamen",
+    "left_globus_pallidus",
+    "right_thalamus",
+    "right_caudate",
+    "right_putamen",
+    "right_globus_pallidus",
+    "posterior_callosum",
+    "mid_posterior_callosum",
+    "central_callosum",
+    "mid_anterior_callosum",
+    "anterior_callosum",
+    "icv",
+)
+
+# Number of slices histogrammed at a time, bounds the temporary integer copy.
+_CHUNK_SLICES = 32
+
+
+def label_histogram(data):
+    """Count the voxels of every integer label in a label volume.
+
+    Voxel values are rounded to the nearest integer, which matches the
+    ``fslstats -l <label - 0.5> -u <label + 0.5>`` windows used previously.
+
+    Args:
+        data (numpy.ndarray): 3D label volume, integer or float valued.
+
+    Returns:
+        numpy.ndarray: ``counts[label]`` is the number of voxels with that label.
+    """
+    counts = np.zeros(1, dtype=np.int64)
+    for start in range(0, data.shape[-1], _CHUNK_SLICES):
+        chunk = data[..., start:start + _CHUNK_SLICES]
+        if chunk.dtype.kind == "f":
+            chunk = np.rint(chunk)
+        chunk = chunk[chunk > 0].astype(np.intp)
+        chunk_counts = np.bincount(chunk)
+        if chunk_counts.size > counts.size:
+            chunk_counts[:counts.size] += counts
+            counts = chunk_counts
+        else:
+            counts[:chunk_counts.size] += chunk_counts
+    return counts
+
+
+def label_volumes(atlas, labels=None):
+    """Get the voxel count and mm³ volume of each label in an atlas.
+
+    Args:
+        atlas (str or nibabel.Nifti1Image): Path to, or loaded, label image.
+        labels (dict, optional): Mapping of name to label value. Defaults to
+            ``LABELS``.
+
+    Returns:
+        dict: Mapping of name to a ``(voxels, volume_mm3)`` tuple.
+    """
+    labels = LABELS if labels is None else labels
+    img = nib.load(atlas) if isinstance(atlas, (str, os.PathLike)) else atlas
+    voxel_volume = float(np.prod(img.header.get_zooms()[:3]))
+
+    counts = label_histogram(np.asanyarray(img.dataobj))
+    volumes = {}
+    for name, value in labels.items():
+        voxels = int(counts[value]) if value < counts.size else 0
+        volumes[name] = (voxels, voxels * voxel_volume)
+    return volumes
+
+
+def summarise_volumes(volumes):
+    """Add the derived summary measures to a set of label volumes.
+
+    Args:
+        volumes (dict): Mapping of name to mm³ volume.
+
+    Returns:
+        dict: Copy of ``volumes`` including the ``DERIVED`` measures.
+    """
+    volumes = dict(volumes)
+    for name, parts in DERIVED.items():
+        volumes[name] = sum(volumes[part] for part in parts)
+    return volumes
+
+
+def write_volumes(volumes, age, output_csv):
+    """Write a row of volumes in the whitespace separated All_volumes.csv layout.
+
+    Args:
+        volumes (dict): Mapping of column name to mm³ volume.
+        age (str): Template age, written to the ``template_age`` column.
+        output_csv (str): Path to the output file.
+    """
+    row = [str(age)] + [f"{volumes[column]:.6f}" for column in COLUMNS[1:]]
+    with open(output_csv, "w") as f:
+        f.write(" ".join(COLUMNS) + "\n")
+        f.write(" ".join(row) + "\n")
+
+
+def extract_volumes(age, work_dir=WORK_DIR, atlas=None, output_csv=None):
+    """Extract the volume of every label of the final segmentation atlas.
+
+    Args:
+        age (str): Template age, written to the ``template_age`` column.
+        work_dir (str, optional): Directory holding the atlas, and where the csv is
+            written. Defaults to ``/flywheel/v0/work``.
+        atlas (str, optional): Path to the atlas. Defaults to
+            ``<work_dir>/Final_segmentation_atlas_with_callosum.nii.gz``.
+        output_csv (str, optional): Path to the csv. Defaults to
+            ``<work_dir>/All_volumes.csv``.
+
+    Returns:
+        str: Path to the written csv.
+    """
+    atlas = atlas or os.path.join(work_dir, ATLAS_NAME)
+    output_csv = output_csv or os.path.join(work_dir, VOLUMES_NAME)
+
+    log.info("Extracting label volumes from %s", atlas)
+    volumes = label_volumes(atlas)
+    volumes = summarise_volumes({name: mm3 for name, (_, mm3) in volumes.items()})
+    write_volumes(volumes, age, output_csv)
+
+    log.info("Volumes extracted and saved to %s", output_csv)
+    return output_csv
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("atlas", help="final segmentation atlas")
+    parser.add_argument("age", help="template age, e.g. 12M")
+    parser.add_argument("output_csv", help="output volumes file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    extract_volumes(args.age, atlas=args.atlas, output_csv=args.output_csv)